@@ -3,39 +3,39 @@ import os
 from threading import Lock
 from threading import Thread
 
-from Torrent import Torrent
-from TorrentMetainfo import TorrentMetainfo
+from Session import Session
 
 
 class Client:
     max_name_len = 28
 
-    def __init__(self, path):
+    def __init__(self, paths):
         self.is_available = True
         self.print_lock = Lock()
-        self.torrent_name = path
-        metainfo = TorrentMetainfo(path)
-        self.torrent = Torrent(metainfo)
+        # 所有torrent共享同一个Session
+        self.session = Session()
+        self.torrent_names = {}
+        for path in paths:
+            torrent = self.session.add(path)
+            self.torrent_names[torrent.metainfo.info_hash] = path
 
     @staticmethod
-    # 进度条清屏
+    # 进度条清屏, 使用ANSI转义序列而不是每次创建clear子进程
     def cls():
-        os.system('cls' if os.name == 'nt' else 'clear')
+        print('\x1b[H\x1b[2J', end='', flush=True)
 
     # 多线程并发
     def run(self):
         t1 = Thread(target=self.print_torrents_table_always,
                     args=(), daemon=True)
-        t2 = Thread(target=self.torrent.run_download,
-                    args=(), daemon=True)
+        self.session.start()
         t1.start()
-        t2.start()
         t1.join()
-        t2.join()
+        self.session.stop()
 
     # 设定下载进度条格式
     def print_torrents_table_always(self):
-        while self.torrent.progress < 1:
+        while not self.session.is_completed:
             time.sleep(.5)
             with self.print_lock:
                 self.cls()
@@ -45,19 +45,21 @@ class Client:
 
     def get_torrents_table(self):
         res = ['Name                         | '
-               'Progress | Peers | Speed', '']
-
-        cur_res = []
-        full_torr_name = os.path.basename(self.torrent_name)
-        short_torr_name = full_torr_name[:self.max_name_len]
-        cur_res.append('{:<{max_len}}'.format(short_torr_name,
-                                              max_len=self.max_name_len))
-        torrent = self.torrent
-        cur_progress = '{:.2%}'.format(torrent.progress)
-        cur_peers_count = len(torrent.peers)
-        cur_speed = torrent.download_speed
-        cur_res.append('{:<8}'.format(cur_progress))
-        cur_res.append('{:<5}'.format(cur_peers_count))
-        cur_res.append('{:<11}'.format(cur_speed))
-        res.append(' | '.join(cur_res))
+               'Status      | Progress | Peers | Speed', '']
+
+        for info_hash, torrent in list(self.session.torrents.items()):
+            cur_res = []
+            full_torr_name = os.path.basename(self.torrent_names[info_hash])
+            short_torr_name = full_torr_name[:self.max_name_len]
+            cur_res.append('{:<{max_len}}'.format(short_torr_name,
+                                                  max_len=self.max_name_len))
+            cur_status = self.session.get_status(info_hash)
+            cur_progress = '{:.2%}'.format(torrent.progress)
+            cur_peers_count = len(torrent.peers)
+            cur_speed = torrent.download_speed
+            cur_res.append('{:<11}'.format(cur_status))
+            cur_res.append('{:<8}'.format(cur_progress))
+            cur_res.append('{:<5}'.format(cur_peers_count))
+            cur_res.append('{:<11}'.format(cur_speed))
+            res.append(' | '.join(cur_res))
         return '\n'.join(res)
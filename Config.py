@@ -5,7 +5,63 @@ SETTINGS = {
     'port': '6881',
     'timeout': 3,
     'timeout_for_peer': 10,
+    'keepalive_interval': 120,
+    'peer_tick_interval': 5,
+    'peer_wait_interval': 0.1,
+    'peer_inactivity_timeout': 240,
+    'peer_idle_timeout': 60,
+    'initial_request_timeout': 5,
+    'min_request_timeout': 1,
+    'max_request_timeout': 60,
+    'max_request_timeouts': 3,
+    'have_batch_interval': 0.5,
+    'udp_max_retries': 1,
     'protocol_name': b'BitTorrent protocol',
     'max_ans_size': 2048,
-    'numwant': 75
+    'numwant': 75,
+    'max_peers': 80,
+    'announce_interval': 1800,
+    'min_announce_interval': 60,
+    'pex_interval': 60,
+    'max_pending_handshakes': 20,
+    'max_incoming_peers': 40,
+    'max_peer_strikes': 2,
+    'ban_duration': 3600,
+    'single_peer_timeout': 60,
+    'max_connections': 200,
+    'max_active_torrents': 3,
+    'disk_queue_size': 64,
+    'file_allocation': 'sparse',
+    'read_cache_size': 2 ** 25,
+    'max_unchoked_peers': 4,
+    'metainfo_cache': 'metainfo_cache.db',
+    'rpc_socket': 'torrent_rpc.sock',
+    'rpc_host': '127.0.0.1',
+    'rpc_port': 6880,
+    'rpc_timeout': 10,
+    'metrics_host': '127.0.0.1',
+    'metrics_port': 9881,
+    'metrics_window': 10,
+    'trace_max_events': 1000000,
+    'peer_trace_dir': None,
+    'web_seed_max_request': 2 ** 22,
+    'web_seed_timeout': 30,
+    'web_seed_retry_interval': 10,
+    'web_seed_max_failures': 5,
+    'web_seed_idle_interval': 1,
+    'shard_claim_pieces': 8,
+    'shard_idle_release': 10,
+    'dht_enabled': True,
+    'dht_port': 6881,
+    'dht_bootstrap_nodes': [('router.bittorrent.com', 6881),
+                            ('router.utorrent.com', 6881),
+                            ('dht.transmissionbt.com', 6881)],
+    'dht_state_file': 'dht_state.dat',
+    'dht_timeout': 2,
+    'dht_max_failures': 2,
+    'dht_peer_ttl': 1800,
+    'dht_maintain_interval': 60,
+    'dht_refresh_interval': 900,
+    'dht_token_interval': 300,
+    'dht_save_interval': 600
 }
@@ -0,0 +1,657 @@
+import hashlib
+import os
+import socket
+import struct
+import time
+from queue import Queue
+from threading import Event
+from threading import Lock
+from threading import Thread
+
+import Bencode
+from Config import SETTINGS
+from TrackerAPI import encode_compact_peer
+
+# k-bucket容量
+K = 8
+# 迭代查找时的并发请求数
+ALPHA = 3
+
+
+def _distance(id1, id2):
+    """
+    计算两个节点id之间的XOR距离
+    :param id1: 20字节的节点id
+    :param id2: 20字节的节点id
+    :return: int类型的距离
+    """
+    return int.from_bytes(id1, 'big') ^ int.from_bytes(id2, 'big')
+
+
+def _is_id(value):
+    """
+    :param value: KRPC参数
+    :return: 是否为20字节的节点id或info_hash
+    """
+    return isinstance(value, bytes) and len(value) == 20
+
+
+def decode_compact_nodes(data):
+    """
+    解析compact格式的节点信息, 每26字节一组: <20字节id><4字节ip><2字节port>
+    :param data: bytes类型的节点数据
+    :return: [(node_id, ip, port),..]的元组列表
+    """
+    data = memoryview(data)[:len(data) - len(data) % 26]
+    inet_ntoa = socket.inet_ntoa
+    return [(node_id, inet_ntoa(bin_ip), port)
+            for node_id, bin_ip, port in struct.iter_unpack('!20s4sH', data)]
+
+
+def encode_compact_nodes(nodes):
+    """
+    将节点列表编码为compact格式
+    :param nodes: DHTNodeInfo列表
+    :return: bytes类型的节点数据
+    """
+    return b''.join(node.node_id + encode_compact_peer(node.ip, node.port)
+                    for node in nodes)
+
+
+class DHTNodeInfo:
+    """路由表中的远端节点"""
+
+    def __init__(self, node_id, ip, port):
+        self.node_id = node_id
+        self.ip = ip
+        self.port = port
+        self.last_seen = time.monotonic()
+        self.failures = 0
+
+    @property
+    def addr(self):
+        """
+        :return: (ip, port)
+        """
+        return self.ip, self.port
+
+
+class RoutingTable:
+    """
+    Kademlia路由表: 按与本节点id的XOR距离的最高位划分为160个k-bucket,
+    每个bucket最多保存K个节点
+    """
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.buckets = [[] for _ in range(160)]
+        self.lock = Lock()
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def _get_bucket(self, node_id):
+        """
+        :param node_id: 节点id
+        :return: 该节点所属的bucket, 本节点自身返回None
+        """
+        distance = _distance(self.node_id, node_id)
+        if distance == 0:
+            return None
+        return self.buckets[distance.bit_length() - 1]
+
+    def add(self, node_id, ip, port):
+        """
+        添加或刷新节点; bucket已满时替换其中失败过多的节点, 否则丢弃新节点
+        :param node_id: 节点id
+        :param ip: 节点ip
+        :param port: 节点端口
+        :return: 节点是否在路由表中
+        """
+        if len(node_id) != 20:
+            return False
+        with self.lock:
+            bucket = self._get_bucket(node_id)
+            if bucket is None:
+                return False
+            for idx, node in enumerate(bucket):
+                if node.node_id == node_id:
+                    node.ip, node.port = ip, port
+                    node.last_seen = time.monotonic()
+                    node.failures = 0
+                    # 最近活跃的节点移至bucket末尾
+                    bucket.append(bucket.pop(idx))
+                    return True
+            if len(bucket) >= K:
+                bad_nodes = [node for node in bucket
+                             if node.failures >= SETTINGS['dht_max_failures']]
+                if not bad_nodes:
+                    return False
+                bucket.remove(bad_nodes[0])
+            bucket.append(DHTNodeInfo(node_id, ip, port))
+            return True
+
+    def mark_failed(self, node_id):
+        """
+        记录节点的一次请求超时
+        :param node_id: 节点id
+        :return: None
+        """
+        with self.lock:
+            bucket = self._get_bucket(node_id)
+            for node in bucket or []:
+                if node.node_id == node_id:
+                    node.failures += 1
+                    return
+
+    def closest(self, target, count=K):
+        """
+        :param target: 目标id
+        :param count: 返回的节点数量
+        :return: 距离目标最近且状态良好的节点列表
+        """
+        with self.lock:
+            nodes = [node for bucket in self.buckets for node in bucket
+                     if node.failures < SETTINGS['dht_max_failures']]
+        nodes.sort(key=lambda node: _distance(node.node_id, target))
+        return nodes[:count]
+
+    def get_nodes(self):
+        """
+        :return: 路由表中的所有节点
+        """
+        with self.lock:
+            return [node for bucket in self.buckets for node in bucket]
+
+
+class _KRPCTransaction:
+    """等待中的KRPC请求"""
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.response = None
+        self.event = Event()
+
+
+class DHTNode:
+    """
+    BEP 5 Mainline DHT节点: 基于UDP的KRPC协议与Kademlia路由表,
+    支持get_peers/announce_peer的迭代并行查找, 路由表保存在磁盘上以便重启后复用
+    """
+
+    def __init__(self, port=None, bootstrap_nodes=None, state_file=None, host='0.0.0.0'):
+        self.host = host
+        self.port = SETTINGS['dht_port'] if port is None else port
+        self.bootstrap_nodes = (SETTINGS['dht_bootstrap_nodes'] if bootstrap_nodes is None
+                                else bootstrap_nodes)
+        self.state_file = SETTINGS['dht_state_file'] if state_file is None else state_file
+        self.node_id = None
+        self.table = None
+        self.sock = None
+        self.is_running = False
+        self._pending = {}
+        self._pending_lock = Lock()
+        self._stop_event = Event()
+        # 本节点保存的peer: {info_hash: {(ip, port): 加入时间}}
+        self.peer_store = {}
+        self.peer_store_lock = Lock()
+        # 用于生成announce_peer token的密钥, 保留上一个以接受旧token
+        self._secret = os.urandom(8)
+        self._prev_secret = self._secret
+
+    def start(self):
+        """
+        绑定UDP端口, 加载持久化的路由表并启动接收与维护线程
+        :return: None
+        """
+        if self.is_running:
+            return
+        self._load_state()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((self.host, self.port))
+        self.port = self.sock.getsockname()[1]
+        self.is_running = True
+        Thread(target=self._recv_always, daemon=True).start()
+        Thread(target=self._maintain_always, daemon=True).start()
+
+    def stop(self):
+        """
+        保存路由表并关闭套接字
+        :return: None
+        """
+        if not self.is_running:
+            return
+        self.is_running = False
+        self._stop_event.set()
+        self.save_state()
+        self.sock.close()
+
+    def bootstrap(self):
+        """
+        通过bootstrap节点以及路由表中已有的节点查找本节点id附近的节点
+        :return: 路由表中的节点数量
+        """
+        addrs = []
+        for host, port in self.bootstrap_nodes:
+            try:
+                addrs.append((socket.gethostbyname(host), port))
+            except OSError:
+                continue
+        self._iterative_lookup(self.node_id, b'find_node', extra_addrs=addrs)
+        return len(self.table)
+
+    def _ensure_bootstrapped(self):
+        """
+        路由表为空时先同步bootstrap
+        :return: None
+        """
+        if len(self.table) == 0:
+            self.bootstrap()
+
+    def add_node(self, ip, port):
+        """
+        在后台ping一个节点(例如peer通过PORT消息告知的节点), 响应后自动加入路由表
+        :param ip: 节点ip或主机名
+        :param port: 节点端口
+        :return: None
+        """
+        if self.is_running:
+            Thread(target=self._ping_host, args=(ip, port), daemon=True).start()
+
+    def _ping_host(self, host, port):
+        """
+        解析主机名后ping该节点
+        :param host: 节点ip或主机名
+        :param port: 节点端口
+        :return: None
+        """
+        try:
+            self.ping((socket.gethostbyname(host), port))
+        except OSError:
+            pass
+
+    def ping(self, addr):
+        """
+        :param addr: (ip, port)
+        :return: 对端的节点id, 无响应时返回None
+        """
+        res = self._query(addr, b'ping', {})
+        return None if res is None else res.get(b'id')
+
+    def find_node(self, target):
+        """
+        迭代查找距离target最近的K个节点
+        :param target: 20字节的目标id
+        :return: [(node_id, ip, port)]列表
+        """
+        responded, _ = self._iterative_lookup(target, b'find_node')
+        return [(node_id, ip, port) for node_id, (ip, port), _ in responded]
+
+    def get_peers(self, info_hash, on_peers=None):
+        """
+        迭代查找下载info_hash的peer
+        :param info_hash: 20字节的info_hash
+        :param on_peers: 每当有新的peer到达时以[peer的packed bytes键]调用的回调
+        :return: peer的packed bytes键(compact格式)列表
+        """
+        self._ensure_bootstrapped()
+        _, peers = self._iterative_lookup(info_hash, b'get_peers', on_peers=on_peers)
+        return peers
+
+    def announce_peer(self, info_hash, port=None, on_peers=None):
+        """
+        查找info_hash并向最近的、返回了token的K个节点宣告本端正在下载
+        :param info_hash: 20字节的info_hash
+        :param port: 本端监听的端口, 默认为SETTINGS['port']
+        :param on_peers: 查找过程中得到新peer时以[peer的packed bytes键]调用的回调
+        :return: 查找到的peer的packed bytes键列表
+        """
+        port = int(SETTINGS['port']) if port is None else port
+        self._ensure_bootstrapped()
+        responded, peers = self._iterative_lookup(info_hash, b'get_peers', on_peers=on_peers)
+        threads = []
+        for _, addr, token in responded:
+            if token is None:
+                continue
+            args = {b'info_hash': info_hash, b'port': port, b'token': token,
+                    b'implied_port': 0}
+            cur_thread = Thread(target=self._query, args=(addr, b'announce_peer', args),
+                                daemon=True)
+            threads.append(cur_thread)
+            cur_thread.start()
+        for thread in threads:
+            thread.join()
+        return peers
+
+    def _iterative_lookup(self, target, query, on_peers=None, extra_addrs=()):
+        """
+        Kademlia迭代查找: 每次并发向最多ALPHA个尚未查询的最近节点发送请求,
+        直到最近的K个节点都已查询完毕
+        :param target: 20字节的目标id
+        :param query: b'find_node'或b'get_peers'
+        :param on_peers: get_peers查找中得到新peer时的回调
+        :param extra_addrs: 额外查询的(ip, port), 例如id未知的bootstrap节点
+        :return: ([(node_id, addr, token)], [peer的packed bytes键]), 前者按距离排序且最多K个
+        """
+        arg_name = b'target' if query == b'find_node' else b'info_hash'
+        # 候选节点: {addr: node_id}, id未知时为None
+        shortlist = {node.addr: node.node_id for node in self.table.closest(target)}
+        for addr in extra_addrs:
+            shortlist.setdefault(addr, None)
+        queried = set()
+        # 已响应的节点: {addr: (node_id, token)}
+        responded = {}
+        peers = []
+        seen_peers = set()
+        results = Queue()
+        in_flight = 0
+
+        def sort_key(addr):
+            node_id = shortlist[addr]
+            return -1 if node_id is None else _distance(node_id, target)
+
+        def query_node(addr):
+            results.put((addr, self._query(addr, query, {arg_name: target})))
+
+        while True:
+            # 仅在最近的K个候选节点中选择尚未查询的节点
+            closest = sorted(shortlist, key=sort_key)[:K]
+            for addr in closest:
+                if in_flight >= ALPHA:
+                    break
+                if addr in queried:
+                    continue
+                queried.add(addr)
+                in_flight += 1
+                Thread(target=query_node, args=(addr,), daemon=True).start()
+            if in_flight == 0:
+                break
+            addr, res = results.get()
+            in_flight -= 1
+            if res is None:
+                shortlist.pop(addr, None)
+                continue
+            node_id = res.get(b'id')
+            if not isinstance(node_id, bytes) or len(node_id) != 20:
+                shortlist.pop(addr, None)
+                continue
+            shortlist[addr] = node_id
+            responded[addr] = (node_id, res.get(b'token'))
+            for new_id, ip, port in decode_compact_nodes(res.get(b'nodes', b'')):
+                if new_id != self.node_id and (ip, port) not in shortlist:
+                    shortlist[(ip, port)] = new_id
+            new_peers = []
+            # values中的compact peer(IPv4为6字节, IPv6为18字节)直接作为packed bytes键
+            for value in res.get(b'values', []):
+                if not isinstance(value, bytes) or len(value) not in (6, 18):
+                    continue
+                if value not in seen_peers:
+                    seen_peers.add(value)
+                    new_peers.append(value)
+            peers.extend(new_peers)
+            if new_peers and on_peers is not None:
+                on_peers(new_peers)
+
+        res_nodes = sorted(((node_id, addr, token) for addr, (node_id, token) in responded.items()),
+                           key=lambda item: _distance(item[0], target))
+        return res_nodes[:K], peers
+
+    def _query(self, addr, query, args):
+        """
+        发送KRPC请求并等待响应
+        :param addr: (ip, port)
+        :param query: 请求名称
+        :param args: 请求参数字典(不含id)
+        :return: 响应中的r字典, 超时或出错时返回None
+        """
+        transaction = _KRPCTransaction(addr)
+        with self._pending_lock:
+            transaction_id = os.urandom(2)
+            while transaction_id in self._pending:
+                transaction_id = os.urandom(2)
+            self._pending[transaction_id] = transaction
+        args = dict(args)
+        args[b'id'] = self.node_id
+        msg = {b'a': dict(sorted(args.items())), b'q': query,
+               b't': transaction_id, b'y': b'q'}
+        try:
+            self.sock.sendto(Bencode.encode(msg), addr)
+            transaction.event.wait(SETTINGS['dht_timeout'])
+        except OSError:
+            pass
+        finally:
+            with self._pending_lock:
+                self._pending.pop(transaction_id, None)
+        res = transaction.response
+        if res is None or res.get(b'y') != b'r':
+            for node in self.table.get_nodes():
+                if node.addr == addr:
+                    self.table.mark_failed(node.node_id)
+            return None
+        return res.get(b'r')
+
+    def _recv_always(self):
+        """
+        接收线程: 分发响应并处理其他节点的请求
+        :return: None
+        """
+        while self.is_running:
+            try:
+                data, addr = self.sock.recvfrom(65536)
+            except OSError:
+                return
+            try:
+                msg = Bencode.decode(data)
+                if not isinstance(msg, dict):
+                    continue
+                msg_type = msg.get(b'y')
+                if msg_type == b'q':
+                    self._handle_query(msg, addr)
+                elif msg_type in (b'r', b'e'):
+                    self._handle_response(msg, addr)
+            except Exception:
+                # 丢弃格式错误的报文
+                continue
+
+    def _handle_response(self, msg, addr):
+        """
+        将响应交给等待中的请求, 并把响应节点加入路由表
+        :param msg: 解码后的KRPC消息
+        :param addr: 来源地址
+        :return: None
+        """
+        with self._pending_lock:
+            transaction = self._pending.get(msg.get(b't'))
+        if transaction is None or transaction.addr != addr:
+            return
+        if msg[b'y'] == b'r':
+            node_id = msg.get(b'r', {}).get(b'id')
+            if isinstance(node_id, bytes):
+                self.table.add(node_id, addr[0], addr[1])
+        transaction.response = msg
+        transaction.event.set()
+
+    def _handle_query(self, msg, addr):
+        """
+        处理其他节点发来的ping/find_node/get_peers/announce_peer请求
+        :param msg: 解码后的KRPC消息
+        :param addr: 来源地址
+        :return: None
+        """
+        query = msg.get(b'q')
+        args = msg.get(b'a')
+        if not isinstance(args, dict) or not _is_id(args.get(b'id')):
+            self._send_error(msg, addr, 203, b'Protocol Error')
+            return
+        # 缺少或格式错误的参数回复203, 而不是在接收线程中抛出异常
+        arg_name = {b'find_node': b'target', b'get_peers': b'info_hash',
+                    b'announce_peer': b'info_hash'}.get(query)
+        if arg_name is not None and not _is_id(args.get(arg_name)):
+            self._send_error(msg, addr, 203, b'Protocol Error: invalid ' + arg_name)
+            return
+        if query == b'announce_peer' and not args.get(b'implied_port'):
+            port = args.get(b'port')
+            if not isinstance(port, int) or not 0 < port < 65536:
+                self._send_error(msg, addr, 203, b'Protocol Error: invalid port')
+                return
+        self.table.add(args[b'id'], addr[0], addr[1])
+        res = {b'id': self.node_id}
+        if query == b'ping':
+            pass
+        elif query == b'find_node':
+            res[b'nodes'] = encode_compact_nodes(self.table.closest(args[b'target']))
+        elif query == b'get_peers':
+            info_hash = args[b'info_hash']
+            res[b'token'] = self._get_token(addr[0])
+            values = self._get_stored_peers(info_hash)
+            if values:
+                res[b'values'] = values
+            else:
+                res[b'nodes'] = encode_compact_nodes(self.table.closest(info_hash))
+        elif query == b'announce_peer':
+            if not self._is_valid_token(args.get(b'token'), addr[0]):
+                self._send_error(msg, addr, 203, b'Bad token')
+                return
+            port = addr[1] if args.get(b'implied_port') else args[b'port']
+            with self.peer_store_lock:
+                self.peer_store.setdefault(args[b'info_hash'], {})[(addr[0], port)] = \
+                    time.monotonic()
+        else:
+            self._send_error(msg, addr, 204, b'Method Unknown')
+            return
+        reply = {b'r': dict(sorted(res.items())), b't': msg.get(b't', b''), b'y': b'r'}
+        self.sock.sendto(Bencode.encode(reply), addr)
+
+    def _send_error(self, msg, addr, code, message):
+        """
+        发送KRPC错误响应
+        :param msg: 引起错误的请求
+        :param addr: 目标地址
+        :param code: 错误码
+        :param message: 错误信息
+        :return: None
+        """
+        reply = {b'e': [code, message], b't': msg.get(b't', b''), b'y': b'e'}
+        self.sock.sendto(Bencode.encode(reply), addr)
+
+    def _get_stored_peers(self, info_hash):
+        """
+        :param info_hash: 20字节的info_hash
+        :return: 最多50个未过期peer的compact编码列表
+        """
+        expire_time = time.monotonic() - SETTINGS['dht_peer_ttl']
+        with self.peer_store_lock:
+            stored = self.peer_store.get(info_hash, {})
+            return [encode_compact_peer(ip, port)
+                    for (ip, port), added_time in list(stored.items())[:50]
+                    if added_time > expire_time]
+
+    def _get_token(self, ip, secret=None):
+        """
+        :param ip: 请求方ip
+        :param secret: 使用的密钥, 默认为当前密钥
+        :return: 与请求方ip绑定的token
+        """
+        secret = self._secret if secret is None else secret
+        return hashlib.sha1(secret + socket.inet_aton(ip)).digest()[:8]
+
+    def _is_valid_token(self, token, ip):
+        """
+        :param token: announce_peer中携带的token
+        :param ip: 请求方ip
+        :return: token是否由当前或上一个密钥生成
+        """
+        return token in (self._get_token(ip), self._get_token(ip, self._prev_secret))
+
+    def _maintain_always(self):
+        """
+        维护线程: 路由表节点不足时重新bootstrap, 定期刷新路由表、轮换token密钥、
+        清理过期peer并保存路由表
+        :return: None
+        """
+        last_refresh = last_save = last_rotate = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                if len(self.table) < K:
+                    self.bootstrap()
+                cur_time = time.monotonic()
+                if cur_time - last_refresh >= SETTINGS['dht_refresh_interval']:
+                    last_refresh = cur_time
+                    self.find_node(os.urandom(20))
+                if cur_time - last_rotate >= SETTINGS['dht_token_interval']:
+                    last_rotate = cur_time
+                    self._prev_secret, self._secret = self._secret, os.urandom(8)
+                    self._expire_peers()
+                if cur_time - last_save >= SETTINGS['dht_save_interval']:
+                    last_save = cur_time
+                    self.save_state()
+            except OSError:
+                pass
+            self._stop_event.wait(SETTINGS['dht_maintain_interval'])
+
+    def _expire_peers(self):
+        """
+        清理超过dht_peer_ttl的peer
+        :return: None
+        """
+        expire_time = time.monotonic() - SETTINGS['dht_peer_ttl']
+        with self.peer_store_lock:
+            for info_hash in list(self.peer_store):
+                stored = self.peer_store[info_hash]
+                for peer in [peer for peer, added_time in stored.items()
+                             if added_time <= expire_time]:
+                    stored.pop(peer)
+                if not stored:
+                    self.peer_store.pop(info_hash)
+
+    def _load_state(self):
+        """
+        从state_file加载节点id与路由表, 不存在时生成新的随机id
+        :return: None
+        """
+        state = {}
+        if self.state_file and os.path.isfile(self.state_file):
+            try:
+                with open(self.state_file, 'rb') as f:
+                    state = Bencode.readfile(f)
+            except (OSError, ValueError):
+                state = {}
+        node_id = state.get(b'id')
+        self.node_id = node_id if isinstance(node_id, bytes) and len(node_id) == 20 \
+            else os.urandom(20)
+        self.table = RoutingTable(self.node_id)
+        for node_id, ip, port in decode_compact_nodes(state.get(b'nodes', b'')):
+            self.table.add(node_id, ip, port)
+
+    def save_state(self):
+        """
+        将节点id与路由表以bencode格式写入state_file
+        :return: None
+        """
+        if not self.state_file or self.table is None:
+            return
+        state = {b'id': self.node_id, b'nodes': encode_compact_nodes(self.table.get_nodes())}
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(Bencode.encode(state))
+        os.replace(tmp_file, self.state_file)
+
+
+_dht_node = None
+_dht_node_lock = Lock()
+
+
+def get_dht_node():
+    """
+    :return: 进程内共享并已启动的DHTNode, 端口不可用时返回None
+    """
+    global _dht_node
+    with _dht_node_lock:
+        if _dht_node is None:
+            node = DHTNode()
+            try:
+                node.start()
+            except OSError:
+                return None
+            _dht_node = node
+        return _dht_node
@@ -0,0 +1,61 @@
+import hashlib
+
+# BEP 52: merkle树的叶子为16KiB block的SHA-256, 节点为两个子节点拼接后的SHA-256
+BLOCK_LEN = 2 ** 14
+HASH_LEN = 32
+# 超出文件末尾的叶子以全0哈希填充
+ZERO_HASH = bytes(HASH_LEN)
+
+
+def get_width(count):
+    """
+    :param count: 叶子数量
+    :return: 不小于count的2的幂, 即补齐后该层的宽度
+    """
+    width = 1
+    while width < count:
+        width *= 2
+    return width
+
+
+def pad_hash(leaves_count):
+    """
+    :param leaves_count: 子树的叶子数量(2的幂)
+    :return: 叶子全为ZERO_HASH的子树的根, 用于补齐piece层
+    """
+    res = ZERO_HASH
+    while leaves_count > 1:
+        res = hashlib.sha256(res + res).digest()
+        leaves_count //= 2
+    return res
+
+
+def merkle_root(hashes, width, pad=ZERO_HASH):
+    """
+    :param hashes: 某一层的哈希值列表
+    :param width: 补齐后该层的宽度(2的幂)
+    :param pad: 补齐使用的哈希值
+    :return: merkle树的根
+    """
+    layer = list(hashes) + [pad] * (width - len(hashes))
+    while len(layer) > 1:
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest()
+                 for i in range(0, len(layer), 2)]
+    return layer[0]
+
+
+def block_hash(block):
+    """
+    :param block: 不超过16KiB的数据
+    :return: 叶子哈希
+    """
+    return hashlib.sha256(block).digest()
+
+
+def block_hashes(data):
+    """
+    :param data: 数据, 最后一个block可以不足16KiB
+    :return: 各block的叶子哈希列表
+    """
+    view = memoryview(data)
+    return [hashlib.sha256(view[i: i + BLOCK_LEN]).digest() for i in range(0, len(data), BLOCK_LEN)]
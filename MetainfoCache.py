@@ -0,0 +1,285 @@
+import json
+import os
+import random
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+from Config import SETTINGS
+from TorrentMetainfo import PieceHashes, TorrentMetainfo
+
+# 表结构变化时递增, 旧版本的缓存会被丢弃重建
+SCHEMA_VERSION = 1
+# 单条SQL中IN子句的参数数量上限, 旧版本SQLite限制为999
+QUERY_CHUNK = 500
+# 每个解析任务包含的文件数量, 减少进程间通信的次数
+PARSE_CHUNK = 64
+
+
+def _to_record(metainfo):
+    """
+    将解析后的metainfo转为缓存中的一行, 常用字段与piece哈希单独成列,
+    其余字段以JSON保存(由C实现解码, 比bencode快得多), 其中的bytes以十六进制表示
+    :param metainfo: TorrentMetainfo对象
+    :return: (info_hash, name, length, piece_length, pieces, data)
+    """
+    fields = {
+        'meta_version': metainfo.meta_version,
+        'is_hybrid': metainfo.is_hybrid,
+        'is_single_file': metainfo.is_single_file,
+        'announce_list': metainfo.announce_list,
+        'announce_tiers': metainfo.announce_tiers,
+        'nodes': metainfo.nodes,
+        'url_list': metainfo.url_list
+    }
+    if metainfo.files is not None:
+        fields['files'] = [[file['length'], file['path'], file['padding']] for file in metainfo.files]
+    if metainfo.info_hash_v2 is not None:
+        fields['info_hash_v2'] = metainfo.info_hash_v2.hex()
+    if metainfo.v2_pieces is not None:
+        fields['v2_pieces'] = [[pieces_root.hex(), first_leaf, piece_hash.hex(), width, data_len]
+                               for pieces_root, first_leaf, piece_hash, width, data_len
+                               in metainfo.v2_pieces]
+        fields['v2_roots'] = {pieces_root.hex(): indexes
+                              for pieces_root, indexes in metainfo.v2_roots.items()}
+    # 纯v2 torrent的pieces由v2_pieces得到, 不重复保存
+    is_pure_v2 = metainfo.meta_version == 2 and not metainfo.is_hybrid
+    pieces = b'' if is_pure_v2 else metainfo.pieces.data
+    return (metainfo.info_hash, metainfo.name, metainfo.length, metainfo.piece_length, pieces,
+            json.dumps(fields, ensure_ascii=False, separators=(',', ':')))
+
+
+def _from_record(info_hash, name, length, piece_length, pieces, data):
+    """
+    由缓存中的一行还原metainfo, 不需要重新解码torrent文件与计算info_hash
+    :return: TorrentMetainfo对象
+    """
+    fields = json.loads(data)
+    metainfo = TorrentMetainfo()
+    metainfo.info_hash = info_hash
+    metainfo.info_hash2str = info_hash.hex()
+    metainfo.name = name
+    metainfo.length = length
+    metainfo.piece_length = piece_length
+    metainfo.meta_version = fields['meta_version']
+    metainfo.is_hybrid = fields['is_hybrid']
+    metainfo.is_single_file = fields['is_single_file']
+    metainfo.announce_list = fields['announce_list']
+    # 与解析时一样, 每次加载都重新打乱各tier内部的顺序
+    metainfo.announce_tiers = fields['announce_tiers']
+    for tier in metainfo.announce_tiers:
+        random.shuffle(tier)
+    metainfo.nodes = [(host, port) for host, port in fields['nodes']]
+    metainfo.url_list = fields['url_list']
+    if 'files' in fields:
+        metainfo.files = [{'length': file_len, 'path': path, 'padding': padding}
+                          for file_len, path, padding in fields['files']]
+    if 'info_hash_v2' in fields:
+        metainfo.info_hash_v2 = bytes.fromhex(fields['info_hash_v2'])
+    if 'v2_pieces' in fields:
+        metainfo.v2_pieces = [(bytes.fromhex(pieces_root), first_leaf, bytes.fromhex(piece_hash),
+                               width, data_len)
+                              for pieces_root, first_leaf, piece_hash, width, data_len
+                              in fields['v2_pieces']]
+        metainfo.v2_roots = {bytes.fromhex(pieces_root): indexes
+                             for pieces_root, indexes in fields['v2_roots'].items()}
+    if metainfo.meta_version == 2 and not metainfo.is_hybrid:
+        metainfo.pieces = [piece[2] for piece in metainfo.v2_pieces]
+    else:
+        metainfo.pieces = PieceHashes(pieces)
+    return metainfo
+
+
+def _parse_entry(path):
+    """
+    在工作进程中解析一个torrent文件
+    :param path: torrent文件的绝对路径
+    :return: (path, (size, mtime_ns) + _to_record(), None), 失败时为(path, None, 错误信息)
+    """
+    try:
+        stat = os.stat(path)
+        metainfo = TorrentMetainfo(path)
+    except Exception as e:
+        return path, None, f'{type(e).__name__}: {e}'
+    return path, (stat.st_size, stat.st_mtime_ns) + _to_record(metainfo), None
+
+
+def collect_torrent_files(directory):
+    """
+    递归查找目录下的torrent文件
+    :param directory: 目录路径
+    :return: 按路径排序的绝对路径列表
+    """
+    paths = []
+    for root, dirs, filenames in os.walk(os.path.abspath(directory)):
+        dirs.sort()
+        paths.extend(os.path.join(root, filename) for filename in sorted(filenames)
+                     if filename.endswith('.torrent'))
+    return paths
+
+
+class MetainfoCache:
+    """
+    以SQLite保存解析后的metainfo, 以文件的路径、大小与修改时间为键:
+    文件未变化时直接读取缓存, 避免每次启动都重新解码大量torrent文件并计算info_hash
+    """
+
+    def __init__(self, db_path=None):
+        """
+        :param db_path: 数据库文件路径, None时使用SETTINGS['metainfo_cache']
+        """
+        self.db_path = SETTINGS['metainfo_cache'] if db_path is None else db_path
+        # Session与RPC线程共用一个连接, 以lock互斥
+        self.lock = Lock()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._init_schema()
+
+    def _init_schema(self):
+        """
+        创建缓存表, 版本不一致时丢弃旧表
+        :return: None
+        """
+        with self.lock, self.conn:
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                self.conn.execute('DROP TABLE IF EXISTS metainfo')
+                self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS metainfo ('
+                              'path TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                              'mtime_ns INTEGER NOT NULL, info_hash BLOB NOT NULL, '
+                              'name TEXT NOT NULL, length INTEGER NOT NULL, '
+                              'piece_length INTEGER NOT NULL, pieces BLOB NOT NULL, '
+                              'data TEXT NOT NULL)')
+
+    def close(self):
+        """
+        :return: None
+        """
+        with self.lock:
+            self.conn.close()
+
+    def _lookup(self, paths):
+        """
+        批量查询缓存, 只返回大小与修改时间均与磁盘上一致的行
+        :param paths: 绝对路径列表
+        :return: ({path: _to_record()形式的行}, 需要重新解析的路径列表)
+        """
+        stats = {}
+        misses = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                misses.append(path)
+                continue
+            stats[path] = (stat.st_size, stat.st_mtime_ns)
+        rows = {}
+        stat_paths = list(stats)
+        with self.lock:
+            for i in range(0, len(stat_paths), QUERY_CHUNK):
+                chunk = stat_paths[i: i + QUERY_CHUNK]
+                rows.update((row[0], row[1:]) for row in self.conn.execute(
+                    'SELECT * FROM metainfo WHERE path IN ({})'.format(','.join('?' * len(chunk))),
+                    chunk))
+        hits = {}
+        for path, stat in stats.items():
+            row = rows.get(path)
+            if row is not None and row[:2] == stat:
+                hits[path] = row[2:]
+            else:
+                misses.append(path)
+        return hits, misses
+
+    def _store(self, entries):
+        """
+        在一个事务中写入新解析的行
+        :param entries: [(path, (size, mtime_ns) + _to_record())]
+        :return: None
+        """
+        if not entries:
+            return
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO metainfo VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                  [(path,) + row for path, row in entries])
+
+    def _index(self, paths, workers=None):
+        """
+        解析不在缓存中或已变化的torrent文件并写入缓存, 文件较多时由进程池并行解析
+        :param paths: 绝对路径列表
+        :param workers: 解析进程数量, None表示CPU核数
+        :return: ({path: 行}, {path: 错误信息}, 重新解析的文件数量)
+        """
+        rows, misses = self._lookup(paths)
+        if len(misses) <= 1 or workers == 1:
+            results = [_parse_entry(path) for path in misses]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_parse_entry, misses, chunksize=PARSE_CHUNK))
+        errors = {path: error for path, _, error in results if error is not None}
+        entries = [(path, row) for path, row, error in results if error is None]
+        self._store(entries)
+        rows.update((path, row[2:]) for path, row in entries)
+        return rows, errors, len(misses)
+
+    def load(self, path):
+        """
+        读取一个torrent文件的metainfo, 未缓存或文件已变化时解析并写入缓存
+        :param path: torrent文件路径
+        :return: TorrentMetainfo对象
+        """
+        path = os.path.abspath(path)
+        hits, _ = self._lookup([path])
+        if path in hits:
+            return _from_record(*hits[path])
+        stat = os.stat(path)
+        metainfo = TorrentMetainfo(path)
+        self._store([(path, (stat.st_size, stat.st_mtime_ns) + _to_record(metainfo))])
+        return metainfo
+
+    def load_many(self, paths, workers=None):
+        """
+        批量读取metainfo: 以少量查询取出全部缓存行, 其余文件并行解析后在一个事务中写入
+        :param paths: torrent文件路径列表
+        :param workers: 解析进程数量, None表示CPU核数
+        :return: ({path: TorrentMetainfo对象}, {path: 错误信息}), 以传入的路径为键
+        """
+        abs_paths = {path: os.path.abspath(path) for path in paths}
+        rows, errors, _ = self._index(list(dict.fromkeys(abs_paths.values())), workers)
+        metainfos = {path: _from_record(*rows[abs_path])
+                     for path, abs_path in abs_paths.items() if abs_path in rows}
+        return metainfos, {path: errors[abs_path]
+                           for path, abs_path in abs_paths.items() if abs_path in errors}
+
+    def scan(self, directory, workers=None):
+        """
+        为目录下的所有torrent文件建立缓存, 并删除该目录下已不存在的文件的缓存
+        :param directory: 目录路径
+        :param workers: 解析进程数量, None表示CPU核数
+        :return: 统计dict: files, parsed, failed({path: 错误信息}), removed
+        """
+        paths = collect_torrent_files(directory)
+        rows, errors, parsed = self._index(paths, workers)
+        prefix = os.path.join(os.path.abspath(directory), '')
+        existing = set(paths)
+        with self.lock, self.conn:
+            # 以范围查询代替LIKE, 避免路径中的%与_被当作通配符
+            stale = [(path,) for path, in self.conn.execute(
+                'SELECT path FROM metainfo WHERE path >= ? AND path < ?',
+                (prefix, prefix[:-1] + chr(ord(os.sep) + 1))) if path not in existing]
+            self.conn.executemany('DELETE FROM metainfo WHERE path = ?', stale)
+        return {'files': len(paths), 'parsed': parsed, 'failed': errors, 'removed': len(stale)}
+
+
+_metainfo_cache = None
+_metainfo_cache_lock = Lock()
+
+
+def get_metainfo_cache():
+    """
+    :return: 进程内共享的MetainfoCache
+    """
+    global _metainfo_cache
+    with _metainfo_cache_lock:
+        if _metainfo_cache is None:
+            _metainfo_cache = MetainfoCache()
+        return _metainfo_cache
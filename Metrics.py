@@ -0,0 +1,361 @@
+import bisect
+import json
+import sys
+import time
+import traceback
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from threading import Thread
+from threading import get_ident
+
+from Config import SETTINGS
+
+# 按方向与类型区分的流量, payload为block数据, protocol为其余的协议开销(握手、消息头等)
+TRAFFIC_KINDS = ('payload_download', 'payload_upload', 'protocol_download', 'protocol_upload')
+
+RTT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+HASH_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+DISK_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+
+class Counter:
+    """
+    无锁计数器: 每个线程只累加自己的单元, 读取时再求和
+    """
+
+    def __init__(self):
+        # {线程id: [累计值]}
+        self._cells = {}
+
+    def inc(self, n=1):
+        cell = self._cells.get(get_ident())
+        if cell is None:
+            cell = self._cells.setdefault(get_ident(), [0])
+        cell[0] += n
+
+    @property
+    def value(self):
+        return sum(cell[0] for cell in list(self._cells.values()))
+
+
+class RateMeter:
+    """
+    滑动窗口速率计: 写入只累加计数器, 由MetricsRegistry的采样线程每秒记录一次累计值,
+    速率为窗口内累计值的增量除以时间差
+    """
+
+    def __init__(self, window=None, parent=None):
+        """
+        :param window: 窗口长度(秒)
+        :param parent: 上一级的速率计(peer -> torrent -> 全局), 写入时一并累加
+        """
+        self.counter = Counter()
+        self.parent = parent
+        window = SETTINGS['metrics_window'] if window is None else window
+        # [(采样时间, 累计值)]
+        self.samples = deque([(time.monotonic(), 0)], maxlen=window + 1)
+
+    def add(self, n):
+        self.counter.inc(n)
+        if self.parent is not None:
+            self.parent.add(n)
+
+    @property
+    def total(self):
+        return self.counter.value
+
+    @property
+    def rate(self):
+        """
+        :return: 窗口内的平均速率(每秒)
+        """
+        samples = list(self.samples)
+        if not samples:
+            return 0.0
+        start_time, start_total = samples[0]
+        elapsed = time.monotonic() - start_time
+        if elapsed <= 0:
+            return 0.0
+        return (self.total - start_total) / elapsed
+
+    def sample(self, now):
+        self.samples.append((now, self.total))
+
+
+class Histogram:
+    """
+    固定分桶的直方图, 与Counter一样按线程分别累加
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # {线程id: [各桶计数..., +Inf计数, 总和]}
+        self._cells = {}
+
+    def observe(self, value):
+        cell = self._cells.get(get_ident())
+        if cell is None:
+            cell = self._cells.setdefault(get_ident(), [0] * (len(self.buckets) + 1) + [0.0])
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def snapshot(self):
+        """
+        :return: (累积的各桶计数, 总和, 总数)的元组, 累积计数与Prometheus的le语义一致
+        """
+        counts = [0] * (len(self.buckets) + 1)
+        total_sum = 0.0
+        for cell in list(self._cells.values()):
+            for i in range(len(counts)):
+                counts[i] += cell[i]
+            total_sum += cell[-1]
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total_sum, running
+
+
+class Gauge:
+    """
+    瞬时值, 可直接设置或在导出时通过回调函数计算
+    """
+
+    def __init__(self, func=None):
+        self.func = func
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        if self.func is not None:
+            return self.func()
+        return self._value
+
+
+class MetricsRegistry:
+    """
+    进程内的指标注册表: 以(名称, 标签)区分指标, 支持导出Prometheus文本格式与JSON快照
+    """
+
+    def __init__(self):
+        # {(name, ((label, value), ...)): metric}
+        self.metrics = {}
+        # {name: (类型, 说明)}
+        self.descriptions = {}
+        self.lock = Lock()
+        self.is_running = False
+        self.server = None
+
+    def _get_or_create(self, kind, name, help_text, labels, factory):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is not None:
+            return metric
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = factory()
+                self.descriptions.setdefault(name, (kind, help_text))
+                self.metrics[key] = metric
+        return metric
+
+    def counter(self, name, help_text, **labels):
+        return self._get_or_create('counter', name, help_text, labels, Counter)
+
+    def meter(self, name, help_text, parent=None, **labels):
+        return self._get_or_create('meter', name, help_text, labels,
+                                   lambda: RateMeter(parent=parent))
+
+    def histogram(self, name, help_text, buckets, **labels):
+        return self._get_or_create('histogram', name, help_text, labels,
+                                   lambda: Histogram(buckets))
+
+    def gauge(self, name, help_text, func=None, **labels):
+        return self._get_or_create('gauge', name, help_text, labels, lambda: Gauge(func))
+
+    def traffic_meters(self, prefix, parents=None, **labels):
+        """
+        创建一组payload/protocol上下行速率计
+        :param prefix: 指标名前缀, 如'bt_torrent_'
+        :param parents: 上一级的traffic_meters结果
+        :param labels: 标签
+        :return: {流量类型: RateMeter}
+        """
+        return {kind: self.meter(f'{prefix}{kind}_bytes', f'{kind.replace("_", " ")} bytes',
+                                 parent=None if parents is None else parents[kind], **labels)
+                for kind in TRAFFIC_KINDS}
+
+    def unregister(self, **labels):
+        """
+        移除标签包含给定标签的所有指标, 用于peer断开或torrent移除时
+        :param labels: 标签
+        :return: None
+        """
+        items = set(labels.items())
+        with self.lock:
+            for key in [key for key in self.metrics if items.issubset(key[1])]:
+                del self.metrics[key]
+
+    def start(self):
+        """
+        启动速率计的采样线程
+        :return: None
+        """
+        if self.is_running:
+            return
+        self.is_running = True
+        Thread(target=self._sample_always, daemon=True).start()
+
+    def _sample_always(self):
+        """
+        采样线程: 每秒记录一次所有速率计的累计值
+        :return: None
+        """
+        while self.is_running:
+            now = time.monotonic()
+            for metric in list(self.metrics.values()):
+                if isinstance(metric, RateMeter):
+                    metric.sample(now)
+            time.sleep(1)
+
+    def _sorted_items(self):
+        with self.lock:
+            items = list(self.metrics.items())
+        return sorted(items, key=lambda item: item[0])
+
+    def to_json(self):
+        """
+        :return: 所有指标的快照dict, 可直接json序列化
+        """
+        res = {}
+        for (name, labels), metric in self._sorted_items():
+            if isinstance(metric, RateMeter):
+                value = {'total': metric.total, 'rate': metric.rate}
+            elif isinstance(metric, Histogram):
+                counts, total_sum, count = metric.snapshot()
+                value = {'buckets': dict(zip([str(b) for b in metric.buckets] + ['+Inf'], counts)),
+                         'sum': total_sum, 'count': count}
+            else:
+                value = metric.value
+            res.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        return res
+
+    def to_prometheus(self):
+        """
+        :return: Prometheus文本格式的所有指标, 速率计导出为<name>_total计数器与<name>_rate仪表
+        """
+        lines = []
+        described = set()
+
+        def describe(name, kind, help_text):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), metric in self._sorted_items():
+            kind, help_text = self.descriptions[name]
+            if isinstance(metric, RateMeter):
+                describe(name + '_total', 'counter', help_text)
+                lines.append(f'{name}_total{_format_labels(labels)} {metric.total}')
+                describe(name + '_rate', 'gauge', help_text + ' per second')
+                lines.append(f'{name}_rate{_format_labels(labels)} {metric.rate:.3f}')
+            elif isinstance(metric, Histogram):
+                describe(name, kind, help_text)
+                counts, total_sum, count = metric.snapshot()
+                for bound, cur_count in zip(list(metric.buckets) + ['+Inf'], counts):
+                    cur_labels = labels + (('le', str(bound)),)
+                    lines.append(f'{name}_bucket{_format_labels(cur_labels)} {cur_count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {total_sum}')
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+            else:
+                describe(name, kind, help_text)
+                lines.append(f'{name}{_format_labels(labels)} {metric.value}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=None, host=None):
+        """
+        在后台线程中提供/metrics(Prometheus文本)与/metrics.json(JSON快照)
+        :param port: 端口号, 默认为SETTINGS['metrics_port']
+        :param host: 监听地址, 默认为SETTINGS['metrics_host']
+        :return: None
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = registry.to_prometheus().encode()
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body = json.dumps(registry.to_json()).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(
+            (SETTINGS['metrics_host'] if host is None else host,
+             SETTINGS['metrics_port'] if port is None else port), MetricsHandler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.is_running = False
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def _format_labels(labels):
+    """
+    :param labels: ((label, value), ...)
+    :return: Prometheus格式的标签字符串
+    """
+    if not labels:
+        return ''
+    escaped = []
+    for label, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{label}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+_metrics = None
+_metrics_lock = Lock()
+
+
+def get_metrics():
+    """
+    :return: 进程内共享并已启动采样线程的MetricsRegistry
+    """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = MetricsRegistry()
+            _metrics.start()
+        return _metrics
+
+
+def serve_metrics():
+    """
+    启动指标的HTTP导出接口, 端口不可用时打印异常并继续运行
+    :return: None
+    """
+    try:
+        get_metrics().serve()
+    except OSError:
+        traceback.print_exc(file=sys.stdout)
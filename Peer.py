@@ -1,25 +1,117 @@
+import itertools
 import socket
 import struct
+import time
+from threading import Lock
 
+import Bencode
+import Tracing
 from Config import SETTINGS
+from Metrics import RTT_BUCKETS, get_metrics
+from PeerTrace import record_socket
+from Scheduler import get_scheduler
 from TorrentWriter import TorrentWriter
+from TrackerAPI import peer_key, split_compact_peers
 
 
 class Peer:
-    def __init__(self, ip, port, torrent):
+    # BEP 10: 握手reserved字段第6个字节(从0计为5)的0x10位表示支持扩展协议
+    ext_reserved_idx = 5
+    ext_reserved_bit = 0x10
+    # BEP 5: reserved字段最后一个字节的0x01位表示支持DHT
+    dht_reserved_idx = 7
+    dht_reserved_bit = 0x01
+    # BEP 6: reserved字段最后一个字节的0x04位表示支持Fast Extension
+    fast_reserved_idx = 7
+    fast_reserved_bit = 0x04
+    # BEP 52: reserved字段最后一个字节的0x10位表示支持v2协议(hash request/hashes消息)
+    v2_reserved_idx = 7
+    v2_reserved_bit = 0x10
+    # 本端为各扩展消息分配的编号
+    local_ext_ids = {b'ut_pex': 1}
+    client_version = b'MY 2282'
+
+    def __init__(self, ip, port, torrent, sock=None, buffer=b''):
+        """
+        :param ip: peer的ip地址
+        :param port: peer的端口号
+        :param torrent: 所属的torrent
+        :param sock: 传入连接已accept的套接字, 为None时主动连接peer
+        :param buffer: 传入连接中已读取的数据(包含对端的握手信息)
+        """
         self.ip = ip
         self.port = port
+        # compact格式的packed bytes键, 用于在torrent中去重
+        self.key = peer_key(ip, port)
         self.torrent = torrent
-        self.sock = socket.socket()
+        # 是否为对端主动发起的传入连接
+        self.is_incoming = sock is not None
+        self.sock = socket.socket() if sock is None else sock
+        # 开启抓包时记录该连接收发的全部数据, 用于离线重放
+        if SETTINGS['peer_trace_dir']:
+            self.sock = record_socket(self.sock, SETTINGS['peer_trace_dir'],
+                                      torrent.metainfo.info_hash, ip, port, buffer)
         self.processed_block = None
         self.is_available = True
         self.peer_choking = True
         self.peer_interested = False
         self.im_choking = True
         self.im_interested = False
-        self.buffer = b''
+        self.buffer = buffer
         self.available_pieces_map = None
         self.is_running = False
+        # BEP 10扩展协议状态
+        self.supports_extensions = False
+        # 对端是否支持BEP 52的hash request
+        self.supports_v2 = False
+        # BEP 6 Fast Extension状态: 对端是否支持, 是否拥有全部piece,
+        # 被choke时也允许请求的piece, 以及对端拒绝过的piece
+        self.supports_fast = False
+        self.has_all = False
+        # 对端是否在握手中设置了DHT标志位(BEP 5)
+        self.supports_dht = False
+        self.allowed_fast = set()
+        self.rejected_pieces = set()
+        # 对端拥有而本端仍需要的piece数量, 由bitfield、have与本端完成的piece增量更新,
+        # 大于0时对其感兴趣
+        self.wanted_count = 0
+        self.interest_lock = Lock()
+        # 对端为各扩展消息分配的编号, 如{b'ut_pex': 2}
+        self.remote_ext_ids = {}
+        # 对端的监听地址(packed bytes键): 主动连接时即为连接的地址,
+        # 传入连接的源端口是临时端口, 须由扩展握手中的p得知, 未知时为None
+        self.listen_key = None if self.is_incoming else self.key
+        # ut_pex: 上次发送给对端的peer集合(packed bytes键)与发送时间
+        self.pex_sent_peers = set()
+        self.pex_last_sent = 0
+        # 该peer的流量速率计(逐级累加到torrent与全局)与请求往返时间
+        metrics = get_metrics()
+        self.traffic = metrics.traffic_meters('bt_peer_', parents=torrent.traffic,
+                                              torrent=torrent.metrics_label, peer=self.name)
+        self.rtt = metrics.histogram('bt_request_rtt_seconds', 'block request round trip time',
+                                     RTT_BUCKETS)
+        self.request_timeouts = metrics.counter('bt_request_timeouts_total',
+                                                'block requests that timed out and were reassigned')
+        self.request_time = None
+        # 由RTT样本平滑得到的往返时间与偏差(RFC 6298), 以及当前的请求超时时间
+        self.srtt = None
+        self.rttvar = None
+        self.rto = SETTINGS['initial_request_timeout']
+        # 连续超时的请求数量, 收到block后清零
+        self.timeouts = 0
+        # 定时线程与peer线程都会修改processed_block, 以该锁互斥
+        self.request_lock = Lock()
+        self.request_timer = None
+        # 已超时并交还、但对端仍可能迟到回复的请求及其超时时间
+        self.late_request = None
+        self.late_since = None
+        # keep-alive与空闲检测: 上次发送、接收数据以及任一方感兴趣的时间
+        self.send_lock = Lock()
+        self.last_sent = self.last_received = self.last_interest = time.monotonic()
+        # 其他线程(定时任务、其他peer的线程)要发送的消息, 由该peer的线程发出,
+        # 调用线程不会阻塞在对端的套接字上
+        self.outbox = []
+        self.outbox_lock = Lock()
 
         self._init_connection()
 
@@ -30,36 +122,69 @@ class Peer:
         2. 传递握手信息
         3. 处理握手信息的回复
         4. 发送interested信息
+        传入连接跳过第1步, 且先处理对端的握手信息再回复握手
         :return: None
         """
         try:
             # 开始执行TCP连接, 包含timeout信息
             self.sock.settimeout(SETTINGS['timeout_for_peer'])
-            self.sock.connect((self.ip, self.port))
-            # 发送握手信息
-            self._send_handshake(self.torrent.metainfo.info_hash)
-            # 处理来自peer的握手信息回复
-            self._handle_handshake()
-            # 发送interested信息
-            self._send_msg(msg_id=2)
-            # 检查回复
-            self._check_buffer()
+            if self.is_incoming:
+                # 处理对端的握手信息并回复握手
+                with Tracing.span('handshake', 'peer', peer=self.name, incoming=True):
+                    self._handle_handshake()
+                    self._send_handshake(self.torrent.metainfo.info_hash)
+            else:
+                with Tracing.span('connect', 'peer', peer=self.name):
+                    self.sock.connect((self.ip, self.port))
+                with Tracing.span('handshake', 'peer', peer=self.name, incoming=False):
+                    # 发送握手信息
+                    self._send_handshake(self.torrent.metainfo.info_hash)
+                    # 处理来自peer的握手信息回复
+                    self._handle_handshake()
+            # 告知本端已完成的piece
+            self._send_bitfield()
+            # 双方都支持BEP 10时发送扩展握手
+            if self.supports_extensions:
+                self._send_ext_handshake()
+            # 双方都支持DHT时告知本端DHT节点的端口
+            self._send_dht_port()
+            # 检查回复, 收到bitfield或have后再决定是否发送interested
+            with Tracing.span('first_message', 'peer', peer=self.name):
+                self._check_buffer()
+            get_scheduler().call_later(SETTINGS['peer_tick_interval'], self._on_tick)
         except Exception:
             # 如果发生错误就关闭连接, 并标记该peer
             self.is_available = False
             self.sock.close()
+            self._unregister_metrics()
+
+    def _unregister_metrics(self):
+        """
+        移除该peer的速率计
+        :return: None
+        """
+        get_metrics().unregister(torrent=self.torrent.metrics_label, peer=self.name)
 
     def _check_buffer(self):
         """
         更新并处理缓存
         :return: None
         """
-        self._update_buffer()
+        # 握手后缓冲区中可能已有完整的消息(如bitfield或have_all), 先处理它们, 避免阻塞在recv上
+        if not self._has_complete_msg():
+            self._update_buffer()
         self._handle_buffer()
         # 循环检查缓存
         if self.buffer_length != 0:
             self._check_buffer()
 
+    def _has_complete_msg(self):
+        """
+        :return: 缓冲区中是否至少有一条完整的消息
+        """
+        return (self.buffer_length >= 4 and
+                4 + struct.unpack('!L', self.buffer[:4])[0] <= self.buffer_length)
+
     def _handle_buffer(self):
         """
         处理缓冲区数据，若存在足够数据则进行解析
@@ -75,6 +200,12 @@ class Peer:
             offset = 4
             if prefix_len + offset > self.buffer_length:
                 return
+            # piece消息中的block为payload, 其余字节均计为协议开销
+            payload_len = 0
+            if prefix_len > 9 and self.buffer[offset] == 7:
+                payload_len = prefix_len - 9
+            self.traffic['payload_download'].add(payload_len)
+            self.traffic['protocol_download'].add(offset + prefix_len - payload_len)
             if prefix_len == 0:
                 pass
             else:
@@ -90,6 +221,24 @@ class Peer:
         :param args: 关键字参数
         :return: None
         """
+        self._set_msg_state(msg_id)
+        self._send_data(self.build_msg(msg_id, **args))
+
+    def _queue_msg(self, msg_id, **args):
+        """
+        在其他线程中发送消息: 立即更新choke和interested属性, 消息放入发送队列由该peer的线程发出
+        :param msg_id: 信息类型
+        :param args: 关键字参数
+        :return: None
+        """
+        self._set_msg_state(msg_id)
+        self._queue_data(self.build_msg(msg_id, **args))
+
+    def _set_msg_state(self, msg_id):
+        """
+        :param msg_id: 将要发送的信息类型
+        :return: None
+        """
         if msg_id == 0:  # choke
             self.im_choking = True
         elif msg_id == 1:  # unchoke
@@ -98,8 +247,155 @@ class Peer:
             self.im_interested = True
         elif msg_id == 3:  # not_interested
             self.im_interested = False
-        msg = self.build_msg(msg_id, **args)
-        self.sock.send(msg)
+
+    def _send_data(self, data, payload_len=0):
+        """
+        在peer线程中发送已编码的消息, 先发出其他线程排队的消息以保持消息顺序
+        :param data: 一条或多条消息拼接的字节
+        :param payload_len: 其中piece消息的block字节数
+        :return: None
+        """
+        with self.send_lock:
+            with self.outbox_lock:
+                queued = self.outbox
+                self.outbox = []
+            if queued:
+                queued.append(data)
+                self.sock.sendall(b''.join(queued))
+            elif data:
+                self.sock.sendall(data)
+            self.last_sent = time.monotonic()
+        self.traffic['payload_upload'].add(payload_len)
+        self.traffic['protocol_upload'].add(len(data) - payload_len)
+
+    def _queue_data(self, data):
+        """
+        在其他线程中发送已编码的消息(不含piece消息): 放入发送队列, 由peer线程在下一次读取前发出
+        :param data: 一条或多条消息拼接的字节
+        :return: None
+        """
+        with self.outbox_lock:
+            self.outbox.append(data)
+        self.traffic['protocol_upload'].add(len(data))
+
+    def _flush_outbox(self):
+        """
+        在peer线程中发出其他线程排队的消息, 空闲超过keepalive_interval时发送keep-alive
+        :return: None
+        """
+        if self.outbox:
+            self._send_data(b'')
+        elif time.monotonic() - self.last_sent >= SETTINGS['keepalive_interval']:
+            self._send_msg(msg_id=-1)
+
+    def unchoke(self):
+        """
+        在其他线程中为该peer分配上传名额后unchoke对端
+        :return: None
+        """
+        try:
+            self._send_msg(msg_id=1)
+        except OSError:
+            pass
+
+    def _handle_request(self, piece_idx, offset, block_len):
+        """
+        回复对端的block请求: 已unchoke且该piece可读时发送piece消息,
+        否则支持Fast Extension时回复reject_request, 使对端不必等待超时
+        :param piece_idx: piece索引
+        :param offset: block在piece中的偏移
+        :param block_len: block长度
+        :return: None
+        """
+        block = None
+        if not self.im_choking and block_len <= SETTINGS['int_block_len']:
+            block = self.torrent.read_block(piece_idx, offset, block_len)
+        if block is None:
+            if self.supports_fast:
+                self._send_msg(msg_id=16, piece_idx=piece_idx, offset=offset, block_len=block_len)
+            return
+        self._send_data(self.build_msg(7, piece_idx=piece_idx, offset=offset, block=block),
+                        payload_len=len(block))
+        self.torrent.uploaded += len(block)
+
+    def _send_bitfield(self):
+        """
+        握手后告知本端已完成的piece: 没有时支持Fast Extension则发送have_none,
+        全部完成时发送have_all, 否则发送bitfield
+        :return: None
+        """
+        pieces_count = len(self.torrent.metainfo.pieces)
+        completed = [not self.torrent.is_piece_needed(i) for i in range(pieces_count)]
+        if not any(completed):
+            if self.supports_fast:
+                self._send_msg(msg_id=15)
+        elif all(completed) and self.supports_fast:
+            self._send_msg(msg_id=14)
+        else:
+            bitfield = bytearray((pieces_count + 7) // 8)
+            for i, is_completed in enumerate(completed):
+                if is_completed:
+                    bitfield[i // 8] |= 0x80 >> (i % 8)
+            self._send_msg(msg_id=5, bitfield=bytes(bitfield))
+
+    def send_haves(self, pieces):
+        """
+        将多条have消息合并为一条, 跳过对端已拥有的piece, 放入发送队列由peer线程发出
+        :param pieces: 本端新完成的piece索引列表
+        :return: None
+        """
+        if not self.is_available:
+            return
+        data = b''.join(self.build_msg(4, piece_idx=piece_idx) for piece_idx in pieces
+                        if not self._peer_has(piece_idx))
+        if data:
+            self._queue_data(data)
+
+    def _peer_has(self, piece_idx):
+        """
+        :param piece_idx: piece索引
+        :return: 对端是否已告知拥有该piece, 未收到bitfield/have/have_all时视为没有
+        """
+        if self.has_all:
+            return True
+        return self.available_pieces_map is not None and self.available_pieces_map[piece_idx]
+
+    def _recount_wanted(self):
+        """
+        重新计算对端拥有而本端仍需要的piece数量, 并更新感兴趣状态
+        :return: None
+        """
+        pieces_count = len(self.torrent.metainfo.pieces)
+        if self.has_all:
+            pieces = range(pieces_count)
+        else:
+            pieces = itertools.compress(range(pieces_count), self.available_pieces_map or ())
+        with self.interest_lock:
+            self.wanted_count = sum(1 for i in pieces if self.torrent.is_piece_needed(i))
+            self._update_interest()
+
+    def _update_interest(self, is_queued=False):
+        """
+        感兴趣状态变化时发送interested或not_interested(需在interest_lock内调用)
+        :param is_queued: 在其他线程中调用时为True, 消息交给peer线程发出
+        :return: None
+        """
+        is_interested = self.wanted_count > 0
+        if is_interested != self.im_interested:
+            send_msg = self._queue_msg if is_queued else self._send_msg
+            send_msg(msg_id=2 if is_interested else 3)
+
+    def handle_piece_completed(self, piece_idx):
+        """
+        本端完成一个piece后, 若对端也拥有它则不再因该piece对其感兴趣
+        :param piece_idx: piece索引
+        :return: None
+        """
+        if not self._peer_has(piece_idx):
+            return
+        with self.interest_lock:
+            self.wanted_count = max(self.wanted_count - 1, 0)
+            self._update_interest(is_queued=True)
 
     def _handle_handshake(self):
         """
@@ -108,7 +404,8 @@ class Peer:
         """
         # 握手信息格式: <pstrlen><pstr><reserved><info_hash><peer_id>
         # 握手信息长度: 49(fixed) + pstrlen(variable)
-        self._update_buffer()
+        if not self.buffer:
+            self._update_buffer()
         pstrlen = self.buffer[0]  # 第一个字节为pstrlen
         # 循环读取知道收到完整的握手信息
         while self.buffer_length < 49 + pstrlen:
@@ -120,8 +417,16 @@ class Peer:
         # 如果pstr与协议名不匹配, 则忽略掉此次握手信息
         if pstr != SETTINGS['protocol_name']:
             raise UnexpectedProtocolType(pstr.decode())
+        # 解析reserved字段中的扩展协议标志位
+        reserved = handshake_data[pstrlen: pstrlen + 8]
+        self.supports_extensions = bool(
+            reserved[self.ext_reserved_idx] & self.ext_reserved_bit)
+        self.supports_v2 = bool(reserved[self.v2_reserved_idx] & self.v2_reserved_bit)
+        self.supports_fast = bool(reserved[self.fast_reserved_idx] & self.fast_reserved_bit)
+        self.supports_dht = bool(reserved[self.dht_reserved_idx] & self.dht_reserved_bit)
         # 将握手以外的数据保留在缓冲区中
         self.buffer = self.buffer[49 + pstrlen:]
+        self.traffic['protocol_download'].add(49 + pstrlen)
 
     def get_data_from_socket(self):
         """
@@ -138,15 +443,31 @@ class Peer:
         data = self.get_data_from_socket()
         if not data:
             raise Exception('Received empty data!')
+        self.last_received = time.monotonic()
         self.buffer += data
 
+    def _receive(self, timeout):
+        """
+        在timeout内读取并处理对端消息, 超时不视为连接失效, 由定时任务判断是否断开
+        :param timeout: 等待秒数
+        :return: None
+        """
+        self._flush_outbox()
+        self.sock.settimeout(timeout)
+        try:
+            self._check_buffer()
+        except socket.timeout:
+            pass
+
     def _send_handshake(self, info_hash):
         """
         使用给定的info_hash构建并发送握手消息
         :param info_hash: info的哈希值
         :return: None
         """
-        self.sock.send(self.build_handshake(info_hash))
+        handshake = self.build_handshake(info_hash, v2=self.torrent.metainfo.meta_version == 2)
+        self.sock.send(handshake)
+        self.traffic['protocol_upload'].add(len(handshake))
 
     @property
     def buffer_length(self):
@@ -171,59 +492,191 @@ class Peer:
         self.is_running = True
         # 若peer可用则进行下载
         while self.is_available:
-            # 获取piece索引以及对应的block索引
-            piece_idx, block_idx = self.torrent.get_pbi_for_peer(self)
-            # 若piece索引丢失则关闭该连接
-            if piece_idx is None:
-                self._close()
-                break
-            # 若block索引丢失则跳进下次循环
-            if block_idx is None:
-                continue
             try:
+                # 对端没有本端需要的piece时等待其have消息, 下载完成后对端也不感兴趣时断开;
+                # 双方均不感兴趣的连接由定时任务在peer_idle_timeout后断开
+                if not self.im_interested:
+                    if self.torrent.progress == 1 and not self.peer_interested:
+                        self._close()
+                        break
+                    self._receive(SETTINGS['peer_tick_interval'])
+                    continue
+                # 被choke时只能下载allowed_fast中的piece, 没有时等待unchoke, 不占用任何block
+                if self.peer_choking:
+                    piece_idx = block_idx = None
+                    if self.allowed_fast:
+                        piece_idx, block_idx = self.torrent.get_pbi_for_peer(self, self.allowed_fast)
+                    if block_idx is None:
+                        self._wait_unchoke()
+                        continue
+                else:
+                    # 获取piece索引以及对应的block索引
+                    piece_idx, block_idx = self.torrent.get_pbi_for_peer(self)
+                # 对端拥有的piece均不再需要时, 重新计算以修正其他线程完成piece造成的偏差
+                if piece_idx is None:
+                    self._recount_wanted()
+                    if self.im_interested:
+                        self._receive(SETTINGS['peer_wait_interval'])
+                    continue
+                # 该peer拥有的piece均已被其他peer领取, 处理对端消息并等待超时交还的block
+                if block_idx is None:
+                    self._receive(SETTINGS['peer_wait_interval'])
+                    continue
                 # 请求下载该block
                 self.request_block(piece_idx, block_idx)
+                # 定期与对端交换已连接的peer
+                self._send_pex_if_needed()
             except Exception:
                 # 若peer没有可供下载的pieces, 则标记该peer并关闭连接
                 peer_is_bad = False
-                if self.available_pieces_map is None:
+                if self.available_pieces_map is None and not self.has_all:
                     peer_is_bad = True
                 self._close(peer_is_bad)
 
+    def _wait_unchoke(self):
+        """
+        等待对端unchoke, 连接是否失效由定时任务判断
+        :return: None
+        """
+        with Tracing.span('wait_unchoke', 'peer', peer=self.name):
+            while self.peer_choking and self.im_interested and self.is_available:
+                self._receive(SETTINGS['peer_tick_interval'])
+
     def request_block(self, piece_idx, block_idx):
         """
-        给定piece索引与block索引, 下载对应block
+        给定piece索引与block索引, 下载对应block; 超过rto未收到时由定时任务交还该block
         :param piece_idx: piece索引
         :param block_idx: block索引
         :return: None
         """
-        # 标记该请求的block
-        self.processed_block = (piece_idx, block_idx)
-        # 如果peer处于choke状态
-        if self.peer_choking:
-            # 发送interested消息
-            self._send_msg(msg_id=2)
-            # 检查peer消息回应
-            self._check_buffer()
-            # 如果仍不回应则关闭此次连接
-            if self.peer_choking:
-                self._close()
-                return
+        offset, block_len = self._get_block_range(piece_idx, block_idx)
+        # v2下向对端请求该piece的叶子哈希, 收到后每个block可单独校验
+        if self.supports_v2:
+            self._request_hashes_if_needed(piece_idx)
+        request = (piece_idx, block_idx)
+        # 通过指定piece索引, block长度, offset
+        with Tracing.span('request', 'peer', peer=self.name, piece=piece_idx, block=block_idx):
+            with self.request_lock:
+                # 标记该请求的block
+                self.processed_block = request
+                self.request_time = time.monotonic()
+                self.request_timer = get_scheduler().call_later(
+                    self.rto, self._on_request_timeout, request)
+            self._send_msg(msg_id=6,
+                           piece_idx=piece_idx, block_len=block_len, offset=offset)
+            # 等待该block到达或被拒绝; 超时后block已交给其他peer, 仍等待迟到的回复再发出新请求,
+            # 避免停滞的peer反复领取同一个block
+            while self.is_available and (self.processed_block is request or
+                                         self.late_request is request):
+                self._receive(SETTINGS['peer_tick_interval'])
+        self.request_timer.cancel()
+
+    def _get_block_range(self, piece_idx, block_idx):
+        """
+        :param piece_idx: piece索引
+        :param block_idx: block索引
+        :return: (block在piece中的偏移, block长度)
+        """
         # 获取该block所在piece的长度
         piece_len = self.torrent.metainfo.get_piece_len_at(piece_idx)
         # 计算block长度的offset
         offset = block_idx * SETTINGS['int_block_len']
         # 进而计算剩余block的长度
-        block_len = min(piece_len - offset, SETTINGS['int_block_len'])
-        # 通过指定piece索引, block长度, offset
-        self._send_msg(msg_id=6,
-                       piece_idx=piece_idx, block_len=block_len, offset=offset)
-        # 检查peer消息回复
-        self._check_buffer()
-        # 处理不正确的block信息
-        if self.processed_block is not None:
-            self.torrent.handle_incorrect_pbi(*self.processed_block)
+        return offset, min(piece_len - offset, SETTINGS['int_block_len'])
+
+    def _on_request_timeout(self, request):
+        """
+        定时任务: 请求超时后向对端发送cancel, 将block交还给piece选择算法由其他peer重新请求,
+        并按指数退避增大rto
+        :param request: 超时的(piece_idx, block_idx)
+        :return: None
+        """
+        with self.request_lock:
+            if self.processed_block is not request:
+                return
+            self.processed_block = None
+            # 支持Fast Extension的对端在cancel后仍会回复piece或reject, 继续等待迟到的回复;
+            # 其他对端可能不再回复, 不再等待
+            if self.supports_fast:
+                self.late_request = request
+                self.late_since = time.monotonic()
+            # Karn算法: 超时请求的往返时间不作为RTT样本
+            self.request_time = None
+            self.timeouts += 1
+            self.rto = min(self.rto * 2, SETTINGS['max_request_timeout'])
+        self.request_timeouts.inc()
+        Tracing.instant('request_timeout', 'peer', peer=self.name, piece=request[0],
+                        block=request[1])
+        offset, block_len = self._get_block_range(*request)
+        self._queue_msg(msg_id=8, piece_idx=request[0], offset=offset, block_len=block_len)
+        self.torrent.handle_incorrect_pbi(*request)
+
+    def _release_request(self):
+        """
+        将已发出但不会再收到的请求交还给piece选择算法
+        :return: None
+        """
+        with self.request_lock:
+            request = self.processed_block
             self.processed_block = None
+            self.request_time = None
+            self.late_request = None
+        if request is not None:
+            self.torrent.handle_incorrect_pbi(*request)
+
+    def _update_rto(self, rtt):
+        """
+        RFC 6298: 由新的RTT样本更新平滑往返时间、偏差与请求超时时间
+        :param rtt: 往返时间样本(秒)
+        :return: None
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, SETTINGS['min_request_timeout']),
+                       SETTINGS['max_request_timeout'])
+        self.timeouts = 0
+
+    def _on_tick(self):
+        """
+        定时任务: 断开长时间无数据、双方均不感兴趣或持续超时的peer,
+        只关闭套接字而不发送数据, keep-alive由peer线程在_receive()中发送
+        :return: None
+        """
+        if not self.is_available:
+            return
+        cur_time = time.monotonic()
+        if self.im_interested or self.peer_interested:
+            self.last_interest = cur_time
+        late_request_expired = (self.late_request is not None and
+                                cur_time - self.late_since > SETTINGS['max_request_timeout'])
+        if (cur_time - self.last_received > SETTINGS['peer_inactivity_timeout'] or
+                cur_time - self.last_interest > SETTINGS['peer_idle_timeout'] or
+                self.timeouts >= SETTINGS['max_request_timeouts'] or late_request_expired):
+            # 关闭读写后peer线程中阻塞的recv返回空数据, 由peer线程完成断开
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return
+        get_scheduler().call_later(SETTINGS['peer_tick_interval'], self._on_tick)
+
+    def _request_hashes_if_needed(self, piece_idx):
+        """
+        若该piece的叶子哈希尚未请求过, 则发送hash request, 回复由_decode_msg()异步处理
+        :param piece_idx: piece索引
+        :return: None
+        """
+        hash_request = self.torrent.get_hash_request(piece_idx)
+        if hash_request is None:
+            return
+        pieces_root, index, length = hash_request
+        # 已知piece层哈希, 不需要proof
+        self._send_msg(msg_id=21, pieces_root=pieces_root, base_layer=0, index=index,
+                       length=length, proof_layers=0)
 
     def have_piece(self, piece_idx):
         """
@@ -231,9 +684,10 @@ class Peer:
         :param piece_idx: piece索引
         :return: 若存在则返回True
         """
-        if self.available_pieces_map is not None:
-            return self.available_pieces_map[piece_idx]
-        return True
+        # 对端拒绝过的piece不再向其请求
+        if piece_idx in self.rejected_pieces:
+            return False
+        return self._peer_has(piece_idx)
 
     def _decode_msg(self, msg):
         """
@@ -246,22 +700,43 @@ class Peer:
         # choke
         if msg_id == 0:
             self.peer_choking = True
+            Tracing.instant('choke', 'peer', peer=self.name)
+            # 不支持Fast Extension时对端会丢弃choke前收到的请求, 立即交还而不必等待超时
+            if not self.supports_fast:
+                self._release_request()
         # unchoke
         elif msg_id == 1:
             self.peer_choking = False
-        # interested
+            # 拒绝可能与unchoke交错到达, 重新unchoke后允许再次请求被拒绝过的piece
+            self.rejected_pieces.clear()
+            Tracing.instant('unchoke', 'peer', peer=self.name)
+        # interested, 有空闲的上传名额时unchoke对端
         elif msg_id == 2:
             self.peer_interested = True
-        # not_interested
+            if self.im_choking and self.torrent.request_unchoke(self):
+                self._send_msg(msg_id=1)
+        # not_interested, 交还上传名额
         elif msg_id == 3:
             self.peer_interested = False
+            if not self.im_choking:
+                self._send_msg(msg_id=0)
+                self.torrent.release_unchoke(self)
         # 消息格式: <len=0005><id=4><piece index>
         elif msg_id == 4:
             # 获取消息对应的piece索引
             idx = struct.unpack('!L', msg[1:5])[0]
+            pieces_count = len(self.torrent.metainfo.pieces)
+            if idx >= pieces_count or self._peer_has(idx):
+                return
+            # 没有发送bitfield的peer从没有任何piece开始记录
+            if self.available_pieces_map is None:
+                self.available_pieces_map = [False] * pieces_count
             # 标记该piece可用
-            if self.available_pieces_map is not None:
-                self.available_pieces_map[idx] = True
+            self.available_pieces_map[idx] = True
+            if self.torrent.is_piece_needed(idx):
+                with self.interest_lock:
+                    self.wanted_count += 1
+                    self._update_interest()
         # bitfield格式: <len=0001+X><id=5><bitfield>
         elif msg_id == 5:
             # 从helper方法获取bitfield
@@ -270,9 +745,10 @@ class Peer:
             pieces_count = len(self.torrent.metainfo.pieces)
             # 根据bitfield更新piece_map
             self.available_pieces_map = cur_map[:pieces_count]
-        # 请求消息
+            self._recount_wanted()
+        # 请求消息格式: <len=0013><id=6><index><begin><length>
         elif msg_id == 6:
-            pass
+            self._handle_request(*struct.unpack('!LLL', msg[1:13]))
         # piece格式: <len=0009+X><id=7><index><begin><block>
         elif msg_id == 7:
             # 获取索引
@@ -281,20 +757,176 @@ class Peer:
             offset = struct.unpack('!L', msg[5:9])[0]
             # 获取block
             block = msg[9:]
+            block_idx = offset // SETTINGS['int_block_len']
+            # 记录请求的往返时间, 并据此更新请求超时时间
+            with self.request_lock:
+                if self.request_time is not None and self.processed_block == (piece_idx, block_idx):
+                    rtt = time.monotonic() - self.request_time
+                    self.rtt.observe(rtt)
+                    self._update_rto(rtt)
+                    self.request_time = None
             # 处理该block
-            self.torrent.handle_block(
-                piece_idx, offset // SETTINGS['int_block_len'], block)
-            # 处理结束后清楚该block
-            self.processed_block = None
-        # 退出该消息
+            self.torrent.handle_block(piece_idx, block_idx, block, self)
+            # 处理结束后清除该block; 迟到的旧block不能清除当前请求的标记, 否则当前请求的block会丢失
+            with self.request_lock:
+                if self.processed_block == (piece_idx, block_idx):
+                    self.processed_block = None
+                if self.late_request == (piece_idx, block_idx):
+                    self.late_request = None
+        # cancel格式: <len=0013><id=8><index><begin><length>, 本端收到请求后立即回复, 没有可取消的请求
         elif msg_id == 8:
             pass
-        # 端口消息
+        # 端口消息格式: <len=0003><id=9><listen-port>
         elif msg_id == 9:
+            self.torrent.handle_dht_port(self.ip, struct.unpack('!H', msg[1:3])[0])
+        # BEP 10扩展消息格式: <len=0002+X><id=20><extended message id><payload>
+        elif msg_id == 20:
+            self._decode_ext_msg(msg[1], msg[2:])
+        # BEP 52 hash request格式: <len=0049><id=21><pieces root><base layer><index><length><proof layers>
+        elif msg_id == 21:
+            # 本端不提供哈希, 回复hash reject
+            pieces_root = msg[1:33]
+            base_layer, index, length, proof_layers = struct.unpack('!LLLL', msg[33:49])
+            self._send_msg(msg_id=23, pieces_root=pieces_root, base_layer=base_layer,
+                           index=index, length=length, proof_layers=proof_layers)
+        # hashes格式: <len=0049+X><id=22><pieces root><base layer><index><length><proof layers><hashes>
+        elif msg_id == 22:
+            base_layer, index, length, _ = struct.unpack('!LLLL', msg[33:49])
+            hashes = [msg[i: i + 32] for i in range(49, 49 + length * 32, 32)]
+            self.torrent.handle_hashes(msg[1:33], base_layer, index, hashes)
+        # BEP 6 suggest_piece格式: <len=0005><id=13><piece index>, 仅为建议, 忽略
+        elif msg_id == 13:
             pass
+        # have_all格式: <len=0001><id=14>, 无需展开bitfield
+        elif msg_id == 14:
+            self.has_all = True
+            self._recount_wanted()
+        # have_none格式: <len=0001><id=15>
+        elif msg_id == 15:
+            self.has_all = False
+            self.available_pieces_map = [False] * len(self.torrent.metainfo.pieces)
+            self._recount_wanted()
+        # reject_request格式: <len=0013><id=16><index><begin><length>
+        elif msg_id == 16:
+            piece_idx, offset = struct.unpack('!LL', msg[1:9])
+            block_idx = offset // SETTINGS['int_block_len']
+            # 被拒绝的block立即交还给piece选择算法
+            if self.processed_block == (piece_idx, block_idx):
+                self._release_request()
+            elif self.late_request == (piece_idx, block_idx):
+                self.late_request = None
+            # 未被choke时拒绝说明对端暂时不提供该piece
+            if not self.peer_choking:
+                self.rejected_pieces.add(piece_idx)
+            self.allowed_fast.discard(piece_idx)
+        # allowed_fast格式: <len=0005><id=17><piece index>
+        elif msg_id == 17:
+            piece_idx = struct.unpack('!L', msg[1:5])[0]
+            if piece_idx < len(self.torrent.metainfo.pieces):
+                self.allowed_fast.add(piece_idx)
+        # hash reject格式与hash request相同
+        elif msg_id == 23:
+            self.torrent.handle_hash_reject(msg[1:33], struct.unpack('!L', msg[37:41])[0])
         else:
             raise UnknownMessageType('msg_id = {}'.format(msg_id))
 
+    def _decode_ext_msg(self, ext_id, payload):
+        """
+        解码BEP 10扩展消息
+        :param ext_id: 扩展消息编号, 0为扩展握手
+        :param payload: bencode编码的消息内容
+        :return: None
+        """
+        if ext_id == 0:
+            self._handle_ext_handshake(Bencode.decode(payload))
+        elif ext_id == self.local_ext_ids[b'ut_pex']:
+            self._handle_pex(Bencode.decode(payload))
+
+    def _handle_ext_handshake(self, handshake):
+        """
+        处理对端的扩展握手, 记录其支持的扩展消息编号
+        :param handshake: 解码后的扩展握手字典
+        :return: None
+        """
+        for name, ext_id in handshake.get(b'm', {}).items():
+            # 编号为0表示对端关闭了该扩展
+            if ext_id == 0:
+                self.remote_ext_ids.pop(name, None)
+            else:
+                self.remote_ext_ids[name] = ext_id
+        port = handshake.get(b'p')
+        if self.is_incoming and isinstance(port, int) and 0 < port < 65536:
+            self.listen_key = peer_key(self.ip, port)
+
+    def _handle_pex(self, pex):
+        """
+        处理ut_pex消息, 将新增的peer交给torrent的连接池
+        :param pex: 解码后的ut_pex字典
+        :return: None
+        """
+        added = (split_compact_peers(pex.get(b'added', b'')) +
+                 split_compact_peers(pex.get(b'added6', b''), ipv6=True))
+        dropped = (split_compact_peers(pex.get(b'dropped', b'')) +
+                   split_compact_peers(pex.get(b'dropped6', b''), ipv6=True))
+        self.torrent.handle_pex_peers(added, dropped)
+
+    def _send_dht_port(self):
+        """
+        双方都在握手中设置了DHT标志位且本端DHT节点正在运行时发送PORT消息
+        :return: None
+        """
+        if not self.supports_dht or not SETTINGS['dht_enabled']:
+            return
+        port = self.torrent.get_dht_port()
+        if port is not None:
+            self._send_msg(msg_id=9, port=port)
+
+    def _send_ext_handshake(self):
+        """
+        发送BEP 10扩展握手
+        :return: None
+        """
+        handshake = {
+            b'm': self.local_ext_ids,
+            b'p': int(SETTINGS['port']),
+            b'v': self.client_version
+        }
+        self._send_msg(msg_id=20, ext_id=0, payload=Bencode.encode(handshake))
+
+    def _send_pex_if_needed(self):
+        """
+        若对端支持ut_pex且距上次发送已超过pex_interval, 则发送新增与断开的peer
+        :return: None
+        """
+        if b'ut_pex' not in self.remote_ext_ids:
+            return
+        cur_time = time.monotonic()
+        if cur_time - self.pex_last_sent < SETTINGS['pex_interval']:
+            return
+        self.pex_last_sent = cur_time
+        cur_peers = self.torrent.get_pex_peers(exclude=self)
+        # BEP 11: 每条消息最多包含50个新增peer与50个断开peer
+        added = list(cur_peers.keys() - self.pex_sent_peers)[:50]
+        dropped = list(self.pex_sent_peers - cur_peers.keys())[:50]
+        if not added and not dropped:
+            return
+        self.pex_sent_peers.difference_update(dropped)
+        self.pex_sent_peers.update(added)
+        # bencode要求字典的键按字节序排列
+        pex = {b'added': b'', b'added.f': b'', b'added6': b'',
+               b'added6.f': b'', b'dropped': b'', b'dropped6': b''}
+        # peer的键即为compact格式, 按长度区分IPv4与IPv6
+        for key in added:
+            field = b'added' if len(key) == 6 else b'added6'
+            pex[field] += key
+            # 0x10: 该peer可接受传入连接, 仅对本端主动连接成功的peer设置
+            pex[field + b'.f'] += b'\x10' if cur_peers[key] else b'\x00'
+        for key in dropped:
+            field = b'dropped' if len(key) == 6 else b'dropped6'
+            pex[field] += key
+        self._send_msg(msg_id=20, ext_id=self.remote_ext_ids[b'ut_pex'],
+                       payload=Bencode.encode(pex))
+
     def _close(self, peer_is_bad=False):
         """
         关闭该peer的TCP连接
@@ -302,8 +934,9 @@ class Peer:
         :return: None
         """
         # 处理不正确的block
-        if self.processed_block is not None:
-            self.torrent.handle_incorrect_pbi(*self.processed_block)
+        self._release_request()
+        if self.request_timer is not None:
+            self.request_timer.cancel()
         # 处理peer退出连接事件
         self.torrent.handle_peer_disconnect(self, peer_is_bad=peer_is_bad)
         # 标记该peer不可用
@@ -312,6 +945,7 @@ class Peer:
         self.is_running = False
         # 关闭TCP连接
         self.sock.close()
+        self._unregister_metrics()
 
     @staticmethod
     def build_msg(msg_id, **args):
@@ -321,23 +955,43 @@ class Peer:
         :param args: 0或关键字信息
         :return: 字节编码消息
         """
-        # choke, unchoke, interested, not_interested的信息长度为1, 且payload为空
-        if msg_id in {0, 1, 2, 3}:
+        # choke, unchoke, interested, not_interested, have_all, have_none的信息长度为1, 且payload为空
+        if msg_id in {0, 1, 2, 3, 14, 15}:
             msg_len = b'\x00\x00\x00\x01'
             payload = b''
         # id为4时的payload格式: <len=0005><id=4><piece index>
         elif msg_id == 4:
             msg_len = b'\x00\x00\x00\x05'
             payload = struct.pack('!L', args['piece_idx'])
-        # id为6时的payload格式: <len=0013><id=6><index><begin><length>
-        elif msg_id == 6:
+        # id为6(request)、8(cancel)与16(reject_request)时的payload格式:
+        # <len=0013><id><index><begin><length>
+        elif msg_id in {6, 8, 16}:
             msg_len = b'\x00\x00\x00\x0d'
             payload = (struct.pack('!L', args['piece_idx']) +
                        struct.pack('!L', args['offset']) +
                        struct.pack('!L', args['block_len']))
-        # bitfield, piece, cancel, port类型
-        elif msg_id in {5, 7, 8, 9}:
-            raise NotImplementedError()
+        # bitfield格式: <len=0001+X><id=5><bitfield>
+        elif msg_id == 5:
+            msg_len = struct.pack('!L', 1 + len(args['bitfield']))
+            payload = args['bitfield']
+        # piece格式: <len=0009+X><id=7><index><begin><block>
+        elif msg_id == 7:
+            msg_len = struct.pack('!L', 9 + len(args['block']))
+            payload = struct.pack('!LL', args['piece_idx'], args['offset']) + args['block']
+        # port格式: <len=0003><id=9><listen-port>
+        elif msg_id == 9:
+            msg_len = b'\x00\x00\x00\x03'
+            payload = struct.pack('!H', args['port'])
+        # hash request与hash reject的payload格式:
+        # <len=0049><id=21或23><pieces root><base layer><index><length><proof layers>
+        elif msg_id in {21, 23}:
+            msg_len = struct.pack('!L', 49)
+            payload = args['pieces_root'] + struct.pack(
+                '!LLLL', args['base_layer'], args['index'], args['length'], args['proof_layers'])
+        # 扩展消息的payload格式: <len=0002+X><id=20><extended message id><payload>
+        elif msg_id == 20:
+            payload = struct.pack('!B', args['ext_id']) + args['payload']
+            msg_len = struct.pack('!L', 1 + len(payload))
         # 空消息类型
         elif msg_id == -1:
             return b'\x00\x00\x00\x00'
@@ -347,22 +1001,32 @@ class Peer:
         return msg_len + msg_id_bytes + payload
 
     @staticmethod
-    def build_handshake(info_hash):
+    def build_handshake(info_hash, v2=False):
         """
         从metainfo中创建并返回握手信息
         :param info_hash: info哈希值
+        :param v2: 是否为v2或hybrid torrent
         :return: 字节编码类型的握手信息
         """
         """
         握手信息格式: <pstrlen><pstr><reserved><info_hash><peer_id>
         pstrlen: <pstr>类型的长度 (0x13)
         pstr: 协议名称(字符串类型'BitTorrent protocol')
-        reserved: 全0的8字节
+        reserved: 8字节, 其中第6个字节的0x10位表示支持BEP 10扩展协议,
+                  最后一个字节的0x01位表示支持DHT, 0x04位表示支持Fast Extension,
+                  0x10位表示支持v2协议
         info_hash: 20字节的SHA1哈希值
         peer_id: 20字节
         """
+        reserved = bytearray(8)
+        reserved[Peer.ext_reserved_idx] |= Peer.ext_reserved_bit
+        if SETTINGS['dht_enabled']:
+            reserved[Peer.dht_reserved_idx] |= Peer.dht_reserved_bit
+        reserved[Peer.fast_reserved_idx] |= Peer.fast_reserved_bit
+        if v2:
+            reserved[Peer.v2_reserved_idx] |= Peer.v2_reserved_bit
         return (b'\x13' + SETTINGS['protocol_name'] +
-                b'\x00' * 8 + info_hash + SETTINGS['peer_id'])
+                bytes(reserved) + info_hash + SETTINGS['peer_id'])
 
 
 class UnexpectedProtocolType(Exception):
@@ -0,0 +1,161 @@
+import socket
+import sys
+import traceback
+from threading import BoundedSemaphore
+from threading import Lock
+from threading import Thread
+
+from Config import SETTINGS
+
+
+class PeerListener:
+    """
+    在SETTINGS['port']上接受传入的peer连接:
+    读取对端握手信息, 根据info_hash找到对应的torrent, 再交给与主动连接相同的Peer处理
+    """
+
+    def __init__(self, port=None, host='0.0.0.0'):
+        self.host = host
+        self.port = int(SETTINGS['port']) if port is None else port
+        self.sock = None
+        self.is_running = False
+        # {info_hash: torrent}
+        self.torrents = {}
+        self.torrents_lock = Lock()
+        # 限制同时进行中的握手数量
+        self.pending_handshakes = BoundedSemaphore(SETTINGS['max_pending_handshakes'])
+        # 当前的传入连接数量
+        self.incoming_count = 0
+        self.incoming_lock = Lock()
+
+    def register(self, torrent):
+        """
+        注册torrent, 使其可接受传入连接
+        :param torrent: torrent对象
+        :return: None
+        """
+        with self.torrents_lock:
+            self.torrents[torrent.metainfo.info_hash] = torrent
+
+    def unregister(self, torrent):
+        """
+        注销torrent
+        :param torrent: torrent对象
+        :return: None
+        """
+        with self.torrents_lock:
+            self.torrents.pop(torrent.metainfo.info_hash, None)
+
+    def start(self):
+        """
+        绑定监听端口并启动accept线程
+        :return: None
+        """
+        if self.is_running:
+            return
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(SETTINGS['max_pending_handshakes'])
+        self.port = self.sock.getsockname()[1]
+        self.is_running = True
+        Thread(target=self._accept_always, daemon=True).start()
+
+    def stop(self):
+        """
+        关闭监听套接字
+        :return: None
+        """
+        self.is_running = False
+        if self.sock is not None:
+            self.sock.close()
+
+    def _accept_always(self):
+        """
+        accept线程: 超过握手或传入连接上限时直接关闭新连接
+        :return: None
+        """
+        while self.is_running:
+            try:
+                sock, addr = self.sock.accept()
+            except OSError:
+                return
+            if self.incoming_count >= SETTINGS['max_incoming_peers']:
+                sock.close()
+                continue
+            if not self.pending_handshakes.acquire(blocking=False):
+                sock.close()
+                continue
+            Thread(target=self._handle_incoming, args=(sock, addr), daemon=True).start()
+
+    def _handle_incoming(self, sock, addr):
+        """
+        读取对端握手信息并将连接交给对应的torrent, 之后在本线程中运行该peer
+        :param sock: 已accept的套接字
+        :param addr: 对端地址
+        :return: None
+        """
+        try:
+            buffer = self._read_handshake(sock)
+            torrent = None
+            if buffer is not None:
+                pstrlen = buffer[0]
+                info_hash = buffer[1 + pstrlen + 8: 1 + pstrlen + 28]
+                with self.torrents_lock:
+                    torrent = self.torrents.get(info_hash)
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            buffer = torrent = None
+        finally:
+            self.pending_handshakes.release()
+        if torrent is None:
+            sock.close()
+            return
+        with self.incoming_lock:
+            self.incoming_count += 1
+        try:
+            torrent.add_incoming_peer(sock, addr[0], addr[1], buffer)
+        finally:
+            with self.incoming_lock:
+                self.incoming_count -= 1
+
+    @staticmethod
+    def _read_handshake(sock):
+        """
+        读取完整的握手信息
+        握手信息格式: <pstrlen><pstr><reserved><info_hash><peer_id>
+        :param sock: 已accept的套接字
+        :return: 已读取的全部数据, 协议不匹配或连接关闭时返回None
+        """
+        sock.settimeout(SETTINGS['timeout_for_peer'])
+        buffer = b''
+        # 仅需读到info_hash即可判断所属torrent, peer_id由Peer继续读取
+        while not buffer or len(buffer) < 1 + buffer[0] + 28:
+            data = sock.recv(SETTINGS['max_ans_size'])
+            if not data:
+                return None
+            buffer += data
+        if buffer[1: 1 + buffer[0]] != SETTINGS['protocol_name']:
+            return None
+        return buffer
+
+
+_peer_listener = None
+_peer_listener_lock = Lock()
+
+
+def get_peer_listener():
+    """
+    :return: 进程内共享并已启动的PeerListener, 端口不可用时返回None
+    """
+    global _peer_listener
+    with _peer_listener_lock:
+        if _peer_listener is None:
+            listener = PeerListener()
+            try:
+                listener.start()
+            except OSError:
+                traceback.print_exc(file=sys.stdout)
+                return None
+            _peer_listener = listener
+        return _peer_listener
@@ -0,0 +1,232 @@
+import atexit
+import os
+import struct
+import time
+from itertools import count
+from threading import Lock
+from weakref import WeakSet
+
+# 文件格式:
+# 文件头: <magic 'BTPT'><version:1B><info_hash:20B><ip长度:1B><ip><port:2B>
+# 记录:   <方向:1B><距上一条记录的微秒数:4B><数据长度:4B><数据>
+# 记录的是每次recv/send的原始数据, 保留了TCP分段的边界与时间间隔
+MAGIC = b'BTPT'
+VERSION = 1
+INBOUND = 0
+OUTBOUND = 1
+_RECORD_HEADER = struct.Struct('!BII')
+# 同一毫秒内对同一peer重连时区分文件名
+_trace_seq = count()
+# 未关闭的TraceWriter, 进程退出时写出缓冲中的记录
+_open_writers = WeakSet()
+
+
+class TraceWriter:
+    """
+    将一个peer连接的收发数据写入trace文件
+    """
+
+    def __init__(self, path, info_hash, ip, port):
+        self.file = open(path, 'wb')
+        self.lock = Lock()
+        self.prev_time = time.monotonic()
+        ip_bytes = ip.encode()
+        self.file.write(MAGIC + struct.pack('!B', VERSION) + info_hash +
+                        struct.pack('!B', len(ip_bytes)) + ip_bytes + struct.pack('!H', port))
+        # 先写出文件头, 即使连接未正常关闭也是合法的trace文件
+        self.file.flush()
+        _open_writers.add(self)
+
+    def write(self, direction, data):
+        """
+        :param direction: INBOUND或OUTBOUND
+        :param data: 收到或发送的数据
+        :return: None
+        """
+        with self.lock:
+            if self.file.closed:
+                return
+            cur_time = time.monotonic()
+            delta = min(int((cur_time - self.prev_time) * 1e6), 0xFFFFFFFF)
+            self.prev_time = cur_time
+            self.file.write(_RECORD_HEADER.pack(direction, delta, len(data)))
+            self.file.write(data)
+
+    def flush(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+@atexit.register
+def _flush_open_writers():
+    for writer in list(_open_writers):
+        writer.flush()
+
+
+class RecordingSocket:
+    """
+    包装真实套接字, 记录所有收发数据, 其余属性直接转发给真实套接字
+    """
+
+    def __init__(self, sock, writer):
+        self._sock = sock
+        self._writer = writer
+
+    def recv(self, bufsize):
+        data = self._sock.recv(bufsize)
+        self._writer.write(INBOUND, data)
+        return data
+
+    def send(self, data):
+        sent = self._sock.send(data)
+        self._writer.write(OUTBOUND, data[:sent])
+        return sent
+
+    def sendall(self, data):
+        self._sock.sendall(data)
+        self._writer.write(OUTBOUND, data)
+
+    def shutdown(self, how):
+        # Torrent.stop()只shutdown套接字, 此时写出缓冲中的记录, 避免trace末尾缺失
+        self._writer.flush()
+        self._sock.shutdown(how)
+
+    def close(self):
+        self._sock.close()
+        self._writer.close()
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+def get_trace_path(trace_dir, info_hash, ip, port):
+    """
+    :return: <info_hash>-<ip>_<port>-<毫秒时间戳>-<序号>.bpt形式的trace文件路径
+    """
+    os.makedirs(trace_dir, exist_ok=True)
+    name = '{}-{}_{}-{}-{}.bpt'.format(info_hash.hex(), ip.replace(':', '.'), port,
+                                       int(time.time() * 1000), next(_trace_seq))
+    return os.path.join(trace_dir, name)
+
+
+def record_socket(sock, trace_dir, info_hash, ip, port, buffer=b''):
+    """
+    :param sock: 真实套接字
+    :param trace_dir: trace文件目录
+    :param info_hash: torrent的info_hash
+    :param ip: peer的ip地址
+    :param port: peer的端口号
+    :param buffer: 传入连接中已读取的数据, 作为第一条收到的记录
+    :return: 记录收发数据的RecordingSocket
+    """
+    writer = TraceWriter(get_trace_path(trace_dir, info_hash, ip, port), info_hash, ip, port)
+    if buffer:
+        writer.write(INBOUND, buffer)
+    return RecordingSocket(sock, writer)
+
+
+class PeerTrace:
+    """
+    读取trace文件
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:4] != MAGIC or data[4] != VERSION:
+            raise InvalidTraceFile(path)
+        self.info_hash = data[5:25]
+        ip_len = data[25]
+        self.ip = data[26: 26 + ip_len].decode()
+        self.port = struct.unpack('!H', data[26 + ip_len: 28 + ip_len])[0]
+        # [(方向, 距开始的秒数, 数据)]
+        self.records = []
+        offset = 28 + ip_len
+        cur_time = 0.0
+        view = memoryview(data)
+        # 进程被强制结束时最后一条记录可能不完整, 忽略该记录
+        while offset + _RECORD_HEADER.size <= len(data):
+            direction, delta, data_len = _RECORD_HEADER.unpack_from(data, offset)
+            if offset + _RECORD_HEADER.size + data_len > len(data):
+                break
+            offset += _RECORD_HEADER.size
+            cur_time += delta / 1e6
+            self.records.append((direction, cur_time, bytes(view[offset: offset + data_len])))
+            offset += data_len
+
+    @property
+    def inbound(self):
+        """
+        :return: 收到的全部数据
+        """
+        return b''.join(data for direction, _, data in self.records if direction == INBOUND)
+
+
+class ReplaySocket:
+    """
+    按trace中的顺序返回收到的数据, 发送的数据直接丢弃;
+    realtime为True时按原始时间间隔返回数据, 否则尽快返回
+    """
+
+    def __init__(self, trace, realtime=False):
+        self.inbound = [(cur_time, data) for direction, cur_time, data in trace.records
+                        if direction == INBOUND and data]
+        self.realtime = realtime
+        self.idx = 0
+        self.start_time = None
+        self.sent_bytes = 0
+        self.recv_bytes = 0
+        self.is_closed = False
+
+    def recv(self, bufsize):
+        if self.is_closed or self.idx >= len(self.inbound):
+            # trace结束视为对端关闭连接
+            return b''
+        cur_time, data = self.inbound[self.idx]
+        if self.realtime:
+            if self.start_time is None:
+                self.start_time = time.monotonic() - cur_time
+            delay = self.start_time + cur_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        # 调用方的缓冲区较小时分多次返回
+        if len(data) > bufsize:
+            self.inbound[self.idx] = (cur_time, data[bufsize:])
+            data = data[:bufsize]
+        else:
+            self.idx += 1
+        self.recv_bytes += len(data)
+        return data
+
+    def send(self, data):
+        if self.is_closed:
+            raise OSError('Socket is closed')
+        self.sent_bytes += len(data)
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def connect(self, address):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def shutdown(self, how):
+        self.is_closed = True
+
+    def close(self):
+        self.is_closed = True
+
+    def fileno(self):
+        return -1
+
+
+class InvalidTraceFile(Exception):
+    pass
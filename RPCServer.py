@@ -0,0 +1,255 @@
+import json
+import os
+import socket
+import sys
+import traceback
+from threading import Event
+from threading import Thread
+
+from Config import SETTINGS
+from Metrics import get_metrics
+
+
+class RPCError(Exception):
+    """
+    JSON-RPC错误, code遵循JSON-RPC 2.0的错误码
+    """
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+# JSON-RPC 2.0错误码
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+
+def get_rpc_address():
+    """
+    支持unix socket时使用SETTINGS['rpc_socket'], 否则使用本机的TCP端口
+    :return: (地址族, 地址)的元组
+    """
+    if hasattr(socket, 'AF_UNIX') and SETTINGS['rpc_socket']:
+        return socket.AF_UNIX, os.path.abspath(SETTINGS['rpc_socket'])
+    return socket.AF_INET, (SETTINGS['rpc_host'], SETTINGS['rpc_port'])
+
+
+class RPCServer:
+    """
+    守护进程的本地控制接口:
+    在unix socket或127.0.0.1上接受按行分隔的JSON-RPC 2.0请求, 用于添加、暂停、恢复、移除与查询torrent
+    """
+
+    def __init__(self, session, address=None):
+        self.session = session
+        self.family, self.address = get_rpc_address() if address is None else address
+        self.sock = None
+        self.is_running = False
+        self.shutdown_event = Event()
+        self.methods = {
+            'add': self.rpc_add,
+            'pause': self.rpc_pause,
+            'resume': self.rpc_resume,
+            'remove': self.rpc_remove,
+            'list': self.rpc_list,
+            'stats': self.rpc_stats,
+            'metrics': self.rpc_metrics,
+            'shutdown': self.rpc_shutdown
+        }
+
+    def start(self):
+        """
+        绑定控制接口并启动accept线程
+        :return: None
+        """
+        if self.is_running:
+            return
+        if self.family == socket.AF_UNIX:
+            self._remove_stale_socket()
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family != socket.AF_UNIX:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        if self.family == socket.AF_UNIX:
+            # 仅允许当前用户控制守护进程
+            os.chmod(self.address, 0o600)
+        self.sock.listen(5)
+        self.is_running = True
+        Thread(target=self._accept_always, daemon=True).start()
+
+    def stop(self):
+        """
+        关闭控制接口
+        :return: None
+        """
+        self.is_running = False
+        self.shutdown_event.set()
+        if self.sock is not None:
+            self.sock.close()
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def serve_forever(self):
+        """
+        阻塞直到收到shutdown请求
+        :return: None
+        """
+        self.shutdown_event.wait()
+
+    def _remove_stale_socket(self):
+        """
+        删除上次未正常退出时遗留的socket文件, 若已有守护进程在运行则报错
+        :return: None
+        """
+        if not os.path.exists(self.address):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.address)
+        except OSError:
+            os.remove(self.address)
+        else:
+            raise RuntimeError(f'Exception: daemon is already running on "{self.address}".')
+        finally:
+            probe.close()
+
+    def _accept_always(self):
+        """
+        accept线程: 每个控制连接由单独的线程处理
+        :return: None
+        """
+        while self.is_running:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                return
+            Thread(target=self._handle_conn, args=(sock,), daemon=True).start()
+
+    def _handle_conn(self, sock):
+        """
+        逐行读取请求并返回响应, 直至对端关闭连接
+        :param sock: 已accept的套接字
+        :return: None
+        """
+        with sock, sock.makefile('rb') as reader:
+            for line in reader:
+                if not line.strip():
+                    continue
+                response = self.handle_request(line)
+                if response is None:
+                    continue
+                try:
+                    sock.sendall(json.dumps(response).encode() + b'\n')
+                except OSError:
+                    return
+
+    def handle_request(self, data):
+        """
+        处理一条JSON-RPC请求
+        :param data: 请求数据(字节类型)
+        :return: 响应dict, 通知(无id)时返回None
+        """
+        try:
+            request = json.loads(data)
+        except ValueError:
+            return self._error_response(None, PARSE_ERROR, 'Parse error')
+        if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+            return self._error_response(None, INVALID_REQUEST, 'Invalid Request')
+        req_id = request.get('id')
+        params = request.get('params', {})
+        method = self.methods.get(request['method'])
+        try:
+            if method is None:
+                raise RPCError(METHOD_NOT_FOUND, f'Method not found: {request["method"]}')
+            if isinstance(params, list):
+                result = method(*params)
+            elif isinstance(params, dict):
+                result = method(**params)
+            else:
+                raise RPCError(INVALID_PARAMS, 'Invalid params')
+        except RPCError as e:
+            return self._error_response(req_id, e.code, e.message)
+        except TypeError as e:
+            return self._error_response(req_id, INVALID_PARAMS, str(e))
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            return self._error_response(req_id, SERVER_ERROR, str(e))
+        if 'id' not in request:
+            return None
+        return {'jsonrpc': '2.0', 'id': req_id, 'result': result}
+
+    @staticmethod
+    def _error_response(req_id, code, message):
+        return {'jsonrpc': '2.0', 'id': req_id, 'error': {'code': code, 'message': message}}
+
+    def _get_info_hash(self, info_hash):
+        """
+        :param info_hash: 十六进制的info_hash
+        :return: 字节类型的info_hash
+        """
+        try:
+            res = bytes.fromhex(info_hash)
+        except (TypeError, ValueError):
+            raise RPCError(INVALID_PARAMS, f'Invalid info_hash: {info_hash}')
+        if res not in self.session.torrents:
+            raise RPCError(INVALID_PARAMS, f'Unknown torrent: {info_hash}')
+        return res
+
+    def rpc_add(self, path):
+        if not os.path.isfile(path):
+            raise RPCError(INVALID_PARAMS, f'File not found: {path}')
+        torrent = self.session.add(path)
+        return self.session.get_stats(torrent.metainfo.info_hash)
+
+    def rpc_pause(self, info_hash):
+        return self.session.pause(self._get_info_hash(info_hash))
+
+    def rpc_resume(self, info_hash):
+        return self.session.resume(self._get_info_hash(info_hash))
+
+    def rpc_remove(self, info_hash):
+        self.session.remove(self._get_info_hash(info_hash))
+        return True
+
+    def rpc_list(self):
+        return [self.session.get_stats(info_hash) for info_hash in list(self.session.torrents)]
+
+    def rpc_stats(self, info_hash):
+        return self.session.get_stats(self._get_info_hash(info_hash))
+
+    def rpc_metrics(self):
+        return get_metrics().to_json()
+
+    def rpc_shutdown(self):
+        # 先返回响应, 再由serve_forever的调用方停止session
+        self.shutdown_event.set()
+        return True
+
+
+def call(method, params=None, address=None):
+    """
+    向守护进程发送一条JSON-RPC请求
+    :param method: 方法名
+    :param params: 参数list或dict
+    :param address: (地址族, 地址)的元组, 默认由get_rpc_address()得到
+    :return: 请求的结果
+    """
+    family, addr = get_rpc_address() if address is None else address
+    request = {'jsonrpc': '2.0', 'id': 1, 'method': method, 'params': params or []}
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(SETTINGS['rpc_timeout'])
+        sock.connect(addr)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile('rb') as reader:
+            line = reader.readline()
+    if not line:
+        raise RPCError(SERVER_ERROR, 'Connection closed by daemon')
+    response = json.loads(line)
+    if 'error' in response:
+        raise RPCError(response['error']['code'], response['error']['message'])
+    return response['result']
@@ -0,0 +1,151 @@
+import heapq
+import itertools
+import sys
+import time
+import traceback
+from threading import Condition
+from threading import Lock
+from threading import Thread
+
+
+class ScheduledCall:
+    """
+    Scheduler.call_later()返回的定时任务, 可在到期前取消
+    """
+    __slots__ = ('deadline', 'func', 'args', 'is_cancelled', 'is_scheduled', 'scheduler')
+
+    def __init__(self, deadline, func, args, scheduler):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.is_cancelled = False
+        # 是否仍在scheduler的堆中
+        self.is_scheduled = True
+        self.scheduler = scheduler
+
+    def cancel(self):
+        """
+        取消该任务, 已执行的任务取消无效果
+        :return: None
+        """
+        self.scheduler._cancel(self)
+
+
+class Scheduler:
+    """
+    进程内共享的定时器: 以最小堆按到期时间排列任务, 由一个线程依次执行,
+    避免为每个peer的keep-alive与请求超时各创建一个threading.Timer线程.
+    任务在定时线程中执行, 不应长时间阻塞
+    """
+
+    # 堆中已取消的任务超过该数量且超过一半时重建堆
+    purge_threshold = 64
+
+    def __init__(self):
+        # [(到期时间, 序号, ScheduledCall)], 序号保证到期时间相同时按加入顺序执行
+        self.heap = []
+        # 堆中已取消、尚未到期的任务数量
+        self.cancelled_count = 0
+        self.counter = itertools.count()
+        self.condition = Condition(Lock())
+        self.is_running = False
+
+    def start(self):
+        """
+        启动定时线程
+        :return: None
+        """
+        if self.is_running:
+            return
+        self.is_running = True
+        Thread(target=self._run_always, daemon=True).start()
+
+    def stop(self):
+        """
+        停止定时线程, 未到期的任务不再执行
+        :return: None
+        """
+        with self.condition:
+            self.is_running = False
+            self.condition.notify()
+
+    def call_later(self, delay, func, *args):
+        """
+        :param delay: 延迟秒数
+        :param func: 到期时调用的函数
+        :param args: 调用参数
+        :return: ScheduledCall对象
+        """
+        call = ScheduledCall(time.monotonic() + delay, func, args, self)
+        with self.condition:
+            heapq.heappush(self.heap, (call.deadline, next(self.counter), call))
+            # 新任务早于原先最早的任务时唤醒定时线程重新计算等待时间
+            if self.heap[0][2] is call:
+                self.condition.notify()
+        return call
+
+    def _cancel(self, call):
+        """
+        标记任务已取消; 每个block请求都会取消上一个超时任务, 已取消的任务过多时
+        从堆中移除它们, 避免堆中积累大量到期前不会被弹出的任务
+        :param call: ScheduledCall对象
+        :return: None
+        """
+        with self.condition:
+            if call.is_cancelled:
+                return
+            call.is_cancelled = True
+            if not call.is_scheduled:
+                return
+            self.cancelled_count += 1
+            if (self.cancelled_count > self.purge_threshold and
+                    self.cancelled_count * 2 > len(self.heap)):
+                self.heap = [entry for entry in self.heap if not entry[2].is_cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled_count = 0
+                # 最早的任务可能已被移除, 唤醒定时线程重新计算等待时间
+                self.condition.notify()
+
+    def _run_always(self):
+        """
+        定时线程: 等待最早的任务到期并执行
+        :return: None
+        """
+        while True:
+            with self.condition:
+                while self.is_running:
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    timeout = self.heap[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                if not self.is_running:
+                    return
+                call = heapq.heappop(self.heap)[2]
+                call.is_scheduled = False
+                if call.is_cancelled:
+                    self.cancelled_count -= 1
+            if call.is_cancelled:
+                continue
+            try:
+                call.func(*call.args)
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+
+
+_scheduler = None
+_scheduler_lock = Lock()
+
+
+def get_scheduler():
+    """
+    :return: 进程内共享并已启动的Scheduler
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+            _scheduler.start()
+        return _scheduler
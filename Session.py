@@ -0,0 +1,258 @@
+from threading import Lock
+from threading import Thread
+
+from Config import SETTINGS
+from DHT import get_dht_node
+from MetainfoCache import get_metainfo_cache
+from Metrics import get_metrics
+from PeerListener import get_peer_listener
+from Torrent import Torrent
+from TorrentWriter import DiskWriter, get_read_cache
+
+
+class Session:
+    """
+    在同一进程中管理多个Torrent:
+    共享监听端口、DHT节点与磁盘写入线程, 按全局连接上限为各torrent公平分配连接数,
+    并限制同时下载的torrent数量, 其余torrent排队等待
+    """
+
+    def __init__(self, max_active_torrents=None, max_connections=None):
+        self.max_active_torrents = (SETTINGS['max_active_torrents'] if max_active_torrents is None
+                                    else max_active_torrents)
+        self.max_connections = (SETTINGS['max_connections'] if max_connections is None
+                                else max_connections)
+        # {info_hash: torrent}, 按加入顺序排列
+        self.torrents = {}
+        # 等待下载的info_hash队列
+        self.queued = []
+        # 正在下载的info_hash
+        self.active = set()
+        # 被暂停的info_hash
+        self.paused = set()
+        self.lock = Lock()
+        self.disk_writer = DiskWriter()
+        self.listener = None
+        self.dht = None
+        self.is_running = False
+
+    def start(self):
+        """
+        启动共享的磁盘写入线程、监听端口与DHT, 并开始下载队列中的torrent
+        :return: None
+        """
+        self.disk_writer.start()
+        self.listener = get_peer_listener()
+        if SETTINGS['dht_enabled']:
+            self.dht = get_dht_node()
+        self.is_running = True
+        self._schedule()
+
+    def stop(self):
+        """
+        停止所有torrent(包括已完成、正在做种的torrent)并等待已校验的piece写入磁盘
+        :return: None
+        """
+        self.is_running = False
+        with self.lock:
+            # 排队中的torrent尚未启动, 已暂停的torrent已经停止, 其余的都需要
+            # 向tracker发送stopped并断开peer
+            torrents = [torrent for info_hash, torrent in self.torrents.items()
+                        if info_hash not in self.queued and info_hash not in self.paused]
+            self.active.clear()
+        for torrent in torrents:
+            torrent.stop()
+        self.disk_writer.flush()
+        if self.dht is not None:
+            self.dht.save_state()
+
+    def add(self, path):
+        """
+        加入一个torrent文件并排队下载
+        :param path: torrent文件路径
+        :return: torrent对象, 已存在时返回已有的torrent
+        """
+        torrent = self._add_metainfo(get_metainfo_cache().load(path))
+        self._schedule()
+        return torrent
+
+    def add_many(self, paths):
+        """
+        批量加入torrent文件, metainfo由缓存批量读取, 未缓存的文件并行解析
+        :param paths: torrent文件路径列表
+        :return: {path: 解析失败的错误信息}
+        """
+        metainfos, errors = get_metainfo_cache().load_many(paths)
+        for path in paths:
+            if path in metainfos:
+                self._add_metainfo(metainfos[path])
+        self._schedule()
+        return errors
+
+    def _add_metainfo(self, metainfo):
+        """
+        :param metainfo: TorrentMetainfo对象
+        :return: torrent对象, 已存在时返回已有的torrent
+        """
+        with self.lock:
+            if metainfo.info_hash in self.torrents:
+                return self.torrents[metainfo.info_hash]
+            torrent = Torrent(metainfo, session=self)
+            self.torrents[metainfo.info_hash] = torrent
+            if torrent.progress < 1:
+                self.queued.append(metainfo.info_hash)
+        return torrent
+
+    def remove(self, info_hash):
+        """
+        停止并移除一个torrent
+        :param info_hash: torrent的info_hash
+        :return: 被移除的torrent, 不存在时返回None
+        """
+        with self.lock:
+            torrent = self.torrents.pop(info_hash, None)
+            if torrent is None:
+                return None
+            if info_hash in self.queued:
+                self.queued.remove(info_hash)
+            self.paused.discard(info_hash)
+            is_active = info_hash in self.active
+            self.active.discard(info_hash)
+        if is_active:
+            torrent.stop()
+        get_read_cache().discard(torrent.writer)
+        get_metrics().unregister(torrent=torrent.metrics_label)
+        self._schedule()
+        return torrent
+
+    def pause(self, info_hash):
+        """
+        暂停一个正在下载或排队中的torrent, 让出下载名额
+        :param info_hash: torrent的info_hash
+        :return: bool类型, 是否暂停成功
+        """
+        with self.lock:
+            torrent = self.torrents.get(info_hash)
+            if torrent is None or info_hash in self.paused or torrent.progress == 1:
+                return False
+            if info_hash in self.queued:
+                self.queued.remove(info_hash)
+            is_active = info_hash in self.active
+            self.active.discard(info_hash)
+            self.paused.add(info_hash)
+        if is_active:
+            torrent.stop()
+        self._schedule()
+        return True
+
+    def resume(self, info_hash):
+        """
+        将被暂停的torrent重新加入下载队列
+        :param info_hash: torrent的info_hash
+        :return: bool类型, 是否恢复成功
+        """
+        with self.lock:
+            if info_hash not in self.paused:
+                return False
+            self.paused.remove(info_hash)
+            self.queued.append(info_hash)
+        self._schedule()
+        return True
+
+    @property
+    def is_completed(self):
+        """
+        :return: 所有torrent是否都已下载完成
+        """
+        with self.lock:
+            return all(torrent.progress == 1 for torrent in self.torrents.values())
+
+    def get_status(self, info_hash):
+        """
+        :param info_hash: torrent的info_hash
+        :return: 'queued', 'downloading', 'paused'或'finished'
+        """
+        with self.lock:
+            if info_hash in self.queued:
+                return 'queued'
+            if info_hash in self.active:
+                return 'downloading'
+            if info_hash in self.paused:
+                return 'paused'
+        return 'finished'
+
+    def get_stats(self, info_hash):
+        """
+        :param info_hash: torrent的info_hash
+        :return: 该torrent状态与统计信息的dict, 不存在时返回None
+        """
+        torrent = self.torrents.get(info_hash)
+        if torrent is None:
+            return None
+        return {
+            'info_hash': info_hash.hex(),
+            'name': torrent.metainfo.name,
+            'status': self.get_status(info_hash),
+            'progress': torrent.progress,
+            'length': torrent.metainfo.length,
+            'completed': torrent.completed_len,
+            'left': torrent.left,
+            'downloaded': torrent.downloaded,
+            'uploaded': torrent.uploaded,
+            'download_rate': torrent.traffic['payload_download'].rate,
+            'upload_rate': torrent.traffic['payload_upload'].rate,
+            'peers': len(torrent.peers),
+            'peer_slots': torrent.max_peers,
+            'banned_ips': len(torrent.banned_ips)
+        }
+
+    def get_peer_slots(self, torrent):
+        """
+        在正在下载的torrent之间公平分配全局连接数:
+        每个torrent保底获得平均份额, 其他torrent未用完的份额由连接数已满的torrent均分
+        :param torrent: torrent对象
+        :return: 该torrent可使用的连接数
+        """
+        active = [self.torrents[info_hash] for info_hash in list(self.active)
+                  if info_hash in self.torrents]
+        if torrent not in active:
+            active.append(torrent)
+        share = self.max_connections // len(active)
+        spare = 0
+        hungry_count = 0
+        is_hungry = False
+        for cur_torrent in active:
+            used = len(cur_torrent.peers) + len(cur_torrent.connecting_peers)
+            if used < share:
+                spare += share - used
+            else:
+                hungry_count += 1
+                is_hungry = is_hungry or cur_torrent is torrent
+        slots = share + spare // hungry_count if is_hungry else share
+        return min(slots, SETTINGS['max_peers'])
+
+    def handle_torrent_completed(self, torrent):
+        """
+        torrent下载完成后让出下载名额给排队中的torrent
+        :param torrent: 完成的torrent
+        :return: None
+        """
+        with self.lock:
+            self.active.discard(torrent.metainfo.info_hash)
+        self._schedule()
+
+    def _schedule(self):
+        """
+        在未达到max_active_torrents时启动排队中的torrent
+        :return: None
+        """
+        if not self.is_running:
+            return
+        to_start = []
+        with self.lock:
+            while self.queued and len(self.active) < self.max_active_torrents:
+                info_hash = self.queued.pop(0)
+                self.active.add(info_hash)
+                to_start.append(self.torrents[info_hash])
+        for torrent in to_start:
+            Thread(target=torrent.run_download, args=(), daemon=True).start()
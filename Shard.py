@@ -0,0 +1,353 @@
+import math
+import multiprocessing
+import sys
+import time
+import traceback
+import zlib
+from multiprocessing import shared_memory
+from threading import Thread
+
+import Tracing
+from Config import SETTINGS
+from Metrics import DISK_BUCKETS, get_metrics
+from PeerListener import get_peer_listener
+from Torrent import Torrent
+from TorrentMetainfo import TorrentMetainfo
+from TorrentWriter import TorrentWriter
+from TrackerAPI import peer_key
+
+# 共享内存中每个piece占一个字节: FREE表示待领取, DONE表示已写入磁盘, 1~254表示被第n-1个分片领取
+FREE = 0
+DONE = 255
+MAX_SHARDS = DONE - 1
+
+
+class ShardTorrent(Torrent):
+    """
+    在工作进程中运行的分片: 只连接按peer键哈希分配给本分片的peer,
+    从共享内存中的piece状态表按需领取piece, 校验后的piece交给协调进程写入磁盘
+    """
+
+    def __init__(self, metainfo, shard_idx, shards_count, states, claim_lock, piece_queue):
+        """
+        :param metainfo: torrent的metainfo
+        :param shard_idx: 分片序号
+        :param shards_count: 分片数量
+        :param states: 共享内存中的piece状态表(memoryview)
+        :param claim_lock: 跨进程的领取锁
+        :param piece_queue: 提交已校验piece的跨进程队列
+        """
+        self.shard_idx = shard_idx
+        self.shards_count = shards_count
+        self.states = states
+        self.claim_lock = claim_lock
+        self.piece_queue = piece_queue
+        # 各分片从不同位置开始领取, 减少竞争并使写入大致连续
+        self.claim_cursor = len(metainfo.pieces) * shard_idx // shards_count
+        super().__init__(metainfo)
+        # web seed只在第一个分片中运行, 避免多个进程重复请求同一服务器
+        if shard_idx != 0:
+            self.web_seeds = []
+
+    def _init_exp_p_blocks(self):
+        # 分片启动时不持有任何piece, 由peer按需领取
+        pass
+
+    def _owns(self, key):
+        """
+        :param key: peer的packed bytes键
+        :return: 该peer是否分配给本分片
+        """
+        return zlib.crc32(key) % self.shards_count == self.shard_idx
+
+    def _claim_pieces(self, peer):
+        """
+        从共享状态表中领取peer拥有的待领取piece, 加入本分片的exp_p_blocks
+        :param peer: peer或web seed对象
+        :return: 领取的piece数量
+        """
+        claimed = []
+        pieces_count = len(self.states)
+        with self.claim_lock:
+            for i in range(pieces_count):
+                piece_idx = (self.claim_cursor + i) % pieces_count
+                if self.states[piece_idx] == FREE and peer.have_piece(piece_idx):
+                    self.states[piece_idx] = self.shard_idx + 1
+                    claimed.append(piece_idx)
+                    if len(claimed) == SETTINGS['shard_claim_pieces']:
+                        break
+            if claimed:
+                self.claim_cursor = (claimed[-1] + 1) % pieces_count
+        with self.exp_p_blocks_lock:
+            for piece_idx in claimed:
+                self.exp_p_blocks[piece_idx] = set(range(len(self.p_blocks[piece_idx])))
+        return len(claimed)
+
+    def release_idle_pieces(self):
+        """
+        没有可用peer时归还尚未开始下载的piece, 使其他分片可以领取
+        :return: 归还的piece数量
+        """
+        released = []
+        with self.exp_p_blocks_lock:
+            for piece_idx, cur_blocks in list(self.exp_p_blocks.items()):
+                if (self.p_numblocks[piece_idx] == 0 and piece_idx not in self.piece_owners and
+                        len(cur_blocks) == len(self.p_blocks[piece_idx])):
+                    self.exp_p_blocks.pop(piece_idx)
+                    released.append(piece_idx)
+        with self.claim_lock:
+            for piece_idx in released:
+                self.states[piece_idx] = FREE
+        return len(released)
+
+    def get_pbi_for_peer(self, peer, pieces=None):
+        piece_idx, block_idx = super().get_pbi_for_peer(peer, pieces)
+        # 本分片持有的piece中没有该peer可下载的block时领取新的piece
+        if block_idx is None and pieces is None and self._claim_pieces(peer):
+            piece_idx, block_idx = super().get_pbi_for_peer(peer)
+        return piece_idx, block_idx
+
+    def get_web_seed_run(self, web_seed, max_len):
+        res = super().get_web_seed_run(web_seed, max_len)
+        if not res and self._claim_pieces(web_seed):
+            res = super().get_web_seed_run(web_seed, max_len)
+        # 本分片暂无piece时只要其他分片仍在下载就继续等待
+        if res is None and self.progress < 1:
+            return []
+        return res
+
+    def is_piece_needed(self, piece_idx):
+        # 其他分片完成的piece同样不再需要
+        return self.states[piece_idx] != DONE and super().is_piece_needed(piece_idx)
+
+    def read_block(self, piece_idx, offset, length):
+        # 磁盘写入由协调进程完成, 本进程writer的written_pieces不会更新;
+        # 状态表中DONE的piece(包括其他分片下载的)均已写入磁盘, 可以读取后上传
+        if piece_idx < len(self.states) and self.states[piece_idx] == DONE:
+            self.writer.written_pieces.add(piece_idx)
+        return super().read_block(piece_idx, offset, length)
+
+    def _write_piece(self, piece_idx, piece):
+        # 由协调进程中唯一的磁盘写入线程写入, 有界队列在磁盘跟不上时阻塞下载线程
+        self.piece_queue.put((piece_idx, piece))
+
+    def _handle_completed(self):
+        # 本分片的piece全部完成不代表整个torrent完成, 由协调进程判断
+        pass
+
+    def add_peer_candidate_keys(self, keys):
+        super().add_peer_candidate_keys(key for key in keys if self._owns(key))
+
+    def _add_new_peer(self, ip, port):
+        key = peer_key(ip, port)
+        if key is not None and self._owns(key):
+            super()._add_new_peer(ip, port)
+
+    @property
+    def max_peers(self):
+        return math.ceil(SETTINGS['max_peers'] / self.shards_count)
+
+    @property
+    def progress(self):
+        return self.states.tobytes().count(DONE) / len(self.states)
+
+    @property
+    def left(self):
+        states = self.states.tobytes()
+        return sum(self.metainfo.get_piece_len_at(piece_idx)
+                   for piece_idx, state in enumerate(states) if state != DONE)
+
+
+def _run_shard(path, shard_idx, shards_count, shm_name, claim_lock, piece_queue, stop_event,
+               peer_counts, settings):
+    """
+    工作进程入口
+    :param path: torrent文件路径
+    :param shard_idx: 分片序号
+    :param shards_count: 分片数量
+    :param shm_name: piece状态表的共享内存名
+    :param claim_lock: 跨进程的领取锁
+    :param piece_queue: 提交已校验piece的跨进程队列
+    :param stop_event: 协调进程要求停止的事件
+    :param peer_counts: 各分片的peer数量(共享数组)
+    :param settings: 协调进程中的SETTINGS
+    :return: None
+    """
+    SETTINGS.update(settings)
+    # 每个分片使用不同的peer_id与监听端口, 对其他peer表现为不同的客户端
+    SETTINGS['peer_id'] = SETTINGS['peer_id'][:-3] + b'%03d' % shard_idx
+    if shard_idx != 0:
+        SETTINGS['port'] = '0'
+        # DHT端口只能被一个进程绑定
+        SETTINGS['dht_enabled'] = False
+    listener = get_peer_listener()
+    if listener is not None:
+        SETTINGS['port'] = str(listener.port)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    torrent = ShardTorrent(TorrentMetainfo(path), shard_idx, shards_count, shm.buf, claim_lock,
+                           piece_queue)
+    Thread(target=torrent.run_download, daemon=True).start()
+    idle_since = time.monotonic()
+    is_completed = False
+    while not stop_event.wait(1):
+        peer_counts[shard_idx] = len(torrent.peers)
+        # 由第一个分片向tracker发送completed事件
+        if shard_idx == 0 and not is_completed and torrent.progress == 1:
+            is_completed = True
+            torrent.tracker.completed()
+        if torrent.peers:
+            idle_since = time.monotonic()
+        elif time.monotonic() - idle_since > SETTINGS['shard_idle_release']:
+            torrent.release_idle_pieces()
+    torrent.stop()
+    # 等待队列中的piece交给协调进程后再退出
+    piece_queue.close()
+    piece_queue.join_thread()
+    shm.close()
+
+
+class ShardedDownload:
+    """
+    将一个torrent的peer连接分散到多个工作进程, 绕开单进程GIL对解析与哈希的限制:
+    piece状态保存在共享内存中, 各分片按需领取, 已校验的piece由协调进程中唯一的写入线程写入磁盘
+    """
+
+    def __init__(self, path, shards_count=None):
+        """
+        :param path: torrent文件路径
+        :param shards_count: 工作进程数量, None表示CPU核数
+        """
+        self.path = path
+        self.metainfo = TorrentMetainfo(path)
+        self.shards_count = min(shards_count or multiprocessing.cpu_count(), MAX_SHARDS)
+        # 先在协调进程中创建下载文件, 工作进程中的TorrentWriter不再创建
+        self.writer = TorrentWriter(self.metainfo)
+        pieces_count = len(self.metainfo.pieces)
+        self.shm = shared_memory.SharedMemory(create=True, size=pieces_count)
+        self.states = self.shm.buf
+        self.states[:] = bytes([DONE]) * pieces_count
+        for piece_idx in self.writer.get_uncompleted_piece_indexes():
+            self.states[piece_idx] = FREE
+        self.completed_len = sum(self.metainfo.get_piece_len_at(piece_idx)
+                                 for piece_idx in range(pieces_count)
+                                 if self.states[piece_idx] == DONE)
+        # 使用spawn启动工作进程, 不继承协调进程中的线程与单例, SETTINGS显式传递
+        ctx = multiprocessing.get_context('spawn')
+        self.claim_lock = ctx.Lock()
+        self.piece_queue = ctx.Queue(SETTINGS['disk_queue_size'])
+        self.stop_event = ctx.Event()
+        self.peer_counts = ctx.Array('i', self.shards_count, lock=False)
+        self.processes = []
+        self._ctx = ctx
+        self._writer_thread = None
+        metrics = get_metrics()
+        self.metrics_label = self.metainfo.info_hash.hex()
+        self.traffic = metrics.traffic_meters('bt_torrent_', parents=metrics.traffic_meters('bt_'),
+                                              torrent=self.metrics_label)
+        self.write_latency = metrics.histogram('bt_disk_write_seconds', 'piece write latency',
+                                               DISK_BUCKETS)
+        metrics.gauge('bt_torrent_peers', 'connected peers',
+                      func=lambda: self.peers_count, torrent=self.metrics_label)
+
+    def start(self):
+        """
+        启动磁盘写入线程与各分片进程
+        :return: None
+        """
+        self._writer_thread = Thread(target=self._write_always, daemon=True)
+        self._writer_thread.start()
+        for shard_idx in range(self.shards_count):
+            self._start_shard(shard_idx)
+        Thread(target=self._monitor_always, daemon=True).start()
+
+    def _start_shard(self, shard_idx):
+        process = self._ctx.Process(
+            target=_run_shard, daemon=True,
+            args=(self.path, shard_idx, self.shards_count, self.shm.name, self.claim_lock,
+                  self.piece_queue, self.stop_event, self.peer_counts, dict(SETTINGS)))
+        process.start()
+        if shard_idx < len(self.processes):
+            self.processes[shard_idx] = process
+        else:
+            self.processes.append(process)
+
+    def _write_always(self):
+        """
+        磁盘写入线程: 写入各分片提交的piece, 写入后才将其标记为完成
+        :return: None
+        """
+        while True:
+            item = self.piece_queue.get()
+            # stop()放入的结束标记
+            if item is None:
+                break
+            piece_idx, piece = item
+            try:
+                with Tracing.span('write', 'disk', piece=piece_idx):
+                    start_time = time.perf_counter()
+                    self.writer.write_piece(piece_idx, piece)
+                    self.write_latency.observe(time.perf_counter() - start_time)
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+                # 写入失败时重新放回待领取状态
+                with self.claim_lock:
+                    self.states[piece_idx] = FREE
+                continue
+            self.states[piece_idx] = DONE
+            self.completed_len += len(piece)
+            self.traffic['payload_download'].add(len(piece))
+
+    def _monitor_always(self):
+        """
+        重启意外退出的分片进程, 并归还其领取的piece
+        :return: None
+        """
+        while not self.stop_event.wait(1):
+            for shard_idx, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                with self.claim_lock:
+                    for piece_idx in range(len(self.states)):
+                        if self.states[piece_idx] == shard_idx + 1:
+                            self.states[piece_idx] = FREE
+                self.peer_counts[shard_idx] = 0
+                if not self.stop_event.is_set():
+                    self._start_shard(shard_idx)
+
+    def stop(self):
+        """
+        停止所有分片进程, 并等待已提交的piece写入磁盘
+        :return: None
+        """
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(SETTINGS['timeout_for_peer'])
+            if process.is_alive():
+                process.terminate()
+        # 分片退出前已将piece交给队列, 结束标记之前的piece均会被写入
+        if self._writer_thread is not None:
+            self.piece_queue.put(None)
+            self._writer_thread.join()
+        self.shm.close()
+        self.shm.unlink()
+
+    @property
+    def progress(self):
+        """
+        :return: 已写入磁盘的piece比例
+        """
+        return self.states.tobytes().count(DONE) / len(self.states)
+
+    @property
+    def peers_count(self):
+        """
+        :return: 各分片的peer数量之和
+        """
+        return sum(self.peer_counts)
+
+    @property
+    def download_rate(self):
+        """
+        :return: 滑动窗口内已写入磁盘数据的速率(B/s)
+        """
+        return self.traffic['payload_download'].rate
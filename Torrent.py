@@ -1,29 +1,47 @@
 import hashlib
 import math
+import socket
 import time
+from collections import Counter
 from threading import Lock
 from threading import Thread
 
-from TrackerAPI import get_peers_list_by_torrent_metainfo, PeersFindingError
-from TorrentWriter import TorrentWriter
+import Merkle
+import Tracing
+from DHT import get_dht_node
+from Metrics import DISK_BUCKETS, HASH_BUCKETS, get_metrics
+from PeerListener import get_peer_listener
+from TrackerAPI import TrackerClient, PeersFindingError, decode_peer_key, peer_key
+from TorrentWriter import TorrentWriter, get_read_cache
 from Config import SETTINGS
 from Peer import Peer
+from Scheduler import get_scheduler
+from WebSeed import WebSeed
 
 
 class Torrent:
-    def __init__(self, metainfo):
+    def __init__(self, metainfo, session=None):
         self.metainfo = metainfo
-        # torrent文件中下载内容的长度
-        self.downloaded_data_len = 0
-        self.prev_time = time.time()
+        # 所属的Session, 单独运行时为None
+        self.session = session
+        # 调用stop()后不再补充peer
+        self.is_stopped = False
+        # 上报给tracker的累计上传/下载字节数, 以及已校验完成的数据长度
+        self.uploaded = 0
+        self.downloaded = 0
+        self.completed_len = 0
         # torrent writer
         # 将下载内容读写至磁盘
         self.writer = TorrentWriter(metainfo)
         self.prev_peers_count = 1
-        # 使用dict类型储存peers
+        # 使用dict类型储存peers, 以peer的packed bytes键(compact格式)为键
         self.peers = {}
-        # 使用set类型储存peers黑名单
+        # 使用set类型储存peers黑名单(packed bytes键)
         self.peers_blacklist = set()
+        # 通过PEX或tracker后台announce得知、尚未连接的候选peer(packed bytes键)
+        self.peer_candidates = set()
+        # 正在建立连接的peer(packed bytes键), 避免重复连接
+        self.connecting_peers = set()
         # 互斥访问peer锁
         self.peers_lock = Lock()
         self.p_blocks = [self._get_initial_blocks_list(i)
@@ -33,6 +51,72 @@ class Torrent:
         self.exp_p_blocks = {}
         self._init_exp_p_blocks()
         self.exp_p_blocks_lock = Lock()
+        # 下载中piece的每个block来源: {piece_idx: [peer的packed ip, ...]}
+        self.p_block_sources = {}
+        # 校验失败、等待单个可信peer重新下载的piece:
+        # {piece_idx: (失败的blocks, 来源列表, 已单独重新下载且失败过的来源ip集合)}
+        self.failed_pieces = {}
+        # 单peer模式下负责重新下载该piece的peer键: {piece_idx: peer.key或None}
+        self.piece_owners = {}
+        # 单peer模式的到期时间, 到期仍未完成时退出单peer模式: {piece_idx: monotonic时间}
+        self.single_peer_deadlines = {}
+        # v2: 已通过piece层校验的各block叶子哈希{piece_idx: [叶子哈希, ...]},
+        # 以及已发出hash request的piece, 有叶子哈希后每个block到达时即可单独校验
+        self.block_hashes = {}
+        self.hash_requests = set()
+        # 发送错误数据的次数与封禁到期时间, 均以packed ip为键
+        self.peer_strikes = {}
+        self.banned_ips = {}
+        # 已完成、等待批量发送have消息的piece, 以及是否已安排发送
+        self.pending_haves = []
+        self.have_lock = Lock()
+        self.is_have_scheduled = False
+        # 已被本端unchoke、可以请求数据的peer(packed bytes键), 由peers_lock保护
+        self.unchoked_peers = set()
+        # 该torrent的tracker客户端, 复用连接并按interval重新announce
+        self.tracker = TrackerClient(self)
+        # 共享的传入连接监听器, 在run_download时注册
+        self.listener = None
+        self._init_metrics()
+        # BEP 19 web seed, 与peer一起参与piece选择
+        self.web_seeds = [WebSeed(url, self) for url in metainfo.url_list]
+
+    def _init_metrics(self):
+        """
+        注册该torrent的速率计、直方图与仪表, 以info_hash的十六进制为torrent标签
+        :return: None
+        """
+        metrics = get_metrics()
+        self.metrics_label = self.metainfo.info_hash.hex()
+        # peer -> torrent -> 全局逐级累加的流量速率计
+        self.traffic = metrics.traffic_meters('bt_torrent_', parents=metrics.traffic_meters('bt_'),
+                                              torrent=self.metrics_label)
+        self.hash_time = metrics.histogram('bt_piece_hash_seconds', 'piece hash time', HASH_BUCKETS)
+        self.write_latency = metrics.histogram('bt_disk_write_seconds', 'piece write latency',
+                                               DISK_BUCKETS)
+        metrics.gauge('bt_torrent_peers', 'connected peers',
+                      func=lambda: len(self.peers), torrent=self.metrics_label)
+        metrics.gauge('bt_torrent_inflight_requests', 'requests waiting for a block',
+                      func=self._count_inflight_requests, torrent=self.metrics_label)
+        metrics.gauge('bt_torrent_buffered_bytes', 'bytes of unfinished pieces held in memory',
+                      func=self._count_buffered_bytes, torrent=self.metrics_label)
+
+    def _count_inflight_requests(self):
+        """
+        :return: 已发出请求但尚未收到block的数量
+        """
+        return sum(1 for peer in list(self.peers.values()) if peer.processed_block is not None)
+
+    def _count_buffered_bytes(self):
+        """
+        :return: 内存中未完成piece的block字节数与peer缓冲区字节数之和
+        """
+        res = sum(len(peer.buffer) for peer in list(self.peers.values()))
+        for piece_idx in list(self.exp_p_blocks):
+            blocks = self.p_blocks[piece_idx]
+            if blocks is not None:
+                res += sum(len(block) for block in blocks if block is not None)
+        return res
 
     def _get_initial_blocks_list(self, piece_idx):
         """
@@ -66,27 +150,77 @@ class Torrent:
             self.exp_p_blocks[piece_idx] = {
                 b_i for b_i in range(len(self.p_blocks[piece_idx]))}
 
-    def _get_new_ip_port_list(self):
+    def _get_new_ip_port_list(self, on_peers=None):
         """
         调用tracker  API获取新的peers名单列表
+        :param on_peers: 每个tracker返回新peer时的回调
         :return: peers列表
         """
         try:
-            return get_peers_list_by_torrent_metainfo(self.metainfo)
+            return self.tracker.get_peers(on_peers)
         except PeersFindingError:
+            # 所有tracker均失败时通过DHT查找peer, 查找到的peer直接加入候选池
+            self._get_peers_from_dht()
+            return []
+
+    def _get_dht(self):
+        """
+        :return: 共享的DHT节点, 未启用或无法启动时返回None
+        """
+        if not SETTINGS['dht_enabled']:
+            return None
+        return get_dht_node()
+
+    def _get_peers_from_dht(self):
+        """
+        通过DHT查找peer并宣告本端正在下载, 查找过程中得到的compact peer
+        不经解码直接以packed bytes键加入候选池(包括IPv6的peer)
+        :return: peer的packed bytes键列表
+        """
+        dht = self._get_dht()
+        if dht is None:
             return []
+        for host, port in self.metainfo.nodes:
+            dht.add_node(host, port)
+        return dht.announce_peer(self.metainfo.info_hash, on_peers=self.add_peer_candidate_keys)
+
+    def get_dht_port(self):
+        """
+        :return: 正在运行的DHT节点的端口, 用于PORT消息, 未启用或无法启动时返回None
+        """
+        dht = self._get_dht()
+        if dht is None or not dht.is_running:
+            return None
+        return dht.port
+
+    def handle_dht_port(self, ip, port):
+        """
+        处理peer通过PORT消息告知的DHT端口
+        :param ip: peer的ip地址
+        :param port: peer的DHT端口
+        :return: None
+        """
+        dht = self._get_dht()
+        if dht is not None:
+            dht.add_node(ip, port)
 
-    def get_pbi_for_peer(self, peer):
+    def get_pbi_for_peer(self, peer, pieces=None):
         """
         对每个peer返回需要请求的piece与block索引, 其形式如下:
         (piece_idx, block_idx)
         :param peer: peer对象
+        :param pieces: 只在这些piece中选择, 如被choke时的allowed_fast集合
         :return: (piece_idx, block_idx)
         """
         res_piece_idx = res_block_idx = None
         with self.exp_p_blocks_lock:
-            for piece_idx in self.exp_p_blocks:
+            candidates = self.exp_p_blocks if pieces is None else [
+                piece_idx for piece_idx in pieces if piece_idx in self.exp_p_blocks]
+            for piece_idx in candidates:
                 cur_blocks = self.exp_p_blocks[piece_idx]
+                # 单peer模式的piece只交给负责的可信peer
+                if piece_idx in self.piece_owners and not self._claim_piece(piece_idx, peer):
+                    continue
                 if peer.have_piece(piece_idx):
                     res_piece_idx = piece_idx
                     if len(cur_blocks) != 0:
@@ -94,6 +228,132 @@ class Torrent:
                         break
         return res_piece_idx, res_block_idx
 
+    def get_web_seed_run(self, web_seed, max_len):
+        """
+        为web seed领取一段blocks: 第一个仍有可领取block的piece中的全部可领取blocks,
+        若该piece完全未被领取, 则继续领取其后同样完全未被领取的相邻piece, 总长度不超过max_len
+        :param web_seed: WebSeed对象
+        :param max_len: 最大字节数
+        :return: 按顺序排列的[(piece_idx, block_idx)], 全部下载完成时返回None
+        """
+        res = []
+        run_len = 0
+        with self.exp_p_blocks_lock:
+            if not self.exp_p_blocks:
+                return None
+            # exp_p_blocks中的piece按索引顺序排列
+            for piece_idx, cur_blocks in self.exp_p_blocks.items():
+                if piece_idx in self.piece_owners and not self._claim_piece(piece_idx, web_seed):
+                    if res:
+                        break
+                    continue
+                is_whole = self.p_numblocks[piece_idx] == 0 and len(cur_blocks) == math.ceil(
+                    self.metainfo.get_piece_len_at(piece_idx) / SETTINGS['int_block_len'])
+                if res and (not is_whole or piece_idx != res[-1][0] + 1 or
+                            run_len + self.metainfo.get_piece_len_at(piece_idx) > max_len):
+                    break
+                if not cur_blocks:
+                    continue
+                res.extend((piece_idx, block_idx) for block_idx in sorted(cur_blocks))
+                run_len += self.metainfo.get_piece_len_at(piece_idx)
+                cur_blocks.clear()
+                # 只有完整的piece才继续向后合并
+                if not is_whole:
+                    break
+        return res
+
+    def _claim_piece(self, piece_idx, peer):
+        """
+        判断peer能否下载处于单peer模式的piece, 尚无负责peer时由可信peer认领
+        (需在exp_p_blocks_lock内调用)
+        :param piece_idx: piece索引
+        :param peer: peer对象
+        :return: bool类型
+        """
+        if time.monotonic() >= self.single_peer_deadlines[piece_idx]:
+            # 长时间没有可信peer认领或负责的peer迟迟未完成时, 放弃追查来源, 由所有peer一起下载
+            self._leave_single_peer_mode(piece_idx)
+            return True
+        owner = self.piece_owners[piece_idx]
+        if owner is not None:
+            return owner == peer.key
+        if not peer.have_piece(piece_idx) or not self._is_trusted(piece_idx, peer):
+            return False
+        self.piece_owners[piece_idx] = peer.key
+        # 从认领时起重新计时, 给负责的peer完整的下载时间
+        self.single_peer_deadlines[piece_idx] = time.monotonic() + SETTINGS['single_peer_timeout']
+        return True
+
+    def _leave_single_peer_mode(self, piece_idx):
+        """
+        退出单peer模式(需在exp_p_blocks_lock内调用)
+        :param piece_idx: piece索引
+        :return: None
+        """
+        self.failed_pieces.pop(piece_idx, None)
+        self.piece_owners.pop(piece_idx, None)
+        self.single_peer_deadlines.pop(piece_idx, None)
+
+    def _is_trusted(self, piece_idx, peer):
+        """
+        可信peer: 从未发送过错误数据, 且不是该piece上次失败时的数据来源;
+        失败数据的来源中, 发送block最多且尚未单独重新下载过的一个也可以认领
+        :param piece_idx: piece索引
+        :param peer: peer对象
+        :return: bool类型
+        """
+        ip = peer.key[:-2]
+        if self.peer_strikes.get(ip):
+            return False
+        _, sources, _ = self.failed_pieces[piece_idx]
+        return ip not in sources or ip == self._get_retry_source(piece_idx)
+
+    def _get_retry_source(self, piece_idx):
+        """
+        :param piece_idx: 处于单peer模式的piece索引
+        :return: 可以单独重新下载该piece的来源ip, 没有时返回None
+        """
+        _, sources, tried = self.failed_pieces[piece_idx]
+        counts = Counter(ip for ip in sources if ip is not None and ip not in tried and
+                         not self.peer_strikes.get(ip))
+        return counts.most_common(1)[0][0] if counts else None
+
+    def is_banned(self, key):
+        """
+        检查peer的ip是否处于封禁期内, 并清除已过期的封禁
+        :param key: peer的packed bytes键
+        :return: bool类型
+        """
+        ip = key[:-2]
+        expire_time = self.banned_ips.get(ip)
+        if expire_time is None:
+            return False
+        if expire_time <= time.monotonic():
+            self.banned_ips.pop(ip, None)
+            self.peer_strikes.pop(ip, None)
+            return False
+        return True
+
+    def _add_strike(self, ip):
+        """
+        记录ip发送了一次错误数据, 达到max_peer_strikes时封禁该ip并断开其所有连接
+        :param ip: peer的packed ip
+        :return: None
+        """
+        self.peer_strikes[ip] = self.peer_strikes.get(ip, 0) + 1
+        if self.peer_strikes[ip] < SETTINGS['max_peer_strikes']:
+            return
+        self.banned_ips[ip] = time.monotonic() + SETTINGS['ban_duration']
+        with self.peers_lock:
+            banned_peers = [peer for key, peer in self.peers.items() if key[:-2] == ip]
+            self.peer_candidates = {key for key in self.peer_candidates if key[:-2] != ip}
+        for peer in banned_peers:
+            # 关闭套接字使该peer的下载线程退出并走正常的断开流程
+            try:
+                peer.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
     def handle_incorrect_pbi(self, piece_idx, block_idx):
         """
         若收到不正确的(piece_idx, block_idx), 将其加入未完成的block list
@@ -102,7 +362,11 @@ class Torrent:
         :return: None
         """
         with self.exp_p_blocks_lock:
-            self.exp_p_blocks[piece_idx].add(block_idx)
+            cur_blocks = self.exp_p_blocks.get(piece_idx)
+            blocks = self.p_blocks[piece_idx]
+            # 迟到的回复可能已经完成了该block或整个piece
+            if cur_blocks is not None and blocks is not None and blocks[block_idx] is None:
+                cur_blocks.add(block_idx)
 
     def handle_peer_disconnect(self, peer, peer_is_bad):
         """
@@ -113,13 +377,40 @@ class Torrent:
         """
         # 将连接状况较差的peer加入黑名单
         if peer_is_bad:
-            self.peers_blacklist.add(peer.name)
+            self.peers_blacklist.add(peer.key)
+        # 释放该peer负责的单peer模式piece, 交给其他可信peer
+        with self.exp_p_blocks_lock:
+            for piece_idx, owner in self.piece_owners.items():
+                if owner == peer.key:
+                    self.piece_owners[piece_idx] = None
         # 从peer名单列表中删去该peer
         with self.peers_lock:
-            self.peers.pop(peer.name)
-        # 添加新的peer
+            self.peers.pop(peer.key, None)
+        self.release_unchoke(peer)
+        # 添加新的peer, 优先从候选池中补充, 候选池为空时才请求tracker
+        if self.is_stopped:
+            return
         if len(self.peers) < self.prev_peers_count * 0.7:
-            self.add_new_peers()
+            if self.peer_candidates:
+                self._connect_candidates()
+            else:
+                self.add_new_peers()
+
+    @property
+    def max_peers(self):
+        """
+        :return: 该torrent可使用的连接数, 在Session中由全局连接上限公平分配
+        """
+        if self.session is None:
+            return SETTINGS['max_peers']
+        return self.session.get_peer_slots(self)
+
+    @property
+    def left(self):
+        """
+        :return: 尚未完成下载的字节数
+        """
+        return self.metainfo.length - self.completed_len
 
     @property
     def progress(self):
@@ -132,35 +423,18 @@ class Torrent:
     @property
     def download_speed(self):
         """
-        计算当前的下载速度, 下载耗时以及完成下载的数据大小
+        由payload下载速率计得到滑动窗口内的下载速度, 读取不会影响测量结果
         :return: str类型(下载速度)
         """
-        # 获取当前时间
-        cur_time = time.time()
-        # 计算已下载内容的数据大小(bit)
-        res_bits_count = self.downloaded_data_len * 8
-        # 重置下载数据大小
-        self.downloaded_data_len = 0
-        # 计算时间差
-        res_time = cur_time - self.prev_time
-        # 速度为0时
-        if res_time == 0:
-            return '0 B/s'
-        # 使用当前时间充当下次计算的起始时间
-        self.prev_time = cur_time
+        rate = self.traffic['payload_download'].rate
         # 下载速度达到B/s时
-        if res_bits_count / 1024 < 1:
-            res_number = res_bits_count
-            res_speed = 'B/s'
+        if rate / 1024 < 1:
+            return '{:.2f} B/s'.format(rate)
         # 下载速度达到KB/s时
-        elif res_bits_count / 1024 ** 2 < 1:
-            res_number = res_bits_count / 1024
-            res_speed = 'KB/s'
+        elif rate / 1024 ** 2 < 1:
+            return '{:.2f} KB/s'.format(rate / 1024)
         # 下载速度达到MB/s时
-        else:
-            res_number = res_bits_count / 1024 ** 2
-            res_speed = 'MB/s'
-        return '{:.2f} {}'.format(res_number / res_time, res_speed)
+        return '{:.2f} MB/s'.format(rate / 1024 ** 2)
 
     def add_new_peers(self):
         """
@@ -168,15 +442,17 @@ class Torrent:
         :return: None
         """
         while True:
-            # 从tracker中获得peer的ip与端口号
-            ip_port_list = self._get_new_ip_port_list()
-            # 创建线程
             threads = []
-            for ip, port in ip_port_list:
-                # 创建线程以添加新的peer
-                cur_thread = Thread(target=self._add_new_peer, args=(ip, port))
-                threads.append(cur_thread)
-                cur_thread.start()
+
+            def connect_peers(ip_port_list):
+                # 每个tracker的结果到达后立即创建线程以添加新的peer
+                for ip, port in ip_port_list:
+                    cur_thread = Thread(target=self._add_new_peer, args=(ip, port))
+                    threads.append(cur_thread)
+                    cur_thread.start()
+
+            # 从所有tracker中并发获得peer的ip与端口号
+            self._get_new_ip_port_list(on_peers=connect_peers)
             # 等待所有线程完成
             for thread in threads:
                 thread.join()
@@ -198,30 +474,184 @@ class Torrent:
         :param port: peer的端口号
         :return: None
         """
-        # 通过<ip>:<port>的形式定义peer格式
-        cur_ip_port = ip + ':' + str(port)
+        # 以compact格式的packed bytes作为peer的键
+        key = peer_key(ip, port)
         # 对于不在peers dict中的peer, 且该peer不在黑名单中, 完成加入
-        if cur_ip_port not in self.peers and cur_ip_port not in self.peers_blacklist:
+        if key is None or len(self.peers) >= self.max_peers or self.is_banned(key):
+            return
+        if key not in self.peers and key not in self.peers_blacklist:
             peer = Peer(ip, port, self)
             if peer.is_available:
                 with self.peers_lock:
-                    self.peers[cur_ip_port] = peer
+                    self.peers[key] = peer
+
+    def _add_and_run_peer(self, key):
+        """
+        添加新的peer并立即开始从其下载
+        :param key: peer的packed bytes键
+        :return: None
+        """
+        try:
+            self._add_new_peer(*decode_peer_key(key))
+        finally:
+            with self.peers_lock:
+                self.connecting_peers.discard(key)
+        with self.peers_lock:
+            peer = self.peers.get(key)
+            if peer is None or peer.is_running:
+                return
+            peer.is_running = True
+        peer.run_download()
+
+    def add_peer_candidates(self, ip_port_list):
+        """
+        将新得知的peer加入候选池, 并在连接数不足时补充连接
+        :param ip_port_list: [(ip,port)]的元组列表
+        :return: None
+        """
+        keys = [peer_key(ip, port) for ip, port in ip_port_list]
+        self.add_peer_candidate_keys(key for key in keys if key is not None)
+
+    def add_peer_candidate_keys(self, keys):
+        """
+        将packed bytes键形式的peer加入候选池, 集合运算完成去重与黑名单检查
+        :param keys: peer的packed bytes键的可迭代对象
+        :return: None
+        """
+        with self.peers_lock:
+            new_keys = set(keys)
+            new_keys.difference_update(self.peers, self.peers_blacklist)
+            if self.banned_ips:
+                new_keys = {key for key in new_keys if not self.is_banned(key)}
+            self.peer_candidates |= new_keys
+        self._connect_candidates()
+
+    def _connect_candidates(self):
+        """
+        从候选池中取出peer建立连接, 直至连接数(含正在连接的)达到max_peers
+        :return: None
+        """
+        if self.progress == 1 or self.is_stopped:
+            return
+        with self.peers_lock:
+            while (self.peer_candidates and
+                   len(self.peers) + len(self.connecting_peers) < self.max_peers):
+                key = self.peer_candidates.pop()
+                if key in self.peers or key in self.connecting_peers:
+                    continue
+                self.connecting_peers.add(key)
+                Thread(target=self._add_and_run_peer, args=(key,), daemon=True).start()
+
+    def add_incoming_peer(self, sock, ip, port, buffer):
+        """
+        接收由PeerListener转交的传入连接, 与主动连接的peer一样开始下载
+        :param sock: 已accept的套接字
+        :param ip: 对端ip
+        :param port: 对端端口
+        :param buffer: 已读取的数据(包含对端的握手信息)
+        :return: None
+        """
+        if len(self.peers) >= self.max_peers or self.is_banned(peer_key(ip, port)):
+            sock.close()
+            return
+        peer = Peer(ip, port, self, sock=sock, buffer=buffer)
+        if not peer.is_available:
+            return
+        with self.peers_lock:
+            if peer.key in self.peers or peer.key in self.peers_blacklist:
+                peer.sock.close()
+                return
+            self.peers[peer.key] = peer
+            peer.is_running = True
+        peer.run_download()
+
+    def handle_pex_peers(self, added, dropped):
+        """
+        处理peer通过ut_pex告知的新增与断开的peer
+        :param added: 新增peer的packed bytes键列表
+        :param dropped: 断开peer的packed bytes键列表
+        :return: None
+        """
+        with self.peers_lock:
+            self.peer_candidates.difference_update(dropped)
+        self.add_peer_candidate_keys(added)
+
+    def get_pex_peers(self, exclude=None):
+        """
+        返回可通过ut_pex告知其他peer的已连接peer, 跳过监听端口未知的传入连接
+        :param exclude: 需要排除的peer(即接收该消息的peer)
+        :return: {peer的监听地址(packed bytes键): 是否由本端主动连接}
+        """
+        with self.peers_lock:
+            return {peer.listen_key: not peer.is_incoming for peer in self.peers.values()
+                    if peer is not exclude and peer.listen_key is not None}
 
     def run_download(self):
+        # 暂停后再次调用时重新开始补充peer
+        self.is_stopped = False
+        # 在监听端口上接受该torrent的传入连接
+        self.listener = get_peer_listener()
+        if self.listener is not None:
+            self.listener.register(self)
+        for web_seed in self.web_seeds:
+            if not web_seed.is_running:
+                web_seed.start()
         self.add_new_peers()
+        self.tracker.start(on_peers=self.add_peer_candidates)
 
-    def handle_block(self, piece_idx, block_idx, block):
+    def stop(self):
+        """
+        停止该torrent, 断开所有peer, 并向tracker发送stopped事件
+        :return: None
+        """
+        self.is_stopped = True
+        with self.peers_lock:
+            self.peer_candidates.clear()
+            peers = list(self.peers.values())
+        for peer in peers:
+            try:
+                peer.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.listener is not None:
+            self.listener.unregister(self)
+        self.tracker.stop()
+
+    def handle_block(self, piece_idx, block_idx, block, peer=None):
         """
         处理新增加的block时
         :param piece_idx: piece索引
         :param block_idx: block索引
         :param block: block对象
+        :param peer: 发送该block的peer, 用于校验失败时追查来源
         :return: None
         """
-        # 计算block长度(用以计算下载速度)
-        self.downloaded_data_len += len(block)
+        self.downloaded += len(block)
+        blocks = self.p_blocks[piece_idx]
+        # 忽略已完成piece或重复的block
+        if blocks is None or blocks[block_idx] is not None:
+            return
+        source = None if peer is None else peer.key[:-2]
+        # 单peer模式下忽略非负责peer发送的block
+        if piece_idx in self.piece_owners and (
+                peer is None or self.piece_owners[piece_idx] != peer.key):
+            self.handle_incorrect_pbi(piece_idx, block_idx)
+            return
+        # v2下已知叶子哈希时立即校验该block, 错误时只需重新下载这一个block
+        if piece_idx in self.block_hashes and not self._check_block(piece_idx, block_idx, block):
+            if source is not None:
+                self._add_strike(source)
+            self.handle_incorrect_pbi(piece_idx, block_idx)
+            return
+        # 记录该block的来源
+        if piece_idx not in self.p_block_sources:
+            self.p_block_sources[piece_idx] = [None] * len(blocks)
+        self.p_block_sources[piece_idx][block_idx] = source
         # 讲block对象添加至block list中
-        self.p_blocks[piece_idx][block_idx] = block
+        blocks[block_idx] = block
+        if self.p_numblocks[piece_idx] == 0:
+            Tracing.begin_async('piece', 'piece', f'{self.metrics_label}:{piece_idx}',
+                                piece=piece_idx)
         # 增加对应piece的索引长度
         self.p_numblocks[piece_idx] += 1
 
@@ -237,24 +667,290 @@ class Torrent:
         # 从blocks中合成piece
         piece = b''.join(self.p_blocks[piece_idx])
         # 计算该piece的hash值
-        cur_piece_hash = hashlib.sha1(piece).digest()
+        with Tracing.span('hash', 'piece', piece=piece_idx):
+            start_time = time.perf_counter()
+            is_valid = self._check_piece(piece_idx, piece)
+            self.hash_time.observe(time.perf_counter() - start_time)
         # 若计算得到的hash值不能与metainfo中的匹配, 则认为该piece不正确
-        if cur_piece_hash != self.metainfo.pieces[piece_idx]:
+        if not is_valid:
+            Tracing.end_async('piece', 'piece', f'{self.metrics_label}:{piece_idx}', valid=False)
             self._handle_incorrect_piece(piece_idx)
             return
+        Tracing.end_async('piece', 'piece', f'{self.metrics_label}:{piece_idx}', valid=True)
+        # 若该piece之前校验失败过, 通过比对正确的数据找出发送错误block的peer
+        self.p_block_sources.pop(piece_idx, None)
+        if piece_idx in self.failed_pieces:
+            self._attribute_corrupt_blocks(piece_idx)
         # 若正确, 则将该piece写入磁盘
         self.p_blocks[piece_idx] = None
-        self.writer.write_piece(piece_idx, piece)
+        self.block_hashes.pop(piece_idx, None)
+        self.hash_requests.discard(piece_idx)
+        # 刚完成的piece很快会被其他peer请求, 直接放入读缓存而不必再从磁盘读回
+        get_read_cache().insert(self.writer, piece_idx, piece)
+        self._write_piece(piece_idx, piece)
         # 将该piece从未完成block list移除
         with self.exp_p_blocks_lock:
             self.exp_p_blocks.pop(piece_idx)
+            self.completed_len += len(piece)
+            is_completed = len(self.exp_p_blocks) == 0
+        self._broadcast_have(piece_idx)
+        if is_completed:
+            self._handle_completed()
+
+    def is_piece_needed(self, piece_idx):
+        """
+        :param piece_idx: piece索引
+        :return: 该piece是否尚未校验完成
+        """
+        return self.p_blocks[piece_idx] is not None
+
+    def read_block(self, piece_idx, offset, length):
+        """
+        读取已完成piece中的block, 用于上传给peer
+        :param piece_idx: piece索引
+        :param offset: block在piece中的偏移
+        :param length: block长度
+        :return: block数据, 请求越界或该piece尚不可读时返回None
+        """
+        if piece_idx >= len(self.metainfo.pieces) or self.is_piece_needed(piece_idx):
+            return None
+        if offset + length > self.metainfo.get_piece_len_at(piece_idx):
+            return None
+        return get_read_cache().read_block(self.writer, piece_idx, offset, length)
+
+    def request_unchoke(self, peer):
+        """
+        对本端感兴趣的peer申请一个上传名额
+        :param peer: peer对象
+        :return: 是否获得名额
+        """
+        with self.peers_lock:
+            if len(self.unchoked_peers) >= SETTINGS['max_unchoked_peers']:
+                return False
+            self.unchoked_peers.add(peer.key)
+            return True
+
+    def release_unchoke(self, peer):
+        """
+        交还peer的上传名额, 并转给一个等待中的感兴趣peer
+        :param peer: peer对象
+        :return: None
+        """
+        with self.peers_lock:
+            if peer.key not in self.unchoked_peers:
+                return
+            self.unchoked_peers.remove(peer.key)
+            waiting = next((p for p in self.peers.values() if p.peer_interested and
+                            p.key not in self.unchoked_peers), None)
+            if waiting is not None:
+                self.unchoked_peers.add(waiting.key)
+        if waiting is not None:
+            waiting.unchoke()
+
+    def _broadcast_have(self, piece_idx):
+        """
+        piece校验完成后立即更新各peer的感兴趣状态, have消息则合并后由定时任务批量发送
+        :param piece_idx: piece索引
+        :return: None
+        """
+        with self.peers_lock:
+            peers = list(self.peers.values())
+        for peer in peers:
+            peer.handle_piece_completed(piece_idx)
+        with self.have_lock:
+            self.pending_haves.append(piece_idx)
+            if self.is_have_scheduled:
+                return
+            self.is_have_scheduled = True
+        get_scheduler().call_later(SETTINGS['have_batch_interval'], self._flush_haves)
+
+    def _flush_haves(self):
+        """
+        定时任务: 将这段时间内完成的piece放入各peer的发送队列, 由各peer线程发出
+        :return: None
+        """
+        with self.have_lock:
+            pieces = self.pending_haves
+            self.pending_haves = []
+            self.is_have_scheduled = False
+        with self.peers_lock:
+            peers = list(self.peers.values())
+        for peer in peers:
+            peer.send_haves(pieces)
+
+    def _write_piece(self, piece_idx, piece):
+        """
+        写入已校验的piece, 在Session中交给共享的磁盘写入线程
+        :param piece_idx: piece索引
+        :param piece: piece数据
+        :return: None
+        """
+        if self.session is None:
+            with Tracing.span('write', 'disk', piece=piece_idx):
+                start_time = time.perf_counter()
+                self.writer.write_piece(piece_idx, piece)
+                self.write_latency.observe(time.perf_counter() - start_time)
+        else:
+            self.session.disk_writer.submit(self.writer, piece_idx, piece)
+
+    def _handle_completed(self):
+        """
+        全部下载完成后通知tracker与Session
+        :return: None
+        """
+        self.tracker.completed()
+        if self.session is not None:
+            self.session.handle_torrent_completed(self)
+
+    def _check_piece(self, piece_idx, piece):
+        """
+        v1校验piece的SHA1; v2由各block的叶子哈希计算piece层哈希并与metainfo比较
+        :param piece_idx: piece索引
+        :param piece: piece数据
+        :return: bool类型
+        """
+        if self.metainfo.meta_version == 1:
+            return hashlib.sha1(piece).digest() == self.metainfo.pieces[piece_idx]
+        # 每个block到达时已单独校验过
+        if piece_idx in self.block_hashes:
+            return True
+        _, _, expected_hash, width, data_len = self.metainfo.v2_pieces[piece_idx]
+        # hybrid torrent中文件末尾之后的填充数据必须为0
+        if any(piece[data_len:]):
+            return False
+        return Merkle.merkle_root(Merkle.block_hashes(piece[:data_len]), width) == expected_hash
+
+    def _check_block(self, piece_idx, block_idx, block):
+        """
+        使用已校验的叶子哈希检查单个block
+        :param piece_idx: piece索引
+        :param block_idx: block索引
+        :param block: block数据
+        :return: bool类型
+        """
+        data_len = self.metainfo.v2_pieces[piece_idx][4] - block_idx * Merkle.BLOCK_LEN
+        if data_len <= 0:
+            # 完全位于填充区域的block
+            return not any(block)
+        if any(block[data_len:]):
+            return False
+        return Merkle.block_hash(block[:data_len]) == self.block_hashes[piece_idx][block_idx]
+
+    def get_hash_request(self, piece_idx):
+        """
+        为v2 piece生成hash request的参数, 每个piece只请求一次
+        :param piece_idx: piece索引
+        :return: (pieces_root, 首个叶子的索引, 叶子数量)的元组, 无需请求时返回None
+        """
+        if self.metainfo.meta_version == 1:
+            return None
+        with self.exp_p_blocks_lock:
+            if piece_idx in self.block_hashes or piece_idx in self.hash_requests:
+                return None
+            pieces_root, first_leaf, _, width, _ = self.metainfo.v2_pieces[piece_idx]
+            # 只有一个叶子时block哈希即为piece哈希, 整体校验即可
+            if width < 2:
+                return None
+            self.hash_requests.add(piece_idx)
+        return pieces_root, first_leaf, width
+
+    def handle_hashes(self, pieces_root, base_layer, index, hashes):
+        """
+        处理hashes消息: 用piece层哈希校验收到的叶子哈希, 通过后检查该piece中已收到的block
+        :param pieces_root: 文件的merkle根
+        :param base_layer: 哈希所在的层, 0为叶子层
+        :param index: 第一个哈希在该层中的索引
+        :param hashes: 哈希值列表
+        :return: None
+        """
+        if base_layer != 0:
+            return
+        # 内容相同的文件共享同一个根, 一次回复即可校验所有这些文件中对应的piece
+        for first_piece in self.metainfo.v2_roots.get(pieces_root, []):
+            width = self.metainfo.v2_pieces[first_piece][3]
+            piece_idx = first_piece + index // width
+            if (piece_idx >= len(self.metainfo.v2_pieces) or
+                    self.metainfo.v2_pieces[piece_idx][0] != pieces_root):
+                continue
+            _, first_leaf, expected_hash, width, _ = self.metainfo.v2_pieces[piece_idx]
+            if (index != first_leaf or len(hashes) < width or
+                    Merkle.merkle_root(hashes[:width], width) != expected_hash):
+                with self.exp_p_blocks_lock:
+                    self.hash_requests.discard(piece_idx)
+                continue
+            blocks = self.p_blocks[piece_idx]
+            if blocks is None:
+                continue
+            self.block_hashes[piece_idx] = hashes[:len(blocks)]
+            self._drop_bad_blocks(piece_idx)
+
+    def handle_hash_reject(self, pieces_root, index):
+        """
+        对端拒绝hash request时允许向其他peer重新请求
+        :param pieces_root: 文件的merkle根
+        :param index: 请求的第一个叶子的索引
+        :return: None
+        """
+        with self.exp_p_blocks_lock:
+            for first_piece in self.metainfo.v2_roots.get(pieces_root, []):
+                width = self.metainfo.v2_pieces[first_piece][3]
+                self.hash_requests.discard(first_piece + index // width)
+
+    def _drop_bad_blocks(self, piece_idx):
+        """
+        叶子哈希到达前已收到的block在此补做校验, 丢弃错误的block并记录来源的错误
+        :param piece_idx: piece索引
+        :return: None
+        """
+        blocks = self.p_blocks[piece_idx]
+        sources = self.p_block_sources.get(piece_idx)
+        for block_idx, block in enumerate(blocks):
+            if block is None or self._check_block(piece_idx, block_idx, block):
+                continue
+            blocks[block_idx] = None
+            self.p_numblocks[piece_idx] -= 1
+            if sources is not None and sources[block_idx] is not None:
+                self._add_strike(sources[block_idx])
+            self.handle_incorrect_pbi(piece_idx, block_idx)
+
+    def _attribute_corrupt_blocks(self, piece_idx):
+        """
+        比对失败时保存的blocks与正确的blocks, 对发送了不同数据的peer记录一次错误
+        :param piece_idx: piece索引
+        :return: None
+        """
+        with self.exp_p_blocks_lock:
+            failed_blocks, sources, tried = self.failed_pieces[piece_idx]
+            self._leave_single_peer_mode(piece_idx)
+        culprits = {sources[b_i] for b_i, block in enumerate(self.p_blocks[piece_idx])
+                    if failed_blocks[b_i] != block and sources[b_i] is not None}
+        # 单独重新下载失败的来源已经记录过错误
+        for ip in culprits - tried:
+            self._add_strike(ip)
 
     def _handle_incorrect_piece(self, piece_idx):
         """
-        处理不正确的piece
+        处理不正确的piece:
+        若所有block来自同一个ip则直接记录该ip的错误;
+        否则保存失败的数据, 并进入单peer模式由一个可信peer重新下载整个piece以找出来源.
+        单peer模式下再次失败时, 负责的peer已在上面记录错误, 改由其他peer重新下载
         :param piece_idx: piece索引
         :return: None
         """
+        sources = self.p_block_sources.pop(piece_idx, [])
+        contributors = {ip for ip in sources if ip is not None}
+        if len(contributors) == 1:
+            self._add_strike(next(iter(contributors)))
+        with self.exp_p_blocks_lock:
+            if piece_idx in self.failed_pieces:
+                self.failed_pieces[piece_idx][2].update(contributors)
+            elif len(contributors) > 1:
+                self.failed_pieces[piece_idx] = (self.p_blocks[piece_idx], sources, set())
+            if piece_idx in self.failed_pieces:
+                # 由新的可信peer重新下载
+                self.piece_owners[piece_idx] = None
+                self.single_peer_deadlines[piece_idx] = (time.monotonic() +
+                                                         SETTINGS['single_peer_timeout'])
         # 重置该piece块的block list
         self.p_blocks[piece_idx] = self._get_initial_blocks_list(piece_idx)
         # 同时重置该piece的未完成列表
@@ -0,0 +1,191 @@
+import bisect
+import hashlib
+import mmap
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import Bencode
+
+# 自动选择piece长度时的目标piece数量与上下限
+TARGET_PIECES_COUNT = 1500
+MIN_PIECE_LENGTH = 2 ** 14
+MAX_PIECE_LENGTH = 2 ** 24
+# 每个哈希任务处理的数据量, 过小时进程间通信开销占比高, 过大时负载不均
+TASK_SIZE = 2 ** 25
+
+
+def get_piece_length(total_length):
+    """
+    根据数据总长度选择piece长度: 使piece数量接近TARGET_PIECES_COUNT且为2的幂
+    :param total_length: 数据总长度
+    :return: piece长度
+    """
+    piece_length = MIN_PIECE_LENGTH
+    while piece_length < MAX_PIECE_LENGTH and total_length // piece_length > TARGET_PIECES_COUNT:
+        piece_length *= 2
+    return piece_length
+
+
+def collect_files(path):
+    """
+    遍历目录, 按路径排序以保证相同目录生成相同的info_hash
+    :param path: 文件或目录路径
+    :return: [(文件路径, 长度, 相对路径分段列表)], 单文件时相对路径分段列表为None
+    """
+    if os.path.isfile(path):
+        return [(path, os.path.getsize(path), None)]
+    files = []
+    for root, dirs, filenames in os.walk(path):
+        dirs.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.join(root, filename)
+            # 跳过符号链接等非普通文件
+            if not os.path.isfile(file_path) or os.path.islink(file_path):
+                continue
+            segments = os.path.relpath(file_path, path).split(os.sep)
+            files.append((file_path, os.path.getsize(file_path), segments))
+    return files
+
+
+def _hash_pieces(files, piece_length, begin, end):
+    """
+    在工作进程中计算[begin, end)范围内各piece的哈希值, 通过mmap读取以避免复制
+    :param files: 与该范围重叠的[(文件路径, 在数据中的偏移, 长度)]
+    :param piece_length: piece长度
+    :param begin: 起始偏移, 为piece长度的整数倍
+    :param end: 结束偏移
+    :return: 各piece的SHA1拼接而成的bytes
+    """
+    pieces = []
+    sha1 = hashlib.sha1()
+    filled = 0
+    for path, offset, length in files:
+        pos = max(begin, offset) - offset
+        stop = min(end, offset + length) - offset
+        if pos >= stop:
+            continue
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            view = memoryview(m)
+            try:
+                while pos < stop:
+                    # piece可能跨越多个文件, 不足一个piece时继续读取下一个文件
+                    n = min(piece_length - filled, stop - pos)
+                    sha1.update(view[pos: pos + n])
+                    pos += n
+                    filled += n
+                    if filled == piece_length:
+                        pieces.append(sha1.digest())
+                        sha1 = hashlib.sha1()
+                        filled = 0
+            finally:
+                view.release()
+    if filled:
+        pieces.append(sha1.digest())
+    return b''.join(pieces)
+
+
+def hash_files(files, piece_length, workers=None):
+    """
+    将数据按TASK_SIZE划分为多个任务, 由进程池并行计算piece哈希
+    :param files: collect_files()返回的文件列表
+    :param piece_length: piece长度
+    :param workers: 进程数量, None表示CPU核数
+    :return: 所有piece的SHA1拼接而成的bytes
+    """
+    # [(文件路径, 在数据中的偏移, 长度)], 空文件不占用数据
+    spans = []
+    offset = 0
+    for path, length, _ in files:
+        if length:
+            spans.append((path, offset, length))
+            offset += length
+    total_length = offset
+    offsets = [span[1] for span in spans]
+    task_length = max(1, TASK_SIZE // piece_length) * piece_length
+    tasks = []
+    for begin in range(0, total_length, task_length):
+        end = min(begin + task_length, total_length)
+        # 只传递与该范围重叠的文件, 减少传给工作进程的数据量
+        first = bisect.bisect_right(offsets, begin) - 1
+        last = bisect.bisect_left(offsets, end)
+        tasks.append((spans[first: last], piece_length, begin, end))
+    if len(tasks) <= 1 or workers == 1:
+        return b''.join(_hash_pieces(*task) for task in tasks)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return b''.join(executor.map(_hash_pieces, *zip(*tasks)))
+
+
+def sort_keys(value):
+    """
+    BEP 3要求字典的键按字节序排列, Bencode按字典的迭代顺序编码, 因此编码前递归排序
+    :param value: bencode对象
+    :return: 所有字典的键均已排序的bencode对象
+    """
+    if isinstance(value, dict):
+        return {key: sort_keys(value[key]) for key in sorted(value)}
+    if isinstance(value, list):
+        return [sort_keys(item) for item in value]
+    return value
+
+
+def make_torrent(path, announce_tiers=(), piece_length=None, comment=None, private=False,
+                 workers=None, url_list=()):
+    """
+    为文件或目录生成metainfo
+    :param path: 文件或目录路径
+    :param announce_tiers: BEP 12形式的tracker列表, [[tier0_url0, ...], ...]
+    :param piece_length: piece长度, None表示根据总长度自动选择
+    :param comment: 注释
+    :param private: 是否为私有torrent(BEP 27)
+    :param workers: 计算哈希的进程数量, None表示CPU核数
+    :param url_list: BEP 19 web seed的URL列表
+    :return: 键已按BEP 3排序的metainfo字典
+    """
+    path = os.path.normpath(path)
+    files = collect_files(path)
+    total_length = sum(length for _, length, _ in files)
+    if total_length == 0:
+        raise ValueError(f'"{path}" contains no data')
+    if piece_length is None:
+        piece_length = get_piece_length(total_length)
+    info = {
+        b'name': os.path.basename(os.path.abspath(path)).encode(),
+        b'piece length': piece_length,
+        b'pieces': hash_files(files, piece_length, workers)
+    }
+    if os.path.isfile(path):
+        info[b'length'] = total_length
+    else:
+        info[b'files'] = [{b'length': length,
+                           b'path': [segment.encode() for segment in segments]}
+                          for _, length, segments in files]
+    if private:
+        info[b'private'] = 1
+    meta_info = {b'info': info, b'creation date': int(time.time())}
+    announce_tiers = [tier for tier in announce_tiers if tier]
+    if announce_tiers:
+        meta_info[b'announce'] = announce_tiers[0][0].encode()
+        if len(announce_tiers) > 1 or len(announce_tiers[0]) > 1:
+            meta_info[b'announce-list'] = [[url.encode() for url in tier]
+                                           for tier in announce_tiers]
+    if url_list:
+        meta_info[b'url-list'] = [url.encode() for url in url_list]
+    if comment:
+        meta_info[b'comment'] = comment.encode()
+    return sort_keys(meta_info)
+
+
+def write_torrent(meta_info, filename):
+    """
+    :param meta_info: make_torrent()返回的metainfo
+    :param filename: 输出的torrent文件路径
+    :return: None
+    """
+    data = Bencode.encode(meta_info)
+    # 解码后按规范重新编码须得到相同的字节, 否则严格的客户端会拒绝该文件,
+    # 重新编码info的客户端也会得到不同的info_hash
+    if Bencode.encode(sort_keys(Bencode.decode(data))) != data:
+        raise ValueError('Metainfo is not canonically bencoded')
+    with open(filename, 'wb') as f:
+        f.write(data)
@@ -1,20 +1,75 @@
 import hashlib
 import os
+import math
+import random
+from collections.abc import Sequence
 import Bencode
+from Merkle import BLOCK_LEN, HASH_LEN, get_width, merkle_root, pad_hash
+
+
+class PieceHashes(Sequence):
+    """
+    v1的piece哈希序列: 保存拼接的原始bytes, 按索引访问时再切出20字节,
+    避免加载大量torrent时为每个piece创建一个bytes对象
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        """
+        :param data: info中pieces字段的原始bytes
+        """
+        self.data = data
+
+    def __len__(self):
+        return len(self.data) // 20
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('piece index out of range')
+        return self.data[idx * 20: idx * 20 + 20]
+
+    def __eq__(self, other):
+        if isinstance(other, PieceHashes):
+            return self.data == other.data
+        return list(self) == other
 
 
 class TorrentMetainfo:
-    def __init__(self, filename):
+    def __init__(self, filename=None):
+        """
+        :param filename: torrent文件路径, 为None时创建空对象, 由MetainfoCache从缓存中填充
+        """
         self.info_hash = None
         self.info_hash2str = None
         self.name = None
         self.length = None
         self.announce_list = []
+        # BEP 12: 按tier分组的announce列表, [[tier0_url0, ...], [tier1_url0, ...], ...]
+        self.announce_tiers = []
+        # 无tracker torrent中的DHT节点, [(host, port)]
+        self.nodes = []
+        # BEP 19: web seed的URL列表
+        self.url_list = []
         self.piece_length = None
         self.pieces = None
         self.is_single_file = True
         self.files = None
-        self._parse_torrent_file(filename)
+        # BEP 52: 1为v1 torrent, 2为v2或hybrid torrent
+        self.meta_version = 1
+        # hybrid torrent同时包含v1的pieces与v2的file tree
+        self.is_hybrid = False
+        # v2 info的完整SHA-256, 纯v2 torrent的info_hash为其前20字节
+        self.info_hash_v2 = None
+        # v2下每个piece的merkle信息, [(pieces_root, 首个叶子的索引, 期望哈希, 叶子层宽度, 数据长度)]
+        self.v2_pieces = None
+        # pieces_root到使用该根的各文件首个piece索引的映射, 内容相同的文件共享同一个根
+        self.v2_roots = None
+        if filename is not None:
+            self._parse_torrent_file(filename)
 
     def __str__(self):
         res = f"info_hash: {self.info_hash2str}\n" \
@@ -34,6 +89,9 @@ class TorrentMetainfo:
         :param piece_idx: piece索引
         :return: piece长度
         """
+        # 纯v2 torrent中每个文件从piece边界开始, 文件的最后一个piece不包含填充
+        if self.meta_version == 2 and not self.is_hybrid:
+            return self.v2_pieces[piece_idx][4]
         return (self.piece_length if piece_idx < len(self.pieces) - 1
                 else self.length - (len(self.pieces) - 1) * self.piece_length)
 
@@ -52,12 +110,34 @@ class TorrentMetainfo:
         # 储存info的哈希值
         self.info_hash = sha1_hash.digest()
         self.info_hash2str = sha1_hash.hexdigest()
-        # 获取并更新announce_list
-        self.announce_list.append(meta_info[b'announce'].decode())
+        self.meta_version = meta_info[b'info'].get(b'meta version', 1)
+        if self.meta_version == 2:
+            self.info_hash_v2 = hashlib.sha256(info).digest()
+            # 纯v2 torrent在握手、tracker与DHT中使用截断为20字节的SHA-256
+            if b'pieces' not in meta_info[b'info']:
+                self.info_hash = self.info_hash_v2[:20]
+                self.info_hash2str = self.info_hash.hex()
+        # 获取并更新announce_list, 无tracker的torrent可能不包含announce
+        if b'announce' in meta_info:
+            self.announce_list.append(meta_info[b'announce'].decode())
         # 如果metainfo中存在多个announce, 则逐个添加announce
         if b'announce-list' in meta_info:
             self._add_announces(meta_info[b'announce-list'])
+            self._init_announce_tiers(meta_info[b'announce-list'])
+        elif self.announce_list:
+            self.announce_tiers = [[self.announce_list[0]]]
+        # BEP 5: 无tracker torrent通过nodes提供DHT节点
+        for host, port in meta_info.get(b'nodes', []):
+            self.nodes.append((host.decode(), port))
+        # url-list可以是单个URL或URL列表
+        url_list = meta_info.get(b'url-list', [])
+        if isinstance(url_list, bytes):
+            url_list = [url_list]
+        self.url_list = [url.decode() for url in url_list
+                         if url.startswith((b'http://', b'https://'))]
         self._decode_info(meta_info[b'info'])
+        if self.meta_version == 2:
+            self._decode_v2_info(meta_info[b'info'], meta_info.get(b'piece layers', {}))
 
     def _add_announces(self, announces):
         """
@@ -70,9 +150,21 @@ class TorrentMetainfo:
             for bin_announce in cur_ann_list:
                 str_announce = bin_announce.decode()
                 # 避免重复添加相同的announce
-                if self.announce_list[0] != str_announce:
+                if str_announce not in self.announce_list:
                     self.announce_list.append(str_announce)
 
+    def _init_announce_tiers(self, announces):
+        """
+        按BEP 12初始化announce的tier列表, 每个tier内部随机打乱
+        :param announces: torrent文件中的announces-list
+        :return: None
+        """
+        for cur_ann_list in announces:
+            tier = [bin_announce.decode() for bin_announce in cur_ann_list]
+            if tier:
+                random.shuffle(tier)
+                self.announce_tiers.append(tier)
+
     def _decode_info(self, meta_info):
         """
         对meatainfo解码并初始化bitfields
@@ -83,9 +175,12 @@ class TorrentMetainfo:
         self.name = meta_info[b'name'].decode()
         # 设定piece长度
         self.piece_length = meta_info[b"piece length"]
-        # 依照每个pieces20字节长度进行切片
-        pieces = meta_info[b'pieces']
-        self.pieces = [pieces[i:i + 20] for i in range(0, len(pieces), 20)]
+        # 纯v2 torrent没有pieces, 由_decode_v2_info()解析file tree
+        if b'pieces' not in meta_info:
+            return
+        self.is_hybrid = self.meta_version == 2
+        # 依照每个pieces20字节长度进行切片, 访问时才切片
+        self.pieces = PieceHashes(meta_info[b'pieces'])
 
         # 如果该torrent文件拥有多个文件
         if b'files' in meta_info:
@@ -104,12 +199,84 @@ class TorrentMetainfo:
                 # 创建多文件的总路径
                 path_segments = [v.decode('utf-8') for v in file[b'path']]
                 # 更新多文件长度与路径
+                # BEP 47: attr中的p表示填充文件, 只用于对齐piece边界, 不写入磁盘
                 self.files.append({
                     'length': file[b'length'],
-                    'path': os.path.join(*path_segments)
+                    'path': os.path.join(*path_segments),
+                    'padding': b'p' in file.get(b'attr', b'')
                 })
             # 设定所有文件的总长度和
             self.length = sum(file['length'] for file in self.files)
         else:
             # 若为单个文件, 则仅设定其文件长度
             self.length = meta_info[b'length']
+
+    def _decode_v2_info(self, meta_info, piece_layers):
+        """
+        解析BEP 52的file tree与piece layers, 为每个piece记录merkle校验信息;
+        纯v2 torrent同时据此生成文件列表, 各文件之间以填充项对齐到piece边界
+        :param meta_info: info字典
+        :param piece_layers: metainfo中的piece layers, {pieces_root: 拼接的piece层哈希}
+        :return: None
+        """
+        v2_files = []
+        self._walk_file_tree(meta_info[b'file tree'], [], v2_files)
+        blocks_per_piece = self.piece_length // BLOCK_LEN
+        self.v2_pieces = []
+        self.v2_roots = {}
+        files = []
+        for segments, length, pieces_root in v2_files:
+            if length > 0:
+                pieces_count = math.ceil(length / self.piece_length)
+                self.v2_roots.setdefault(pieces_root, []).append(len(self.v2_pieces))
+                # 不超过一个piece的文件没有piece层, 其根即为该piece的期望哈希
+                if length > self.piece_length:
+                    layer = piece_layers.get(pieces_root, b'')
+                    layer = [layer[i: i + HASH_LEN] for i in range(0, len(layer), HASH_LEN)]
+                    if (len(layer) != pieces_count or
+                            merkle_root(layer, get_width(pieces_count),
+                                        pad_hash(blocks_per_piece)) != pieces_root):
+                        raise InvalidPieceLayers(os.path.join(*segments))
+                for i in range(pieces_count):
+                    data_len = min(self.piece_length, length - i * self.piece_length)
+                    if length > self.piece_length:
+                        self.v2_pieces.append((pieces_root, i * blocks_per_piece, layer[i],
+                                               blocks_per_piece, data_len))
+                    else:
+                        self.v2_pieces.append((pieces_root, 0, pieces_root,
+                                               get_width(math.ceil(length / BLOCK_LEN)), data_len))
+            if files and files[-1]['length'] % self.piece_length:
+                pad_len = self.piece_length - files[-1]['length'] % self.piece_length
+                files.append({'length': pad_len, 'path': os.path.join('.pad', str(pad_len)),
+                              'padding': True})
+            files.append({'length': length, 'path': os.path.join(*segments), 'padding': False})
+        # hybrid torrent沿用v1的文件列表与pieces
+        if self.is_hybrid:
+            return
+        self.pieces = [piece[2] for piece in self.v2_pieces]
+        self.length = sum(length for _, length, _ in v2_files)
+        if len(v2_files) == 1 and v2_files[0][0] == [self.name]:
+            self.is_single_file = True
+        else:
+            self.is_single_file = False
+            self.files = files
+
+    def _walk_file_tree(self, tree, segments, res):
+        """
+        按键的顺序深度优先遍历file tree, 键为空字符串的节点为文件
+        :param tree: file tree中的目录节点
+        :param segments: 当前目录的路径分段
+        :param res: 输出的[(路径分段列表, 文件长度, pieces_root)]
+        :return: None
+        """
+        for name, node in tree.items():
+            cur_segments = segments + [name.decode('utf-8')]
+            if b'' in node:
+                file = node[b'']
+                res.append((cur_segments, file[b'length'], file.get(b'pieces root')))
+            else:
+                self._walk_file_tree(node, cur_segments, res)
+
+
+class InvalidPieceLayers(Exception):
+    pass
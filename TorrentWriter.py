@@ -1,10 +1,100 @@
+import bisect
 import os
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from queue import Queue
+from threading import Lock
+from threading import Thread
+
+import Tracing
+from Config import SETTINGS
+from Metrics import DISK_BUCKETS, get_metrics
+
+
+class DiskWriter:
+    """
+    多个torrent共享的磁盘写入线程, 使用有界队列在磁盘跟不上时阻塞下载线程
+    """
+
+    def __init__(self, queue_size=None):
+        self.queue = Queue(SETTINGS['disk_queue_size'] if queue_size is None else queue_size)
+        self._thread = None
+        metrics = get_metrics()
+        self.write_latency = metrics.histogram('bt_disk_write_seconds', 'piece write latency',
+                                               DISK_BUCKETS)
+        metrics.gauge('bt_disk_queue_pieces', 'pieces waiting to be written',
+                      func=self.queue.qsize)
+
+    def start(self):
+        """
+        启动写入线程
+        :return: None
+        """
+        if self._thread is None:
+            self._thread = Thread(target=self._write_always, daemon=True)
+            self._thread.start()
+
+    def submit(self, writer, piece_idx, piece):
+        """
+        提交一个已校验的piece等待写入
+        :param writer: 该piece所属torrent的TorrentWriter
+        :param piece_idx: piece的索引
+        :param piece: piece数据（字节类型）
+        :return: None
+        """
+        self.queue.put((writer, piece_idx, piece))
+
+    def flush(self):
+        """
+        等待队列中所有piece写入完成
+        :return: None
+        """
+        self.queue.join()
+
+    def _write_always(self):
+        """
+        写入线程: 依次将队列中的piece写入磁盘
+        :return: None
+        """
+        while True:
+            writer, piece_idx, piece = self.queue.get()
+            try:
+                with Tracing.span('write', 'disk', piece=piece_idx):
+                    start_time = time.perf_counter()
+                    writer.write_piece(piece_idx, piece)
+                    self.write_latency.observe(time.perf_counter() - start_time)
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+            finally:
+                self.queue.task_done()
+
+
+# 文件分配策略: sparse只设置文件长度, full预先分配全部磁盘块以减少碎片, lazy在首次写入时才创建文件
+ALLOCATION_STRATEGIES = ('sparse', 'full', 'lazy')
 
 
 class TorrentWriter:
-    def __init__(self, metainfo):
+    def __init__(self, metainfo, allocation=None):
+        """
+        :param metainfo: torrent的metainfo
+        :param allocation: 文件分配策略, None表示SETTINGS['file_allocation']
+        """
         self.metainfo = metainfo
+        self.allocation = SETTINGS['file_allocation'] if allocation is None else allocation
+        if self.allocation not in ALLOCATION_STRATEGIES:
+            raise ValueError(f'Unknown allocation strategy "{self.allocation}"')
         self._downloads_dir = os.path.join(os.getcwd(), 'downloads')
+        # 多文件torrent中各文件在数据中的起始偏移, 用于将piece映射到文件
+        self.file_offsets = []
+        if not metainfo.is_single_file:
+            offset = 0
+            for file in metainfo.files:
+                self.file_offsets.append(offset)
+                offset += file['length']
+        # 已写入磁盘、可以从磁盘读取的piece
+        self.written_pieces = set()
         self.check_place_to_download()
 
     @property
@@ -54,6 +144,33 @@ class TorrentWriter:
         if not os.path.exists(path_to_place):
             self.create_place_to_download()
 
+    def _get_file_ranges(self, piece_idx, piece_len):
+        """
+        将piece映射到各文件
+        :param piece_idx: piece的索引
+        :param piece_len: piece长度
+        :return: [(文件路径, 文件内偏移, piece内偏移, 长度)], 填充文件的路径为None
+        """
+        piece_offset_in_data = piece_idx * self.metainfo.piece_length
+        if self.metainfo.is_single_file:
+            return [(os.path.join(self.downloads_dir, self.metainfo.name),
+                     piece_offset_in_data, 0, piece_len)]
+        res = []
+        file_idx = bisect.bisect_right(self.file_offsets, piece_offset_in_data) - 1
+        offset_in_piece = 0
+        while offset_in_piece < piece_len:
+            file_dict = self.metainfo.files[file_idx]
+            offset_in_file = piece_offset_in_data + offset_in_piece - self.file_offsets[file_idx]
+            data_len = min(piece_len - offset_in_piece, file_dict['length'] - offset_in_file)
+            # 跳过空文件
+            if data_len > 0:
+                full_path = None if file_dict.get('padding') else os.path.join(
+                    self.downloads_dir, self.metainfo.name, file_dict['path'])
+                res.append((full_path, offset_in_file, offset_in_piece, data_len))
+                offset_in_piece += data_len
+            file_idx += 1
+        return res
+
     def write_piece(self, piece_idx, piece):
         """
         对于可获取的piece进行写入
@@ -61,51 +178,49 @@ class TorrentWriter:
         :param piece: piece数据（字节类型）
         :return: None
         """
-        piece_offset_in_data = piece_idx * self.metainfo.piece_length
-        if self.metainfo.is_single_file:
-            self._write_data_in_single_file(
-                os.path.join(self.downloads_dir, self.metainfo.name),
-                piece_offset_in_data, 0, len(piece), piece)
-        else:
-            file_offset_in_data = 0
-            file_idx = -1
-            next_offset = 0
-            while next_offset <= piece_offset_in_data:
-                file_idx += 1
-                file_offset_in_data = next_offset
-                next_offset += self.metainfo.files[file_idx]['length']
-
-            offset_in_piece = 0
-            while offset_in_piece != len(piece):
-                offset_in_file = 0
-                file_len = self.metainfo.files[file_idx]['length']
-                file_path = self.metainfo.files[file_idx]['path']
-                full_path = os.path.join(
-                    self.downloads_dir, self.metainfo.name, file_path)
-                if file_offset_in_data < piece_offset_in_data:
-                    offset_in_file = piece_offset_in_data - file_offset_in_data
-                    data_len = min(len(piece), file_len - offset_in_file)
-                else:
-                    data_len = min(file_len, len(piece) - offset_in_piece)
-
-                self._write_data_in_single_file(
-                    full_path, offset_in_file, offset_in_piece,
-                    data_len, piece)
-                offset_in_piece += data_len
-                file_offset_in_data += file_len
-                file_idx += 1
+        for file_path, offset_in_file, offset_in_piece, data_len in self._get_file_ranges(
+                piece_idx, len(piece)):
+            # 填充文件只用于对齐piece边界, 其数据不写入磁盘
+            if file_path is not None:
+                self._write_data_in_single_file(file_path, offset_in_file, offset_in_piece,
+                                                data_len, piece)
+        self.written_pieces.add(piece_idx)
+
+    def read_piece(self, piece_idx):
+        """
+        从磁盘读取已写入的piece
+        :param piece_idx: piece的索引
+        :return: piece数据（字节类型）
+        """
+        piece = bytearray(self.metainfo.get_piece_len_at(piece_idx))
+        view = memoryview(piece)
+        for file_path, offset_in_file, offset_in_piece, data_len in self._get_file_ranges(
+                piece_idx, len(piece)):
+            # 填充文件的数据全为0
+            if file_path is None:
+                continue
+            with open(file_path, 'rb') as f:
+                f.seek(offset_in_file)
+                f.readinto(view[offset_in_piece: offset_in_piece + data_len])
+        return bytes(piece)
 
     @staticmethod
     def _write_data_in_single_file(file_path, offset_in_file, offset_in_piece, data_len, piece):
         '''
-        依据路径写入对应数据
+        依据路径写入对应数据, lazy策略下文件与目录在首次写入时创建
         :param offset_in_file: 写入数据位于文件中的位置
         :param offset_in_piece: 写入数据位于piece中的位置
         :return: None
         '''
-        with open(file_path, 'r+b') as f:
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        try:
+            fd = os.open(file_path, flags, 0o666)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            fd = os.open(file_path, flags, 0o666)
+        with open(fd, 'r+b') as f:
             f.seek(offset_in_file)
-            f.write(piece[offset_in_piece: offset_in_piece + data_len])
+            f.write(memoryview(piece)[offset_in_piece: offset_in_piece + data_len])
 
     def create_place_to_download(self):
         """
@@ -118,16 +233,23 @@ class TorrentWriter:
         else:
             self._create_empty_files()
 
-    def _create_single_empty_file(self, file_path, length):
+    def _create_single_empty_file(self, file_path, length, created_dirs=None):
         """
         对于单个空文件定义其路径与长度
         :param file_path: 文件路径
         :param length: 文件长度
+        :param created_dirs: 已创建的目录集合, 大量小文件时避免重复调用makedirs
         :return: None
         """
         full_path = os.path.join(self.downloads_dir, file_path)
+        # lazy策略下非空文件及其目录在首次写入时创建, 空文件不会被写入, 需要立即创建
+        if self.allocation == 'lazy' and length > 0:
+            return
         dirs_path, _ = os.path.split(full_path)
-        os.makedirs(dirs_path, exist_ok=True)
+        if created_dirs is None or dirs_path not in created_dirs:
+            os.makedirs(dirs_path, exist_ok=True)
+            if created_dirs is not None:
+                created_dirs.add(dirs_path)
         self._create_empty_file(full_path, length)
 
     def _create_empty_files(self):
@@ -136,21 +258,133 @@ class TorrentWriter:
         :return: None
         """
         base_dir = self.metainfo.name
+        created_dirs = set()
         # 从metainfo遍历文件再创建空文件
         for file_dict in self.metainfo.files:
+            if file_dict.get('padding'):
+                continue
             # 指定创建文件目录
             file_path = os.path.join(base_dir, file_dict['path'])
             # 调用单个空文件创建函数
-            self._create_single_empty_file(file_path, file_dict['length'])
+            self._create_single_empty_file(file_path, file_dict['length'], created_dirs)
+        # lazy策略下也创建顶层目录, 使check_place_to_download()不会重复创建
+        os.makedirs(os.path.join(self.downloads_dir, base_dir), exist_ok=True)
 
-    @staticmethod
-    def _create_empty_file(file_path, length):
+    def _create_empty_file(self, file_path, length):
+        """
+        按分配策略创建指定长度的文件: sparse通过ftruncate设置长度而不分配磁盘块,
+        full通过posix_fallocate一次分配全部磁盘块, 使随机到达的piece不会造成碎片
+        (不支持posix_fallocate的平台或文件系统退化为sparse)
+        :param file_path: 文件路径
+        :param length: 文件长度, 可以为0
+        :return: None
         """
-        空文件创建.使用\x00覆盖
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0),
+                     0o666)
+        try:
+            if length == 0:
+                return
+            if self.allocation == 'full' and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fd, 0, length)
+                    return
+                except OSError:
+                    pass
+            os.ftruncate(fd, length)
+        finally:
+            os.close(fd)
+
+
+class PieceCache:
+    """
+    多个torrent共享的piece读缓存, 按字节数上限以LRU淘汰:
+    上传时请求某个block会读取整个piece, 同一piece的其他block(常被多个peer请求)直接命中;
+    刚校验完成的piece在写入磁盘前即放入缓存
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = SETTINGS['read_cache_size'] if max_bytes is None else max_bytes
+        # {(info_hash, piece_idx): piece}, 按最近使用的顺序排列
+        self.pieces = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        metrics = get_metrics()
+        self.hits = metrics.counter('bt_read_cache_hits_total', 'block reads served from the cache')
+        self.misses = metrics.counter('bt_read_cache_misses_total',
+                                      'block reads that had to read the piece from disk')
+        self.evictions = metrics.counter('bt_read_cache_evictions_total',
+                                         'pieces evicted from the read cache')
+        metrics.gauge('bt_read_cache_bytes', 'bytes held by the read cache', func=lambda: self.size)
+
+    def insert(self, writer, piece_idx, piece):
         """
-        # 创建用于写入的二进制文件
-        with open(file_path, 'wb') as f:
-            # 文件末尾
-            f.seek(length - 1)
-            # 用0值覆盖
-            f.write(b'\x00')  
+        放入一个完整的piece, 超出上限时淘汰最久未使用的piece
+        :param writer: 该piece所属torrent的TorrentWriter
+        :param piece_idx: piece的索引
+        :param piece: piece数据（字节类型）
+        :return: None
+        """
+        if len(piece) > self.max_bytes:
+            return
+        key = (writer.metainfo.info_hash, piece_idx)
+        with self.lock:
+            old_piece = self.pieces.pop(key, None)
+            if old_piece is not None:
+                self.size -= len(old_piece)
+            self.pieces[key] = piece
+            self.size += len(piece)
+            while self.size > self.max_bytes:
+                _, evicted = self.pieces.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions.inc()
+
+    def read_block(self, writer, piece_idx, offset, length):
+        """
+        读取一个block, 未命中时从磁盘读取整个piece并放入缓存
+        :param writer: 该piece所属torrent的TorrentWriter
+        :param piece_idx: piece的索引
+        :param offset: block在piece中的偏移
+        :param length: block长度
+        :return: block数据, 该piece既不在缓存中也未写入磁盘时返回None
+        """
+        key = (writer.metainfo.info_hash, piece_idx)
+        with self.lock:
+            piece = self.pieces.get(key)
+            if piece is not None:
+                self.pieces.move_to_end(key)
+        if piece is not None:
+            self.hits.inc()
+            return piece[offset: offset + length]
+        if piece_idx not in writer.written_pieces:
+            return None
+        self.misses.inc()
+        with Tracing.span('read', 'disk', piece=piece_idx):
+            piece = writer.read_piece(piece_idx)
+        self.insert(writer, piece_idx, piece)
+        return piece[offset: offset + length]
+
+    def discard(self, writer):
+        """
+        移除某个torrent的所有piece
+        :param writer: 该torrent的TorrentWriter
+        :return: None
+        """
+        info_hash = writer.metainfo.info_hash
+        with self.lock:
+            for key in [key for key in self.pieces if key[0] == info_hash]:
+                self.size -= len(self.pieces.pop(key))
+
+
+_read_cache = None
+_read_cache_lock = Lock()
+
+
+def get_read_cache():
+    """
+    :return: 进程内共享的PieceCache
+    """
+    global _read_cache
+    with _read_cache_lock:
+        if _read_cache is None:
+            _read_cache = PieceCache()
+        return _read_cache
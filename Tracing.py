@@ -0,0 +1,168 @@
+import json
+import os
+import time
+from collections import deque
+from threading import current_thread
+from threading import get_ident
+
+from Config import SETTINGS
+
+# 未启用时span()直接返回空操作对象, 热路径上只有一次全局变量判断
+_enabled = False
+# Chrome trace事件, deque的append是线程安全的
+_events = deque(maxlen=SETTINGS['trace_max_events'])
+# 已输出thread_name元数据的线程
+_named_threads = set()
+_pid = os.getpid()
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    记录一个阶段的耗时, 退出时生成Chrome trace的complete('X')事件
+    """
+    __slots__ = ('name', 'cat', 'args', 'start')
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        _add_event({'name': self.name, 'cat': self.cat, 'ph': 'X',
+                    'ts': self.start / 1000, 'dur': (end - self.start) / 1000,
+                    'args': self.args})
+        return False
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable():
+    """
+    开始记录trace事件
+    :return: None
+    """
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """
+    停止记录trace事件, 已记录的事件保留至dump()
+    :return: None
+    """
+    global _enabled
+    _enabled = False
+
+
+def span(name, cat, **args):
+    """
+    用法: with span('request', 'peer', piece=1, block=0): ...
+    :param name: 阶段名
+    :param cat: 分类, 如'peer', 'piece', 'disk'
+    :param args: 附加在事件上的参数, 如peer名与piece索引
+    :return: 上下文管理器, 未启用时为空操作对象
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, cat, args)
+
+
+def instant(name, cat, **args):
+    """
+    记录一个瞬时事件, 如收到choke
+    :param name: 事件名
+    :param cat: 分类
+    :param args: 附加参数
+    :return: None
+    """
+    if not _enabled:
+        return
+    _add_event({'name': name, 'cat': cat, 'ph': 'i', 's': 't',
+                'ts': time.perf_counter_ns() / 1000, 'args': args})
+
+
+def begin_async(name, cat, event_id, **args):
+    """
+    开始一个跨线程的异步事件, 如一个piece从收到第一个block到校验完成
+    :param name: 事件名
+    :param cat: 分类
+    :param event_id: 用于配对begin与end的id
+    :param args: 附加参数
+    :return: None
+    """
+    if not _enabled:
+        return
+    _add_event({'name': name, 'cat': cat, 'ph': 'b', 'id': event_id,
+                'ts': time.perf_counter_ns() / 1000, 'args': args})
+
+
+def end_async(name, cat, event_id, **args):
+    """
+    结束begin_async()开始的异步事件
+    :param name: 事件名
+    :param cat: 分类
+    :param event_id: 与begin_async()相同的id
+    :param args: 附加参数
+    :return: None
+    """
+    if not _enabled:
+        return
+    _add_event({'name': name, 'cat': cat, 'ph': 'e', 'id': event_id,
+                'ts': time.perf_counter_ns() / 1000, 'args': args})
+
+
+def _add_event(event):
+    """
+    补充进程与线程信息并保存事件, 每个线程首次出现时记录线程名(peer线程即对应单个peer)
+    :param event: trace事件
+    :return: None
+    """
+    tid = get_ident()
+    event['pid'] = _pid
+    event['tid'] = tid
+    if tid not in _named_threads:
+        _named_threads.add(tid)
+        _events.append({'name': 'thread_name', 'ph': 'M', 'pid': _pid, 'tid': tid,
+                        'args': {'name': current_thread().name}})
+    _events.append(event)
+
+
+def dump(path):
+    """
+    以Chrome trace/Perfetto可读取的JSON格式写出已记录的事件并清空缓存
+    :param path: 输出文件路径
+    :return: 写出的事件数量
+    """
+    events = []
+    while _events:
+        try:
+            events.append(_events.popleft())
+        except IndexError:
+            break
+    _named_threads.clear()
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return len(events)
@@ -1,49 +1,529 @@
-import re
+import random
 import socket
 import struct
 import sys
+import time
 import traceback
+from queue import Queue
+from threading import Event
+from threading import Lock
+from threading import Thread
+from urllib.parse import urlsplit
 import requests
 
 import Bencode
 from Config import SETTINGS
 
-# 判断当前announce url链接是否为UDP格式
-UDP_REGEX = re.compile(r'udp://[(\[]?(.+?)[)\]]?:([\d]{1,5})(?![\d:])')
 
+class TrackerStats:
+    """单个tracker的历史统计信息, 用于下一轮announce时对tier内的tracker排序"""
 
-def get_peers_list_by_torrent_metainfo(metainfo):
+    # 平滑延迟时新样本所占的权重
+    latency_weight = 0.3
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.latency = None
+
+    def record_success(self, latency):
+        """
+        记录一次成功的announce
+        :param latency: 本次announce耗时(秒)
+        :return: None
+        """
+        self.successes += 1
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.latency_weight * (latency - self.latency)
+
+    def record_failure(self):
+        """
+        记录一次失败的announce
+        :return: None
+        """
+        self.failures += 1
+
+    @property
+    def success_rate(self):
+        """
+        :return: 经过平滑的成功率, 未知tracker为0.5
+        """
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    @property
+    def sort_key(self):
+        """
+        :return: 成功率高、延迟低的tracker排在前面
+        """
+        latency = SETTINGS['timeout'] if self.latency is None else self.latency
+        return -self.success_rate, latency
+
+    def __str__(self):
+        return f'ok={self.successes} fail={self.failures} latency={self.latency}'
+
+
+# 所有torrent共享的tracker统计信息, 以announce url为键
+_tracker_stats = {}
+_tracker_stats_lock = Lock()
+
+
+def get_tracker_stats(announce):
     """
-    通过metainfo信息，获取http或者udp的peer列表
-    :param metainfo: metainfo
-    :return: [(ip,port)]的元组列表
+    获取announce对应的统计信息, 不存在则创建
+    :param announce: announce url链接
+    :return: TrackerStats对象
     """
-    for announce in metainfo.announce_list:
-        try:
+    with _tracker_stats_lock:
+        if announce not in _tracker_stats:
+            _tracker_stats[announce] = TrackerStats()
+        return _tracker_stats[announce]
+
+
+class AnnounceResponse:
+    """单次announce的解析结果"""
+
+    def __init__(self, peers, interval=None, min_interval=None,
+                 tracker_id=None, complete=None, incomplete=None):
+        self.peers = peers
+        self.interval = interval
+        self.min_interval = min_interval
+        self.tracker_id = tracker_id
+        self.complete = complete
+        self.incomplete = incomplete
+
+
+class TrackerState:
+    """TrackerClient中单个tracker的announce状态"""
+
+    def __init__(self, announce):
+        self.announce = announce
+        self.interval = SETTINGS['announce_interval']
+        self.min_interval = SETTINGS['min_announce_interval']
+        # 以time.monotonic()计的上次announce时间与下次计划announce时间
+        self.last_announce = None
+        self.next_announce = 0
+        self.tracker_id = None
+        self.is_started = False
+        self.failures = 0
+        self.peers = []
+        self.complete = None
+        self.incomplete = None
+
+    def can_announce(self, now):
+        """
+        :param now: 当前时间
+        :return: 距离上次announce是否已超过min interval
+        """
+        return (self.last_announce is None or
+                now - self.last_announce >= self.min_interval)
+
+    def handle_response(self, response, now):
+        """
+        根据tracker的响应更新状态与下次announce时间
+        :param response: AnnounceResponse对象
+        :param now: 当前时间
+        :return: None
+        """
+        self.failures = 0
+        self.last_announce = now
+        if response.interval:
+            self.interval = response.interval
+        if response.min_interval:
+            self.min_interval = response.min_interval
+        if response.tracker_id is not None:
+            self.tracker_id = response.tracker_id
+        self.complete = response.complete
+        self.incomplete = response.incomplete
+        self.peers = response.peers
+        self.next_announce = now + self.interval
+
+    def handle_failure(self, now):
+        """
+        announce失败时按指数退避推迟下次announce
+        :param now: 当前时间
+        :return: None
+        """
+        self.failures += 1
+        self.last_announce = now
+        self.next_announce = now + min(self.min_interval * 2 ** (self.failures - 1),
+                                       self.interval)
+
+
+class TrackerClient:
+    """
+    每个torrent持有的tracker客户端:
+    复用HTTP连接池, 上报started/completed/stopped事件与真实的上传下载量,
+    并在后台按tracker给出的interval重新announce
+    """
+
+    # 事件在UDP协议中的编号
+    udp_events = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+    def __init__(self, torrent):
+        self.torrent = torrent
+        self.metainfo = torrent.metainfo
+        self.session = requests.Session()
+        self.trackers = {}
+        # 该客户端自己的tier列表(TrackerState), 不修改metainfo中共享的announce_tiers;
+        # tier内先按历史统计排序, 之后成功的tracker被移到tier的最前面(BEP 12)
+        self.tiers = []
+        self.tiers_lock = Lock()
+        for tier in self.metainfo.announce_tiers:
+            states = []
+            for announce in sorted(tier, key=lambda cur_announce:
+                                   get_tracker_stats(cur_announce).sort_key):
+                if _get_announce_method(announce) is None or announce in self.trackers:
+                    continue
+                self.trackers[announce] = TrackerState(announce)
+                states.append(self.trackers[announce])
+            if states:
+                self.tiers.append(states)
+        self.on_peers = None
+        self._stop_event = Event()
+        self._thread = None
+
+    def start(self, on_peers=None):
+        """
+        启动后台re-announce线程
+        :param on_peers: 后台announce得到新peer时的回调
+        :return: None
+        """
+        self.on_peers = on_peers
+        if self._thread is None:
+            # 每次启动使用新的Event, 暂停后重新启动时不会唤醒旧线程
+            self._stop_event = Event()
+            self._thread = Thread(target=self._announce_always, args=(self._stop_event,),
+                                  daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        停止后台线程并向已started的tracker发送stopped事件, 之后可再次start()
+        :return: None
+        """
+        self._stop_event.set()
+        self._thread = None
+        started = [state for state in self.trackers.values() if state.is_started]
+        if started:
+            self._announce_trackers(started, event='stopped')
+        self.session.close()
+
+    def completed(self):
+        """
+        下载完成时向已started的tracker发送completed事件
+        :return: None
+        """
+        started = [state for state in self.trackers.values() if state.is_started]
+        Thread(target=self._announce_trackers, args=(started, 'completed', self.on_peers),
+               daemon=True).start()
+
+    def get_peers(self, on_peers=None):
+        """
+        补充peer: 仅向已超过min interval的tracker重新announce,
+        其余tracker直接返回上次缓存的peer, 避免频繁请求tracker
+        :param on_peers: 每个tracker返回新peer时的回调
+        :return: [(ip,port)]的元组列表
+        """
+        now = time.monotonic()
+        due = [state for state in self._ordered_trackers() if state.can_announce(now)]
+        cached = []
+        for state in self.trackers.values():
+            if state not in due:
+                cached.extend(state.peers)
+        if cached and on_peers is not None:
+            on_peers(cached)
+        peers = self._announce_trackers(due, on_peers=on_peers) if due else []
+        if not peers and not cached:
+            raise PeersFindingError('Could not find peers!')
+        return cached + peers
+
+    def scrape(self):
+        """
+        向所有支持scrape的tracker并发请求当前torrent的统计信息
+        :return: {announce: {'complete': int, 'downloaded': int, 'incomplete': int}}
+        """
+        jobs = []
+        for announce in self.trackers:
             if announce.startswith('http'):
-                get_method = _get_peers_from_http_tracker
-            elif announce.startswith('udp'):
-                get_method = _get_peers_from_udp_tracker
+                if _get_scrape_url(announce) is None:
+                    continue
+                jobs.append((announce, self._scrape_http, (announce,)))
             else:
+                jobs.append((announce, _udp_scrape, (announce, self.metainfo)))
+        results = Queue()
+        for announce, method, args in jobs:
+            Thread(target=_scrape_worker, args=(announce, method, args, results),
+                   daemon=True).start()
+        res = {}
+        for _ in jobs:
+            announce, scrape_info = results.get()
+            if scrape_info is not None:
+                res[announce] = scrape_info
+        return res
+
+    def _scrape_http(self, announce):
+        """
+        向HTTP tracker发送scrape请求
+        :param announce: HTTP announce的url链接
+        :return: 统计信息字典
+        """
+        response = self.session.get(_get_scrape_url(announce),
+                                    {'info_hash': self.metainfo.info_hash},
+                                    timeout=SETTINGS['timeout'])
+        files = Bencode.decode(response.content)[b'files']
+        info = files[self.metainfo.info_hash]
+        return {'complete': info[b'complete'],
+                'downloaded': info[b'downloaded'],
+                'incomplete': info[b'incomplete']}
+
+    def _ordered_trackers(self):
+        """
+        :return: 按tier顺序及历史统计排序后的tracker状态列表
+        """
+        with self.tiers_lock:
+            return [state for tier in self.tiers for state in tier]
+
+    def _announce_always(self, stop_event):
+        """
+        后台线程: 等待到最近的计划时间后向到期的tracker重新announce
+        :param stop_event: 该线程的停止信号
+        :return: None
+        """
+        while not stop_event.is_set():
+            now = time.monotonic()
+            due = [state for state in self._ordered_trackers()
+                   if state.next_announce <= now]
+            if due:
+                self._announce_trackers(due, on_peers=self.on_peers)
                 continue
-            return get_method(announce, metainfo)
+            next_time = min((state.next_announce for state in self.trackers.values()),
+                            default=now + SETTINGS['announce_interval'])
+            stop_event.wait(max(next_time - now, 1))
+
+    def _announce_trackers(self, states, event=None, on_peers=None):
+        """
+        各tier并发地announce, tier内按顺序逐个尝试给定的tracker, 直到有一个成功;
+        未started的tracker自动带上started事件, stopped事件则发送给每个已started的tracker
+        :param states: TrackerState列表
+        :param event: 'completed', 'stopped'或None
+        :param on_peers: 每个tier返回新peer时的回调
+        :return: 合并去重后的[(ip,port)]列表
+        """
+        selected = set(states)
+        with self.tiers_lock:
+            groups = [[state for state in tier if state in selected] for tier in self.tiers]
+        if event == 'stopped':
+            groups = [[state] for group in groups for state in group]
+        tiers = []
+        for group in groups:
+            jobs = []
+            for state in group:
+                cur_event = event
+                if cur_event is None and not state.is_started:
+                    cur_event = 'started'
+                jobs.append((state.announce, self._announce_one, (state, cur_event)))
+            if jobs:
+                tiers.append(jobs)
+        try:
+            return _announce_concurrently(tiers, on_peers)
+        except PeersFindingError:
+            return []
+
+    def _promote(self, state):
+        """
+        BEP 12: 将成功响应的tracker移到其tier的最前面;
+        tier内的其他tracker只作为备用, 跟随该tracker的announce时间, 不单独announce
+        :param state: 成功响应的TrackerState
+        :return: None
+        """
+        with self.tiers_lock:
+            for tier in self.tiers:
+                if state not in tier:
+                    continue
+                tier.remove(state)
+                tier.insert(0, state)
+                for other in tier[1:]:
+                    other.last_announce = state.last_announce
+                    other.next_announce = state.next_announce
+                return
+
+    def _announce_one(self, state, event):
+        """
+        向单个tracker发送announce并更新其状态
+        :param state: TrackerState对象
+        :param event: 事件名称
+        :return: AnnounceResponse对象
+        """
+        announce_args = {
+            'uploaded': self.torrent.uploaded,
+            'downloaded': self.torrent.downloaded,
+            'left': self.torrent.left,
+            'event': event,
+            'tracker_id': state.tracker_id
+        }
+        try:
+            if state.announce.startswith('http'):
+                response = _http_announce(self.session, state.announce,
+                                          self.metainfo, **announce_args)
+            else:
+                announce_args['event'] = self.udp_events[event]
+                response = _udp_announce(state.announce, self.metainfo, **announce_args)
         except Exception:
-            traceback.print_exc(file=sys.stdout)
+            state.handle_failure(time.monotonic())
+            raise
+        state.handle_response(response, time.monotonic())
+        if event != 'stopped':
+            self._promote(state)
+        if event == 'started':
+            state.is_started = True
+        elif event == 'stopped':
+            state.is_started = False
+        return response
+
+
+def get_peers_list_by_torrent_metainfo(metainfo, on_peers=None):
+    """
+    各tier并发地announce, tier内按历史统计排序后逐个尝试(BEP 12), 合并去重所有结果
+    :param metainfo: metainfo
+    :param on_peers: 可选的回调, 每当有新的peer到达时以[(ip,port)]调用
+    :return: [(ip,port)]的元组列表
+    """
+    tiers = []
+    for tier in metainfo.announce_tiers:
+        # 依据上一轮的统计信息对tier内的tracker排序(稳定排序), 排序副本而不修改metainfo
+        jobs = []
+        for announce in sorted(tier, key=lambda cur_announce:
+                               get_tracker_stats(cur_announce).sort_key):
+            get_method = _get_announce_method(announce)
+            if get_method is None:
+                continue
+            jobs.append((announce, get_method, (announce, metainfo)))
+        if jobs:
+            tiers.append(jobs)
+    return _announce_concurrently(tiers, on_peers)
+
+
+def _announce_concurrently(tiers, on_peers=None):
+    """
+    每个tier一个线程并发执行announce, 按到达顺序合并去重结果.
+    与BEP 12逐个tier尝试不同, 所有tier同时announce以尽快得到peer
+    :param tiers: [[(announce, 请求函数, 参数元组), ...], ...], tier内按尝试顺序排列
+    :param on_peers: 可选的回调, 每当有新的peer到达时以[(ip,port)]调用
+    :return: [(ip,port)]的元组列表
+    """
+    results = Queue()
+    for jobs in tiers:
+        Thread(target=_announce_tier_worker, args=(jobs, results), daemon=True).start()
+
+    peers = []
+    seen_peers = set()
+    is_found = False
+    for _ in tiers:
+        peers_from_tracker = results.get()
+        if peers_from_tracker is None:
             continue
-    raise PeersFindingError('Could not find peers!')
+        is_found = True
+        new_peers = [peer for peer in peers_from_tracker if peer not in seen_peers]
+        seen_peers.update(new_peers)
+        peers.extend(new_peers)
+        if new_peers and on_peers is not None:
+            on_peers(new_peers)
+    if not is_found:
+        raise PeersFindingError('Could not find peers!')
+    return peers
+
+
+def _get_announce_method(announce):
+    """
+    根据announce url的协议选择请求方法
+    :param announce: announce url链接
+    :return: 请求函数, 不支持的协议返回None
+    """
+    if announce.startswith('http'):
+        return _get_peers_from_http_tracker
+    elif announce.startswith('udp'):
+        return _get_peers_from_udp_tracker
+    return None
+
+
+def _announce_tier_worker(jobs, results):
+    """
+    在独立线程中按顺序尝试一个tier内的tracker, 直到有一个成功
+    :param jobs: [(announce, 请求函数, 参数元组)]列表
+    :param results: 结果队列, 放入成功tracker的peer列表, 全部失败时放入None
+    :return: None
+    """
+    for announce, method, args in jobs:
+        peers = _announce_one_tracker(announce, method, args)
+        if peers is not None:
+            results.put(peers)
+            return
+    results.put(None)
+
+
+def _announce_one_tracker(announce, method, args):
+    """
+    向单个tracker发送announce, 并记录延迟与成功率
+    :param announce: announce url链接
+    :param method: 请求函数, 返回peer列表或AnnounceResponse
+    :param args: 请求函数的参数元组
+    :return: peer列表, 失败时返回None
+    """
+    stats = get_tracker_stats(announce)
+    start_time = time.monotonic()
+    try:
+        peers = method(*args)
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        with _tracker_stats_lock:
+            stats.record_failure()
+        return None
+    with _tracker_stats_lock:
+        stats.record_success(time.monotonic() - start_time)
+    if isinstance(peers, AnnounceResponse):
+        peers = peers.peers
+    return peers
+
+
+def _scrape_worker(announce, method, args, results):
+    """
+    在独立线程中向单个tracker发送scrape
+    :param announce: announce url链接
+    :param method: scrape函数
+    :param args: scrape函数的参数元组
+    :param results: 结果队列, 失败时放入(announce, None)
+    :return: None
+    """
+    try:
+        results.put((announce, method(*args)))
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        results.put((announce, None))
+
+
+def _get_scrape_url(announce):
+    """
+    按约定将announce url最后一段中的'announce'替换为'scrape'
+    :param announce: HTTP announce的url链接
+    :return: scrape url, 不支持scrape时返回None
+    """
+    idx = announce.rfind('/')
+    if idx == -1 or not announce[idx + 1:].startswith('announce'):
+        return None
+    return announce[:idx + 1] + 'scrape' + announce[idx + 1 + len('announce'):]
 
 
 def _parse_udp_announce_url(announce):
     """
-    得到annouce的链接信息
+    得到annouce的链接信息, 支持[IPv6]形式的host
     :param announce: announce url链接
     :return: host ip
     """
-    match = re.search(UDP_REGEX, announce)
-    host = match.group(1)
-    str_port = match.group(2)
-    port = 80 if str_port == '' else int(str_port)
-    return host, port
+    url = urlsplit(announce)
+    port = 80 if url.port is None else url.port
+    return url.hostname, port
 
 
 def _get_peers_from_http_tracker(announce, metainfo):
@@ -53,35 +533,70 @@ def _get_peers_from_http_tracker(announce, metainfo):
     :param metainfo: metainfo
     :return: [(ip,port)]的元组列表
     """
+    return _http_announce(requests, announce, metainfo).peers
+
+
+def _http_announce(session, announce, metainfo, **announce_args):
+    """
+    向HTTP tracker发送announce并解析完整响应
+    :param session: requests.Session对象(或requests模块)
+    :param announce: HTTP announce的url链接
+    :param metainfo: metainfo
+    :param announce_args: 传递给_get_http_request_args的流量与事件参数
+    :return: AnnounceResponse对象
+    """
     # 向http tracker发送请求，并解析该响应
-    response = requests.get(announce, _get_http_request_args(metainfo),
-                            timeout=SETTINGS['timeout'])
+    response = session.get(announce, _get_http_request_args(metainfo, **announce_args),
+                           timeout=SETTINGS['timeout'])
 
     # 解析bencode的响应
-    peers = Bencode.decode(response.content)
+    res = Bencode.decode(response.content)
+    if b'failure reason' in res:
+        raise TrackerError(res[b'failure reason'].decode(errors='replace'))
 
-    # 处理binary类型的peer数据
-    if isinstance(peers[b'peers'], bytes):
-        peers = _get_peers_bin_model(peers[b'peers'])
+    # 处理binary类型的peer数据, 只返回peers6的tracker可能不带peers
+    peers = res.get(b'peers', b'')
+    if isinstance(peers, bytes):
+        peers = _get_peers_bin_model(peers)
     # 处理字典列表类型的peer数据
     else:
-        peers = _get_peers_list_model(peers[b'peers'])
-    return peers
+        peers = _get_peers_list_model(peers)
+    # BEP 7: IPv6的peer以18字节一组放在peers6中
+    peers6 = res.get(b'peers6', b'')
+    if isinstance(peers6, bytes):
+        peers.extend(_get_peers_bin6_model(peers6))
+    return AnnounceResponse(peers,
+                            interval=res.get(b'interval'),
+                            min_interval=res.get(b'min interval'),
+                            tracker_id=res.get(b'tracker id'),
+                            complete=res.get(b'complete'),
+                            incomplete=res.get(b'incomplete'))
 
 
-def _get_http_request_args(metainfo):
+def _get_http_request_args(metainfo, uploaded=0, downloaded=0, left=None,
+                           event=None, tracker_id=None):
     """
     返回对HTTP tracker请求时用到的参数
     :param metainfo:metainfo
+    :param uploaded: 已上传的字节数
+    :param downloaded: 已下载的字节数
+    :param left: 剩余字节数, 默认为全部长度
+    :param event: 'started', 'completed', 'stopped'或None
+    :param tracker_id: 上次响应中的tracker id
     :return:请求参数的字典
     """
     request = {
         'info_hash': metainfo.info_hash,
         'peer_id': SETTINGS['peer_id'],
         'port': SETTINGS['port'],
-        'uploaded': '0', 'downloaded': '0', 'left': metainfo.length,
+        'uploaded': str(uploaded), 'downloaded': str(downloaded),
+        'left': metainfo.length if left is None else left,
         'compact': '1', 'no_peer_id': '1', 'numwant': SETTINGS['numwant']
     }
+    if event is not None:
+        request['event'] = event
+    if tracker_id is not None:
+        request['trackerid'] = tracker_id
     return request
 
 
@@ -92,14 +607,186 @@ def _get_peers_from_udp_tracker(announce, metainfo):
     :param metainfo: metainfo
     :return: [(ip,port)]的元组列表
     """
-    # 建立一个连接UDP tracker的UDP套接字
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-        # 设置超时参数
-        s.settimeout(SETTINGS['timeout'])
-        # 获取announce的host port
+    return _udp_announce(announce, metainfo).peers
+
+
+def _udp_announce(announce, metainfo, **announce_args):
+    """
+    通过共享的UDPTrackerClient向UDP tracker发送announce
+    :param announce: UDP announce的url链接
+    :param metainfo: metainfo
+    :param announce_args: 流量与事件参数
+    :return: AnnounceResponse对象
+    """
+    return get_udp_tracker_client().announce(announce, metainfo, **announce_args)
+
+
+def _udp_scrape(announce, metainfo):
+    """
+    通过共享的UDPTrackerClient向UDP tracker发送scrape
+    :param announce: UDP announce的url链接
+    :param metainfo: metainfo
+    :return: 统计信息字典
+    """
+    return get_udp_tracker_client().scrape(announce, metainfo)
+
+
+class _UDPTransaction:
+    """等待中的UDP tracker请求"""
+
+    def __init__(self, addr, action):
+        self.addr = addr
+        self.action = action
+        self.response = None
+        self.event = Event()
+
+
+class UDPTrackerClient:
+    """
+    BEP 15 UDP tracker客户端, 所有torrent共享:
+    每个地址族只使用一个套接字, 由接收线程按transaction_id分发响应,
+    connection_id按地址缓存60秒, 超时按指数退避重传
+    """
+
+    protocol_id = 0x41727101980
+    connection_id_ttl = 60
+    # action编号
+    action_connect = 0
+    action_announce = 1
+    action_scrape = 2
+    action_error = 3
+
+    def __init__(self):
+        self.key = random.getrandbits(32)
+        self._socks = {}
+        self._socks_lock = Lock()
+        self._pending = {}
+        self._pending_lock = Lock()
+        # {(ip, port): (connection_id, 过期时间)}
+        self._connections = {}
+
+    def announce(self, announce, metainfo, uploaded=0, downloaded=0, left=None,
+                 event=0, tracker_id=None):
+        """
+        向UDP tracker发送announce并解析完整响应
+        :param announce: UDP announce的url链接
+        :param metainfo: metainfo
+        :param uploaded: 已上传的字节数
+        :param downloaded: 已下载的字节数
+        :param left: 剩余字节数, 默认为全部长度
+        :param event: 0: none; 1: completed; 2: started; 3: stopped
+        :param tracker_id: UDP协议不使用, 仅为与HTTP保持一致的参数
+        :return: AnnounceResponse对象
+        """
+        addr, family = self._resolve(announce)
+        if left is None:
+            left = metainfo.length
+
+        def build_request(connection_id, transaction_id):
+            return _get_udp_announce_request(connection_id, transaction_id, metainfo,
+                                             uploaded, downloaded, left, event, self.key)
+
+        res = self._request_with_connection(addr, family, self.action_announce,
+                                            build_request)
+        '''
+        announce response:
+        Offset      Size            Name            Value
+        0           32-bit integer  action          1 // announce
+        4           32-bit integer  transaction_id
+        8           32-bit integer  interval
+        12          32-bit integer  leechers
+        16          32-bit integer  seeders
+        20 + 6 * n  32-bit integer  IP address      // IPv6 tracker: 128-bit
+        24 + 6 * n  16-bit integer  TCP port
+        '''
+        if len(res) < 20:
+            raise TrackerError('Announce response is too short')
+        interval, leechers, seeders = struct.unpack('!LLL', res[8:20])
+        # 通过IPv6访问的tracker返回18字节的compact peer
+        if family == socket.AF_INET6:
+            peers = _get_peers_bin6_model(res[20:])
+        else:
+            peers = _get_peers_bin_model(res[20:])
+        return AnnounceResponse(peers, interval=interval,
+                                complete=seeders, incomplete=leechers)
+
+    def scrape(self, announce, metainfo):
+        """
+        向UDP tracker发送scrape请求
+        :param announce: UDP announce的url链接
+        :param metainfo: metainfo
+        :return: 统计信息字典
+        """
+        addr, family = self._resolve(announce)
+
+        def build_request(connection_id, transaction_id):
+            # scrape请求: <connection_id><action=2><transaction_id><info_hash>...
+            return (connection_id + struct.pack('!LL', self.action_scrape, transaction_id) +
+                    metainfo.info_hash)
+
+        res = self._request_with_connection(addr, family, self.action_scrape,
+                                            build_request)
+        # scrape响应: <action=2><transaction_id><seeders><completed><leechers>...
+        if len(res) < 20:
+            raise TrackerError('Scrape response is too short')
+        seeders, completed, leechers = struct.unpack('!LLL', res[8:20])
+        return {'complete': seeders, 'downloaded': completed, 'incomplete': leechers}
+
+    @staticmethod
+    def _resolve(announce):
+        """
+        解析announce url得到tracker的地址
+        :param announce: UDP announce的url链接
+        :return: (sockaddr, 地址族)
+        """
         host, port = _parse_udp_announce_url(announce)
-        # 连接到announce
-        s.connect((host, port))
+        family, _, _, _, addr = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+        return addr[:2], family
+
+    def _request_with_connection(self, addr, family, action, build_request):
+        """
+        使用(缓存的)connection_id发送请求, 缓存的connection_id失效时重新连接一次.
+        tracker回复的error响应(如torrent未注册)直接以TrackerError抛出, 不再重试
+        :param addr: tracker地址
+        :param family: 地址族
+        :param action: 请求的action编号
+        :param build_request: 以(connection_id, transaction_id)构造请求的函数
+        :return: bytes类型的响应
+        """
+        is_cached = self._get_cached_connection_id(addr) is not None
+        connection_id = self._get_connection_id(addr, family)
+        try:
+            return self._request(addr, family, action,
+                                 lambda tid: build_request(connection_id, tid))
+        except socket.timeout:
+            # 超时可能是connection_id已被tracker判定过期而丢弃了请求, 丢弃缓存后重新连接
+            self._connections.pop(addr, None)
+            if not is_cached:
+                raise
+        connection_id = self._get_connection_id(addr, family)
+        return self._request(addr, family, action,
+                             lambda tid: build_request(connection_id, tid))
+
+    def _get_cached_connection_id(self, addr):
+        """
+        :param addr: tracker地址
+        :return: 未过期的connection_id, 没有则返回None
+        """
+        cached = self._connections.get(addr)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        return None
+
+    def _get_connection_id(self, addr, family):
+        """
+        获取tracker的connection_id, 60秒内复用缓存
+        :param addr: tracker地址
+        :param family: 地址族
+        :return: 8字节的connection_id
+        """
+        connection_id = self._get_cached_connection_id(addr)
+        if connection_id is not None:
+            return connection_id
         '''
         connect request:
         Offset  Size            Name            Value
@@ -107,15 +794,6 @@ def _get_peers_from_udp_tracker(announce, metainfo):
         8       32-bit integer  action          0 // connect
         12      32-bit integer  transaction_id
         16
-        '''
-        # 形成连接请求
-        transaction_id = b'\x00\x00\x00\xff'  # 随机初始化transaction_id
-        req = b''.join((b'\x00\x00\x04\x17\x27\x10\x19\x80',  # protocol_id
-                        b'\x00\x00\x00\x00',
-                        transaction_id))
-        # 发送request请求
-        s.send(req)
-        '''
         connect response:
         Offset  Size            Name            Value
         0       32-bit integer  action          0 // connect
@@ -123,24 +801,113 @@ def _get_peers_from_udp_tracker(announce, metainfo):
         8       64-bit integer  connection_id
         16
         '''
-        # 接收responce
-        res = s.recv(16)
-        # 获取IPv4 announce请求
-        req = _get_udp_announce_request(res[8:16], transaction_id, metainfo)
-        # 发送IPv4 announce请求
-        s.send(req)
-        # 接收IPv4 announce请求
-        res = s.recv(SETTINGS['max_ans_size'])
-        # IPV4 响应包含ip和port 但有20位偏移（二进制下）
-        return _get_peers_bin_model(res[20:])
+        res = self._request(
+            addr, family, self.action_connect,
+            lambda tid: struct.pack('!QLL', self.protocol_id, self.action_connect, tid))
+        if len(res) < 16:
+            raise TrackerError('Connect response is too short')
+        connection_id = res[8:16]
+        self._connections[addr] = (connection_id,
+                                   time.monotonic() + self.connection_id_ttl)
+        return connection_id
+
+    def _request(self, addr, family, action, build_request):
+        """
+        发送请求并等待匹配的响应, 超时后以新的transaction_id按指数退避重传
+        (BEP 15建议15 * 2 ^ n秒, 这里以SETTINGS['timeout']为基数)
+        :param addr: tracker地址
+        :param family: 地址族
+        :param action: 期望的响应action
+        :param build_request: 以transaction_id构造请求的函数
+        :return: bytes类型的响应
+        """
+        sock = self._get_socket(family)
+        for attempt in range(SETTINGS['udp_max_retries'] + 1):
+            transaction = _UDPTransaction(addr, action)
+            with self._pending_lock:
+                transaction_id = random.getrandbits(32)
+                while transaction_id in self._pending:
+                    transaction_id = random.getrandbits(32)
+                self._pending[transaction_id] = transaction
+            try:
+                sock.sendto(build_request(transaction_id), addr)
+                transaction.event.wait(SETTINGS['timeout'] * 2 ** attempt)
+            finally:
+                with self._pending_lock:
+                    self._pending.pop(transaction_id, None)
+            res = transaction.response
+            if res is None:
+                continue
+            if struct.unpack('!L', res[:4])[0] == self.action_error:
+                raise TrackerError(res[8:].decode(errors='replace'))
+            return res
+        raise socket.timeout(f'UDP tracker {addr} did not respond')
 
+    def _get_socket(self, family):
+        """
+        获取指定地址族的共享套接字, 首次使用时创建并启动接收线程
+        :param family: 地址族
+        :return: UDP套接字
+        """
+        with self._socks_lock:
+            if family not in self._socks:
+                sock = socket.socket(family, socket.SOCK_DGRAM)
+                sock.bind(('::' if family == socket.AF_INET6 else '0.0.0.0', 0))
+                self._socks[family] = sock
+                Thread(target=self._recv_always, args=(sock,), daemon=True).start()
+            return self._socks[family]
 
-def _get_udp_announce_request(connection_id, transaction_id, metainfo):
+    def _recv_always(self, sock):
+        """
+        接收线程: 校验响应的transaction_id, 来源地址与action后唤醒对应请求
+        :param sock: UDP套接字
+        :return: None
+        """
+        while True:
+            try:
+                res, addr = sock.recvfrom(65536)
+            except OSError:
+                return
+            if len(res) < 8:
+                continue
+            action, transaction_id = struct.unpack('!LL', res[:8])
+            with self._pending_lock:
+                transaction = self._pending.get(transaction_id)
+            if transaction is None or transaction.addr != addr[:2]:
+                continue
+            if action != transaction.action and action != self.action_error:
+                continue
+            transaction.response = res
+            transaction.event.set()
+
+
+_udp_tracker_client = None
+_udp_tracker_client_lock = Lock()
+
+
+def get_udp_tracker_client():
+    """
+    :return: 进程内共享的UDPTrackerClient
+    """
+    global _udp_tracker_client
+    with _udp_tracker_client_lock:
+        if _udp_tracker_client is None:
+            _udp_tracker_client = UDPTrackerClient()
+        return _udp_tracker_client
+
+
+def _get_udp_announce_request(connection_id, transaction_id, metainfo,
+                              uploaded=0, downloaded=0, left=None, event=0, key=0):
     """
     通过connection_id,transaction_id和metainfo，返回IPV4连接请求
     :param connection_id: 请求时的connection_id
-    :param transaction_id: 请求时的transaction_id
+    :param transaction_id: 请求时的transaction_id(整数)
     :param metainfo: metainfo
+    :param uploaded: 已上传的字节数
+    :param downloaded: 已下载的字节数
+    :param left: 剩余字节数, 默认为全部长度
+    :param event: 事件编号
+    :param key: 客户端的随机key
     :return: bytes类型的UDP请求
     """
 
@@ -161,29 +928,46 @@ def _get_udp_announce_request(connection_id, transaction_id, metainfo):
     96      16-bit integer  port
     98
     """
+    if left is None:
+        left = metainfo.length
     req_list = [
         connection_id,  # connection_id
-        b'\x00\x00\x00\x01',  # action: announce = 1
-        transaction_id,  # transaction_id
+        struct.pack('!LL', 1, transaction_id),  # action: announce = 1, transaction_id
         metainfo.info_hash,  # info_hash
         SETTINGS['peer_id'],  # peer_id
-        b'\x00\x00\x00\x00\x00\x00\x00\x00'  # downloaded
+        struct.pack('!QQQ', downloaded, left, uploaded),  # downloaded, left, uploaded
+        struct.pack('!L', event),  # event
+        b'\x00\x00\x00\x00',  # IP address (default)
+        struct.pack('!L', key),  # key
+        struct.pack('!l', SETTINGS['numwant']),  # num_want
+        struct.pack('!H', int(SETTINGS['port']))  # port
     ]
-
-    hex_metainfo_len = hex(metainfo.length)[2:]
-    full_hex_metainfo_len = ('0' * (16 - len(hex_metainfo_len)) +
-                             hex_metainfo_len)
-    req_list.append(bytes.fromhex(full_hex_metainfo_len))  # left
-
-    req_list.append(b'\x00\x00\x00\x00\x00\x00\x00\x00')  # uploaded
-    req_list.append(b'\x00\x00\x00\x00')  # event (none)
-    req_list.append(b'\x00\x00\x00\x00')  # IP address (default)
-    req_list.append(b'\x00\x00\x00\x00')  # key
-    req_list.append(struct.pack('!L', SETTINGS['numwant']))  # num_want
-    req_list.append(b'\x00\x00\x1a\xe1')  # port
     return b''.join(req_list)
 
 
+def decode_compact_peers(data, ipv6=False):
+    """
+    解析compact格式的peer列表(BEP 23, IPv6为BEP 7)
+    :param data: bytes类型的peer数据
+    :param ipv6: 是否为18字节一组的IPv6格式
+    :return: [(ip,port),..]的元组列表
+    """
+    if ipv6:
+        return _get_peers_bin6_model(data)
+    return _get_peers_bin_model(data)
+
+
+def encode_compact_peer(ip, port):
+    """
+    将peer编码为compact格式
+    :param ip: IPv4或IPv6地址字符串
+    :param port: 端口号
+    :return: 6字节(IPv4)或18字节(IPv6)的bytes
+    """
+    family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+    return socket.inet_pton(family, ip) + struct.pack('!H', port)
+
+
 def _get_peers_list_model(peers_list):
     """
     返回字典列表的peer列表
@@ -202,24 +986,66 @@ def _get_peers_bin_model(data):
     :param data:bytes类型的peer数据
     :return:[(ip,port),..]的元组列表
     """
-    # 每6位是一组(ip,port),前四个ip，后两个port
-    chunks = [data[i:i + 6] for i in range(0, len(data), 6)]
-    return [(_get_ip(chunk[:4]),
-             int.from_bytes(chunk[4:], byteorder='big'))
-            for chunk in chunks]
+    # 每6位是一组(ip,port),前四个ip，后两个port, 以struct.iter_unpack批量解析
+    data = memoryview(data)[:len(data) - len(data) % 6]
+    inet_ntoa = socket.inet_ntoa
+    return [(inet_ntoa(bin_ip), port)
+            for bin_ip, port in struct.iter_unpack('!4sH', data)]
+
+
+def _get_peers_bin6_model(data):
+    """
+    返回BEP 7 IPv6 binary类型的peer列表
+    :param data:bytes类型的peer数据
+    :return:[(ip,port),..]的元组列表
+    """
+    # 每18位是一组(ip,port),前16个ip，后两个port
+    data = memoryview(data)[:len(data) - len(data) % 18]
+    inet_ntop = socket.inet_ntop
+    return [(inet_ntop(socket.AF_INET6, bin_ip), port)
+            for bin_ip, port in struct.iter_unpack('!16sH', data)]
+
+
+def split_compact_peers(data, ipv6=False):
+    """
+    将compact格式的peer数据切分为packed bytes键, 不构造ip字符串,
+    用于在集合中高效去重与黑名单检查
+    :param data: bytes类型的peer数据
+    :param ipv6: 是否为18字节一组的IPv6格式
+    :return: [6字节或18字节的bytes]列表
+    """
+    size = 18 if ipv6 else 6
+    data = memoryview(data)[:len(data) - len(data) % size]
+    return [key for key, in struct.iter_unpack(f'{size}s', data)]
+
+
+def peer_key(ip, port):
+    """
+    :param ip: IPv4或IPv6地址字符串
+    :param port: 端口号
+    :return: peer的packed bytes键(即compact格式), ip无效时返回None
+    """
+    try:
+        return encode_compact_peer(ip, port)
+    except OSError:
+        return None
 
 
-def _get_ip(bin_ip):
+def decode_peer_key(key):
     """
-    从bytes类型返回IP字符串
-    :param bin_ip: bytes类型的IP
-    :return: IP字符串
+    :param key: peer的packed bytes键
+    :return: (ip, port)
     """
-    res = []
-    for i in range(4):
-        res.append(str(bin_ip[i]))
-    return '.'.join(res)
+    if len(key) == 6:
+        ip = socket.inet_ntoa(key[:4])
+    else:
+        ip = socket.inet_ntop(socket.AF_INET6, key[:16])
+    return ip, int.from_bytes(key[-2:], byteorder='big')
 
 
 class PeersFindingError(Exception):
     pass
+
+
+class TrackerError(Exception):
+    pass
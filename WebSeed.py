@@ -0,0 +1,263 @@
+import bisect
+import os
+import time
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from threading import Lock, Thread
+from urllib.parse import quote, urlsplit
+
+import Tracing
+from Config import SETTINGS
+from Metrics import get_metrics
+
+
+class HTTPConnectionPool:
+    """
+    按(scheme, host)复用keep-alive连接, 多个web seed与torrent共享
+    """
+
+    def __init__(self, max_idle_per_host=4):
+        self.max_idle_per_host = max_idle_per_host
+        # {(scheme, netloc): [空闲连接, ...]}
+        self.idle = {}
+        self.lock = Lock()
+
+    def get(self, scheme, netloc):
+        """
+        :param scheme: 'http'或'https'
+        :param netloc: host[:port]
+        :return: 空闲的连接, 没有时新建
+        """
+        with self.lock:
+            conns = self.idle.get((scheme, netloc))
+            if conns:
+                return conns.pop()
+        conn_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+        return conn_class(netloc, timeout=SETTINGS['web_seed_timeout'])
+
+    def put(self, scheme, netloc, conn):
+        """
+        归还响应已读完的连接, 超出空闲上限时关闭
+        :return: None
+        """
+        with self.lock:
+            conns = self.idle.setdefault((scheme, netloc), [])
+            if len(conns) < self.max_idle_per_host:
+                conns.append(conn)
+                return
+        conn.close()
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_http_pool():
+    """
+    :return: 进程内共享的HTTPConnectionPool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = HTTPConnectionPool()
+        return _pool
+
+
+class WebSeed:
+    """
+    BEP 19 web seed: 对piece选择算法表现为拥有全部piece的peer,
+    以HTTP Range请求下载一个或连续多个piece, 数据仍交给Torrent.handle_block()校验
+    """
+
+    def __init__(self, url, torrent):
+        """
+        :param url: metainfo中url-list的一项
+        :param torrent: 所属的torrent
+        """
+        self.url = url
+        self.torrent = torrent
+        # 与Peer相同形式的键, key[:-2]用于记录错误数据的来源
+        self.key = b'web:' + url.encode() + b'\x00\x00'
+        self.is_available = True
+        self.is_running = False
+        self.failures = 0
+        metainfo = torrent.metainfo
+        # 各文件在数据中的起始偏移、长度与对应的URL, 填充文件的URL为None
+        self.file_offsets = []
+        self.file_lens = []
+        self.file_urls = []
+        if metainfo.is_single_file:
+            self.file_offsets.append(0)
+            self.file_lens.append(metainfo.length)
+            self.file_urls.append(self._get_file_url([metainfo.name]))
+        else:
+            offset = 0
+            for file in metainfo.files:
+                self.file_offsets.append(offset)
+                self.file_lens.append(file['length'])
+                self.file_urls.append(None if file.get('padding') else self._get_file_url(
+                    [metainfo.name] + file['path'].split(os.sep)))
+                offset += file['length']
+        self.traffic = get_metrics().traffic_meters('bt_peer_', parents=torrent.traffic,
+                                                     torrent=torrent.metrics_label, peer=url)
+
+    @property
+    def name(self):
+        return self.url
+
+    def have_piece(self, piece_idx):
+        return True
+
+    def _get_file_url(self, segments):
+        """
+        BEP 19: 以'/'结尾的URL为目录, 需拼接文件路径; 单文件torrent的URL也可以直接指向文件
+        :param segments: 包含torrent名的路径分段
+        :return: 文件的URL
+        """
+        if not self.url.endswith('/'):
+            if len(segments) == 1:
+                return self.url
+            return self.url + '/' + '/'.join(quote(segment) for segment in segments)
+        return self.url + '/'.join(quote(segment) for segment in segments)
+
+    def _get_file_ranges(self, offset, length):
+        """
+        将数据中的字节范围映射到各文件
+        :param offset: 在数据中的起始偏移
+        :param length: 长度
+        :return: [(URL或None, 文件内偏移, 长度)]
+        """
+        res = []
+        file_idx = bisect.bisect_right(self.file_offsets, offset) - 1
+        while length > 0:
+            file_offset = self.file_offsets[file_idx]
+            cur_len = min(length, self.file_lens[file_idx] - (offset - file_offset))
+            if cur_len > 0:
+                res.append((self.file_urls[file_idx], offset - file_offset, cur_len))
+                offset += cur_len
+                length -= cur_len
+            file_idx += 1
+        return res
+
+    def _fetch(self, url, offset, length):
+        """
+        通过连接池发送Range请求
+        :param url: 文件URL
+        :param offset: 文件内偏移
+        :param length: 长度
+        :return: 字节类型数据
+        """
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        pool = get_http_pool()
+        conn = pool.get(parts.scheme, parts.netloc)
+        try:
+            with Tracing.span('web_request', 'webseed', url=url, offset=offset, length=length):
+                conn.request('GET', path, headers={
+                    'Range': 'bytes={}-{}'.format(offset, offset + length - 1),
+                    'User-Agent': SETTINGS['peer_id'][1:7].decode()})
+                response = conn.getresponse()
+                data = response.read()
+        except (OSError, HTTPException):
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            pool.put(parts.scheme, parts.netloc, conn)
+        # 不支持Range的服务器返回整个文件
+        if response.status == 200:
+            data = data[offset: offset + length]
+        elif response.status != 206:
+            raise WebSeedError('{} {} for {}'.format(response.status, response.reason, url))
+        if len(data) != length:
+            raise WebSeedError('Short read from {}'.format(url))
+        return data
+
+    def _download_range(self, pbis):
+        """
+        下载一段连续的blocks并交给torrent
+        :param pbis: 连续的[(piece_idx, block_idx)]
+        :return: None
+        """
+        metainfo = self.torrent.metainfo
+        block_len = SETTINGS['int_block_len']
+        piece_idx, block_idx = pbis[0]
+        offset = piece_idx * metainfo.piece_length + block_idx * block_len
+        lens = [min(metainfo.get_piece_len_at(p_i) - b_i * block_len, block_len)
+                for p_i, b_i in pbis]
+        data = b''.join(b'\x00' * cur_len if url is None else self._fetch(url, file_offset, cur_len)
+                        for url, file_offset, cur_len in self._get_file_ranges(offset, sum(lens)))
+        self.traffic['payload_download'].add(len(data))
+        view = memoryview(data)
+        pos = 0
+        for (p_i, b_i), cur_len in zip(pbis, lens):
+            self.torrent.handle_block(p_i, b_i, bytes(view[pos: pos + cur_len]), self)
+            pos += cur_len
+
+    def _split_contiguous(self, pbis):
+        """
+        :param pbis: 按顺序排列的[(piece_idx, block_idx)]
+        :return: 按数据偏移相邻分组后的列表
+        """
+        metainfo = self.torrent.metainfo
+        block_len = SETTINGS['int_block_len']
+        groups = []
+        prev_end = None
+        for piece_idx, block_idx in pbis:
+            start = piece_idx * metainfo.piece_length + block_idx * block_len
+            if start != prev_end:
+                groups.append([])
+            groups[-1].append((piece_idx, block_idx))
+            prev_end = start + min(metainfo.get_piece_len_at(piece_idx) - block_idx * block_len,
+                                   block_len)
+        return groups
+
+    def run_download(self):
+        """
+        循环领取连续的blocks并下载, 连续失败过多或被封禁时停止
+        :return: None
+        """
+        self.is_running = True
+        while self.is_available and not self.torrent.is_stopped:
+            if self.torrent.is_banned(self.key):
+                break
+            pbis = self.torrent.get_web_seed_run(self, SETTINGS['web_seed_max_request'])
+            if pbis is None:
+                break
+            if not pbis:
+                # 剩余的blocks均已被peer领取, 稍后再试
+                time.sleep(SETTINGS['web_seed_idle_interval'])
+                continue
+            for group in self._split_contiguous(pbis):
+                # 已放弃该web seed时归还剩余的blocks
+                if not self.is_available:
+                    for piece_idx, block_idx in group:
+                        self.torrent.handle_incorrect_pbi(piece_idx, block_idx)
+                    continue
+                try:
+                    self._download_range(group)
+                    self.failures = 0
+                except (OSError, HTTPException, WebSeedError):
+                    for piece_idx, block_idx in group:
+                        self.torrent.handle_incorrect_pbi(piece_idx, block_idx)
+                    self.failures += 1
+                    if self.failures >= SETTINGS['web_seed_max_failures']:
+                        self.is_available = False
+                        continue
+                    # 失败后按次数指数退避
+                    time.sleep(SETTINGS['web_seed_retry_interval'] * 2 ** (self.failures - 1))
+        self.is_running = False
+        self.is_available = False
+        get_metrics().unregister(torrent=self.torrent.metrics_label, peer=self.url)
+
+    def start(self):
+        """
+        在后台线程中下载
+        :return: None
+        """
+        self.is_available = True
+        Thread(target=self.run_download, daemon=True).start()
+
+
+class WebSeedError(Exception):
+    pass
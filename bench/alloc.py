@@ -0,0 +1,163 @@
+"""
+文件分配策略基准测试:
+分别以sparse、full与lazy策略创建下载文件, 按随机顺序写入全部piece(模拟从swarm下载),
+再从页缓存中逐出数据后顺序读取, 输出分配耗时、写入与顺序读取速度以及文件的extent数量(碎片程度)
+
+python3 bench/alloc.py --size 1024 --piece-length 256
+python3 bench/alloc.py --files 5000 --size 64 --json alloc.json
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from TorrentWriter import ALLOCATION_STRATEGIES, TorrentWriter
+
+READ_CHUNK = 2 ** 20
+
+
+class _Metainfo:
+    """
+    TorrentWriter所需的最小metainfo, 数据按长度均分到files_count个文件中, 其中包含空文件
+    """
+
+    def __init__(self, size, piece_length, files_count):
+        self.name = 'alloc_bench'
+        self.piece_length = piece_length
+        self.length = size
+        pieces_count = (size + piece_length - 1) // piece_length
+        self.pieces = [b'\x00' * 20] * pieces_count
+        self.is_single_file = files_count == 1
+        self.files = None
+        if not self.is_single_file:
+            self.files = []
+            file_len = size // files_count
+            for i in range(files_count):
+                length = file_len if i < files_count - 1 else size - file_len * (files_count - 1)
+                self.files.append({'length': length,
+                                   'path': os.path.join('dir%d' % (i % 100), 'file_%d.bin' % i)})
+                # 每100个文件插入一个空文件
+                if i % 100 == 0:
+                    self.files.append({'length': 0,
+                                       'path': os.path.join('dir%d' % (i % 100), 'empty_%d' % i)})
+
+    def get_piece_len_at(self, piece_idx):
+        return min(self.piece_length, self.length - piece_idx * self.piece_length)
+
+
+def _data_paths(metainfo, downloads_dir):
+    if metainfo.is_single_file:
+        return [os.path.join(downloads_dir, metainfo.name)]
+    return [os.path.join(downloads_dir, metainfo.name, file['path']) for file in metainfo.files]
+
+
+def _evict(paths):
+    """
+    写回磁盘并从页缓存中逐出, 使随后的读取来自磁盘
+    :param paths: 文件路径列表
+    :return: None
+    """
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def _count_extents(paths):
+    """
+    :param paths: 文件路径列表
+    :return: 由filefrag得到的extent总数, 不可用时返回None
+    """
+    total = 0
+    for path in paths:
+        try:
+            out = subprocess.run(['filefrag', path], capture_output=True, text=True,
+                                 check=True).stdout
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        # 输出格式: "<path>: N extents found"
+        total += int(out.rsplit(':', 1)[1].split()[0])
+    return total
+
+
+def run_strategy(allocation, args, work_dir):
+    """
+    :param allocation: 分配策略
+    :param args: 命令行参数
+    :param work_dir: 工作目录
+    :return: 结果dict
+    """
+    size = int(args.size * 2 ** 20)
+    metainfo = _Metainfo(size, args.piece_length * 1024, args.files)
+    strategy_dir = os.path.join(work_dir, allocation)
+    os.mkdir(strategy_dir)
+    cwd = os.getcwd()
+    os.chdir(strategy_dir)
+    try:
+        start_time = time.perf_counter()
+        writer = TorrentWriter(metainfo, allocation=allocation)
+        alloc_seconds = time.perf_counter() - start_time
+    finally:
+        os.chdir(cwd)
+    pieces = list(range(len(metainfo.pieces)))
+    random.Random(0).shuffle(pieces)
+    data = os.urandom(metainfo.piece_length)
+    start_time = time.perf_counter()
+    for piece_idx in pieces:
+        writer.write_piece(piece_idx, data[:metainfo.get_piece_len_at(piece_idx)])
+    paths = _data_paths(metainfo, writer.downloads_dir)
+    # 写入速度包含fsync, 否则只反映写入页缓存的速度
+    _evict(paths)
+    write_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    read_len = 0
+    for path in paths:
+        with open(path, 'rb', buffering=0) as f:
+            for chunk in iter(lambda: f.read(READ_CHUNK), b''):
+                read_len += len(chunk)
+    read_seconds = time.perf_counter() - start_time
+    assert read_len == size
+    return {
+        'allocation': allocation,
+        'alloc_seconds': alloc_seconds,
+        'write_mb_per_s': args.size / write_seconds,
+        'read_mb_per_s': args.size / read_seconds,
+        'extents': _count_extents(paths)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='File allocation strategy benchmark.')
+    parser.add_argument('--size', type=float, default=256, help='total data size in MiB')
+    parser.add_argument('--piece-length', type=int, default=256, help='piece length in KiB')
+    parser.add_argument('--files', type=int, default=1, help='number of files to spread the data over')
+    parser.add_argument('--strategy', choices=ALLOCATION_STRATEGIES, action='append',
+                        help='strategy to run, repeat for more, defaults to all')
+    parser.add_argument('--dir', help='directory on the file system to test, defaults to a temp dir')
+    parser.add_argument('--json', metavar='FILE', help='write the results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as work_dir:
+        for allocation in args.strategy or ALLOCATION_STRATEGIES:
+            res = run_strategy(allocation, args, work_dir)
+            results.append(res)
+            print('{allocation:<7} alloc {alloc_seconds:.3f}s, write {write_mb_per_s:.1f} MB/s, '
+                  'read {read_mb_per_s:.1f} MB/s, extents {extents}'.format(**res))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'params': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
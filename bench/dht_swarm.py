@@ -0,0 +1,141 @@
+"""
+本机回环网络上的DHT swarm:
+在同一进程中启动若干DHTNode, 以第一个节点作为bootstrap节点组网,
+输出组网耗时、路由表规模、announce_peer之后由其他节点get_peers的成功率与查找耗时,
+并检查节点对缺少参数的请求回复203错误
+
+python3 bench/dht_swarm.py --nodes 50 --lookups 20
+python3 bench/dht_swarm.py --nodes 200 --timeout 0.5 --json dht.json
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Bencode
+from Config import SETTINGS
+from DHT import DHTNode
+from TrackerAPI import peer_key
+
+HOST = '127.0.0.1'
+
+
+def start_nodes(count):
+    """
+    启动count个节点, 除第一个节点外均以第一个节点为bootstrap节点
+    :param count: 节点数量
+    :return: DHTNode列表
+    """
+    nodes = []
+    for i in range(count):
+        bootstrap_nodes = [(HOST, nodes[0].port)] if nodes else []
+        # state_file为空字符串时不读写路由表文件
+        node = DHTNode(port=0, bootstrap_nodes=bootstrap_nodes, state_file='', host=HOST)
+        node.start()
+        nodes.append(node)
+    return nodes
+
+
+def check_errors(node):
+    """
+    发送缺少target/info_hash的请求, 检查是否回复203错误
+    :param node: 被测节点
+    :return: {请求名称: 是否收到203错误}
+    """
+    res = {}
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(SETTINGS['dht_timeout'])
+    try:
+        for query in (b'find_node', b'get_peers', b'announce_peer'):
+            msg = {b'a': {b'id': os.urandom(20)}, b'q': query, b't': b'aa', b'y': b'q'}
+            sock.sendto(Bencode.encode(msg), (HOST, node.port))
+            try:
+                reply = Bencode.decode(sock.recvfrom(65536)[0])
+            except (socket.timeout, ValueError):
+                res[query.decode()] = False
+                continue
+            res[query.decode()] = reply.get(b'y') == b'e' and reply.get(b'e', [None])[0] == 203
+    finally:
+        sock.close()
+    return res
+
+
+def run_lookups(nodes, count, rng):
+    """
+    随机节点announce_peer后, 由另一个随机节点get_peers查找
+    :param nodes: DHTNode列表
+    :param count: 查找次数
+    :param rng: random.Random对象
+    :return: (成功次数, 各次查找耗时列表)
+    """
+    found = 0
+    seconds = []
+    for i in range(count):
+        info_hash = os.urandom(20)
+        announcer, searcher = rng.sample(nodes, 2)
+        port = 10000 + i
+        announcer.announce_peer(info_hash, port=port)
+        start_time = time.perf_counter()
+        peers = searcher.get_peers(info_hash)
+        seconds.append(time.perf_counter() - start_time)
+        found += peer_key(HOST, port) in peers
+    return found, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loopback DHT swarm benchmark.')
+    parser.add_argument('--nodes', type=int, default=50, help='number of DHT nodes')
+    parser.add_argument('--lookups', type=int, default=20, help='number of announce/get_peers rounds')
+    parser.add_argument('--timeout', type=float, default=1, help='KRPC query timeout in seconds')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for choosing nodes')
+    parser.add_argument('--json', metavar='FILE', help='write the results as JSON')
+    args = parser.parse_args()
+    if args.nodes < 2:
+        parser.error('--nodes must be at least 2')
+
+    SETTINGS['dht_timeout'] = args.timeout
+    rng = random.Random(args.seed)
+    start_time = time.perf_counter()
+    nodes = start_nodes(args.nodes)
+    try:
+        # 依次加入的节点只认识先加入的节点, 全部加入后再bootstrap一轮以补全路由表
+        for _ in range(2):
+            for node in nodes[1:]:
+                node.bootstrap()
+        join_seconds = time.perf_counter() - start_time
+        table_sizes = [len(node.table) for node in nodes]
+        found, seconds = run_lookups(nodes, args.lookups, rng)
+        errors = check_errors(nodes[-1])
+    finally:
+        for node in nodes:
+            node.stop()
+    res = {
+        'nodes': args.nodes,
+        'join_seconds': join_seconds,
+        'median_table_size': statistics.median(table_sizes),
+        'min_table_size': min(table_sizes),
+        'lookup_success': found / args.lookups if args.lookups else None,
+        'median_lookup_seconds': statistics.median(seconds) if seconds else None,
+        'max_lookup_seconds': max(seconds) if seconds else None,
+        'protocol_errors': errors
+    }
+    print('{nodes} nodes joined in {join_seconds:.2f}s, routing table median {median_table_size} '
+          '(min {min_table_size})'.format(**res))
+    if seconds:
+        print('get_peers: {:.0%} found, median {:.3f}s, max {:.3f}s'.format(
+            res['lookup_success'], res['median_lookup_seconds'], res['max_lookup_seconds']))
+    print('203 on missing arguments: ' + ', '.join(
+        f'{query} {"ok" if is_ok else "FAILED"}' for query, is_ok in errors.items()))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'params': vars(args), 'results': res}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+端到端吞吐量基准测试:
+在本机回环网络上生成合成torrent, 启动做种进程与本地tracker, 再用Torrent完成下载,
+输出MB/s、CPU时间、峰值RSS与首个piece完成时间
+
+python3 bench/e2e.py --size 64 --seeders 4 --latency 5 --tracker udp --repeat 3 --json out.json
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.swarm import WebSeedServer, make_synthetic_torrent, start_seeders, start_tracker
+from Config import SETTINGS
+from TorrentMetainfo import TorrentMetainfo
+
+
+def _cpu_time():
+    """
+    :return: 本进程与已退出子进程(分片)的CPU时间之和
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def _run_client(torrent_path, work_dir, timeout, shards, result_queue):
+    """
+    在独立进程中下载, 使CPU时间与峰值RSS只反映客户端本身
+    :param torrent_path: torrent文件路径
+    :param work_dir: 下载目录的上级目录
+    :param timeout: 超时时间(秒)
+    :param shards: 分片进程数量, 0表示在单个进程中下载
+    :param result_queue: 返回结果的队列
+    :return: None
+    """
+    from Shard import ShardedDownload
+    from Torrent import Torrent
+
+    os.chdir(work_dir)
+    SETTINGS['dht_enabled'] = False
+    # 使用随机端口, 避免与本机其他客户端冲突
+    SETTINGS['port'] = '0'
+    if shards:
+        torrent = ShardedDownload(torrent_path, shards)
+        run = torrent.start
+    else:
+        torrent = Torrent(TorrentMetainfo(torrent_path))
+        run = torrent.run_download
+    start_cpu = _cpu_time()
+    start_time = time.perf_counter()
+    first_piece_time = None
+    Thread(target=run, daemon=True).start()
+    while torrent.progress < 1 and time.perf_counter() - start_time < timeout:
+        if first_piece_time is None and torrent.completed_len > 0:
+            first_piece_time = time.perf_counter() - start_time
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - start_time
+    completed = torrent.progress == 1
+    torrent.stop()
+    # 分片进程在stop()中退出后才计入RUSAGE_CHILDREN
+    cpu_time = _cpu_time() - start_cpu
+    result_queue.put({
+        'completed': completed,
+        'seconds': elapsed,
+        'cpu_seconds': cpu_time,
+        # Linux下ru_maxrss的单位为KB, 分片时取各进程中的最大值
+        'peak_rss_mb': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                           resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024,
+        'time_to_first_piece': first_piece_time
+    })
+
+
+def _file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            sha1.update(chunk)
+    return sha1.digest()
+
+
+def run_once(args, run_idx):
+    """
+    搭建一次模拟swarm并完成一次下载
+    :param args: 命令行参数
+    :param run_idx: 第几次运行, 同时作为合成数据的随机数种子
+    :return: 结果dict
+    """
+    size = int(args.size * 2 ** 20)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tracker = start_tracker(args.tracker)
+        web_seed = WebSeedServer(tmp_dir) if args.web_seed else None
+        torrent_path, data_path = make_synthetic_torrent(
+            tmp_dir, size, args.piece_length * 1024, tracker.announce, seed=run_idx,
+            url_list=[web_seed.url] if web_seed else None)
+        metainfo = TorrentMetainfo(torrent_path)
+        seeder_args = (metainfo.info_hash, data_path, metainfo.piece_length,
+                       args.latency / 1000, args.bandwidth * 1024 or None,
+                       args.choke_every, args.choke_duration / 1000, args.fast)
+        seeders, ports = start_seeders(args.seeders, seeder_args)
+        tracker.set_peers(ports)
+        work_dir = os.path.join(tmp_dir, 'client')
+        os.mkdir(work_dir)
+        try:
+            ctx = multiprocessing.get_context('spawn')
+            result_queue = ctx.Queue()
+            client = ctx.Process(target=_run_client,
+                                 args=(torrent_path, work_dir, args.timeout, args.shards,
+                                       result_queue))
+            client.start()
+            res = result_queue.get(timeout=args.timeout + 60)
+            client.join()
+        finally:
+            for seeder in seeders:
+                seeder.terminate()
+            tracker.stop()
+            if web_seed is not None:
+                web_seed.stop()
+        downloaded_path = os.path.join(work_dir, 'downloads', metainfo.name)
+        res['verified'] = (res['completed'] and
+                           _file_digest(downloaded_path) == _file_digest(data_path))
+    res['mb_per_s'] = args.size / res['seconds'] if res['completed'] else 0.0
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loopback swarm end-to-end throughput benchmark.')
+    parser.add_argument('--size', type=float, default=16, help='torrent size in MiB')
+    parser.add_argument('--piece-length', type=int, default=256, help='piece length in KiB')
+    parser.add_argument('--seeders', type=int, default=4, help='number of seeder processes')
+    parser.add_argument('--latency', type=float, default=0, help='added latency per request in ms')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='upload bandwidth per connection in KiB/s, 0 for unlimited')
+    parser.add_argument('--choke-every', type=int, default=0,
+                        help='choke the client after this many blocks, 0 to never choke')
+    parser.add_argument('--choke-duration', type=float, default=100, help='choke duration in ms')
+    parser.add_argument('--fast', action='store_true',
+                        help='seeders use the Fast Extension (BEP 6): have_all, allowed_fast and '
+                             'reject_request while choked')
+    parser.add_argument('--tracker', choices=('http', 'udp'), default='http')
+    parser.add_argument('--web-seed', action='store_true',
+                        help='also serve the data from a local HTTP web seed (BEP 19)')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='split the peer connections across this many client processes')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs')
+    parser.add_argument('--timeout', type=float, default=300, help='timeout per run in seconds')
+    parser.add_argument('--json', metavar='FILE', help='write the results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    for run_idx in range(args.repeat):
+        res = run_once(args, run_idx)
+        results.append(res)
+        ttfp = res['time_to_first_piece']
+        print('run {}: {:.2f} MB/s, {:.2f}s, cpu {:.2f}s, peak rss {:.1f} MB, '
+              'first piece {}{}'.format(run_idx, res['mb_per_s'], res['seconds'],
+                                       res['cpu_seconds'], res['peak_rss_mb'],
+                                       'n/a' if ttfp is None else '{:.3f}s'.format(ttfp),
+                                       '' if res['verified'] else ' (FAILED)'))
+
+    summary = {key: statistics.median(res[key] for res in results)
+               for key in ('mb_per_s', 'seconds', 'cpu_seconds', 'peak_rss_mb')}
+    print('median: {mb_per_s:.2f} MB/s, {seconds:.2f}s, cpu {cpu_seconds:.2f}s, '
+          'peak rss {peak_rss_mb:.1f} MB'.format(**summary))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'params': vars(args), 'runs': results, 'median': summary}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""
+热点纯函数的微基准测试:
+覆盖bencode编解码、消息构建与解析、缓冲区分帧、bitfield解析、compact peer解析与piece选择,
+结果以JSON保存, 并可与基线比较以发现性能回退
+
+python3 bench/micro.py --save results.json
+python3 bench/micro.py --baseline results.json --threshold 1.25
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Bencode
+from Config import SETTINGS
+from Metrics import get_metrics
+from Peer import Peer
+from TrackerAPI import _get_peers_bin_model
+from TorrentWriter import TorrentWriter
+
+BLOCK_LEN = SETTINGS['int_block_len']
+
+
+class _FakeMetainfo:
+    def __init__(self, pieces_count, piece_length=BLOCK_LEN * 16, name='bench.bin'):
+        self.info_hash = b'\x00' * 20
+        self.meta_version = 1
+        self.name = name
+        self.piece_length = piece_length
+        self.pieces = [b'\x00' * 20] * pieces_count
+        self.length = piece_length * pieces_count
+        self.is_single_file = True
+        self.files = None
+        self.announce_tiers = []
+        self.nodes = []
+        self.url_list = []
+
+    def get_piece_len_at(self, piece_idx):
+        return self.piece_length
+
+
+class _FakeSocket:
+    """
+    丢弃所有发送数据的套接字, 使Peer不建立真实连接
+    """
+
+    def settimeout(self, timeout):
+        pass
+
+    def send(self, data):
+        return len(data)
+
+    def sendall(self, data):
+        pass
+
+    def recv(self, size):
+        # 对端不再发送数据, Peer会将其视为连接关闭
+        return b''
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+class _FakeTorrent:
+    """
+    只接收block的torrent, 使_decode_msg不触碰磁盘与网络
+    """
+
+    def __init__(self, pieces_count):
+        self.metainfo = _FakeMetainfo(pieces_count)
+        self.metrics_label = 'bench'
+        self.traffic = get_metrics().traffic_meters('bench_torrent_')
+
+    def handle_block(self, piece_idx, block_idx, block, peer=None):
+        pass
+
+    def handle_dht_port(self, ip, port):
+        pass
+
+    def is_piece_needed(self, piece_idx):
+        # 不需要任何piece, 解析have与bitfield时不会发送interested
+        return False
+
+
+def _make_peer(pieces_count):
+    """
+    以假套接字与假torrent构建传入连接的Peer, 仅用于调用消息解析函数
+    :param pieces_count: piece数量
+    :return: Peer对象
+    """
+    torrent = _FakeTorrent(pieces_count)
+    # 预先放入对端的握手信息与空bitfield, 握手流程不需要从套接字读取数据
+    protocol_name = SETTINGS['protocol_name']
+    handshake = (bytes([len(protocol_name)]) + protocol_name + bytes(8) +
+                 torrent.metainfo.info_hash + bytes(20))
+    bitfield = bytes((pieces_count + 7) // 8)
+    buffer = handshake + struct.pack('!LB', 1 + len(bitfield), 5) + bitfield
+    peer = Peer('127.0.0.1', 6881, torrent, sock=_FakeSocket(), buffer=buffer)
+    if not peer.is_available:
+        raise RuntimeError('Failed to build the benchmark peer.')
+    return peer
+
+
+def _bencode_torrent(files_count):
+    """
+    :param files_count: 文件数量
+    :return: 多文件torrent的metainfo字典
+    """
+    rng = random.Random(files_count)
+    files = [{b'length': rng.randrange(1, 2 ** 30),
+              b'path': [b'dir%d' % (i % 100), b'file_%d.bin' % i]} for i in range(files_count)]
+    return {
+        b'announce': b'http://tracker.example.com/announce',
+        b'info': {
+            b'files': files,
+            b'name': b'bench',
+            b'piece length': 2 ** 18,
+            b'pieces': rng.randbytes(20 * files_count)
+        }
+    }
+
+
+def _piece_frames(total_len):
+    """
+    :param total_len: 缓冲区大小
+    :return: 由piece消息组成的缓冲区
+    """
+    block = bytes(BLOCK_LEN)
+    frame_count = total_len // (13 + BLOCK_LEN)
+    return b''.join(struct.pack('!LBLL', 9 + BLOCK_LEN, 7, i // 16, i % 16 * BLOCK_LEN) + block
+                    for i in range(frame_count))
+
+
+def _have_frames(count):
+    """
+    :param count: have消息数量
+    :return: 由have消息组成的缓冲区(最坏情况: 大量小消息)
+    """
+    return b''.join(struct.pack('!LBL', 5, 4, i) for i in range(count))
+
+
+def _torrent_for_pbi(work_dir, pieces_count):
+    """
+    :param work_dir: 工作目录, TorrentWriter在其中创建稀疏文件
+    :param pieces_count: piece数量
+    :return: Torrent对象
+    """
+    from Torrent import Torrent
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        return Torrent(_FakeMetainfo(pieces_count, piece_length=BLOCK_LEN))
+    finally:
+        os.chdir(cwd)
+
+
+class _LastPiecePeer:
+    """
+    只拥有最后一个piece的peer, get_pbi_for_peer需要扫描全部piece
+    """
+
+    def __init__(self, pieces_count):
+        self.last_idx = pieces_count - 1
+        self.key = b'\x7f\x00\x00\x01\x1a\xe1'
+
+    def have_piece(self, piece_idx):
+        return piece_idx == self.last_idx
+
+
+class _AllPiecesPeer:
+    """
+    拥有全部piece的peer, get_pbi_for_peer在第一个piece即可返回
+    """
+    key = b'\x7f\x00\x00\x01\x1a\xe2'
+
+    @staticmethod
+    def have_piece(piece_idx):
+        return True
+
+
+def _get_pbi_and_restore(torrent, peer):
+    """
+    选择block后放回, 使每次调用面对相同的状态
+    """
+    piece_idx, block_idx = torrent.get_pbi_for_peer(peer)
+    if block_idx is not None:
+        torrent.exp_p_blocks[piece_idx].add(block_idx)
+
+
+def get_cases(work_dir):
+    """
+    :param work_dir: 临时目录
+    :return: [(名称, 被测函数, setup函数或None)], 有setup时每次调用前重新构建输入
+    """
+    cases = []
+
+    torrent_10k = _bencode_torrent(10000)
+    encoded_10k = Bencode.encode(torrent_10k)
+    cases.append(('bencode_decode_10k_files', lambda: Bencode.decode(encoded_10k), None))
+    cases.append(('bencode_encode_10k_files', lambda: Bencode.encode(torrent_10k), None))
+
+    cases.append(('build_msg_request',
+                  lambda: Peer.build_msg(6, piece_idx=1234, offset=BLOCK_LEN, block_len=BLOCK_LEN),
+                  None))
+    cases.append(('build_msg_interested', lambda: Peer.build_msg(2), None))
+
+    peer = _make_peer(100000)
+    have_msg = struct.pack('!BL', 4, 99999)
+    piece_msg = struct.pack('!BLL', 7, 0, 0) + bytes(BLOCK_LEN)
+    bitfield_msg = b'\x05' + b'\xff' * (100000 // 8)
+    cases.append(('decode_msg_have', lambda: peer._decode_msg(have_msg), None))
+    cases.append(('decode_msg_piece_16k', lambda: peer._decode_msg(piece_msg), None))
+    cases.append(('decode_msg_bitfield_100k_pieces', lambda: peer._decode_msg(bitfield_msg), None))
+
+    piece_buffer = _piece_frames(2 ** 20)
+    have_buffer = _have_frames(10000)
+    buffer_peer = _make_peer(100000)
+
+    def set_buffer(data):
+        def setup():
+            buffer_peer.buffer = data
+        return setup
+
+    cases.append(('handle_buffer_1mb_piece_frames', buffer_peer._handle_buffer,
+                  set_buffer(piece_buffer)))
+    cases.append(('handle_buffer_10k_have_frames', buffer_peer._handle_buffer,
+                  set_buffer(have_buffer)))
+
+    bitfield = b'\xaa' * (100000 // 8)
+    cases.append(('bitfield_to_pieces_100k',
+                  lambda: TorrentWriter.get_info_about_pieced_from_bytes(bitfield), None))
+
+    compact_peers = random.Random(0).randbytes(6 * 10000)
+    cases.append(('peers_bin_model_10k', lambda: _get_peers_bin_model(compact_peers), None))
+
+    pbi_torrent = _torrent_for_pbi(work_dir, 100000)
+    all_pieces_peer = _AllPiecesPeer()
+    last_piece_peer = _LastPiecePeer(100000)
+    cases.append(('get_pbi_100k_pieces_first_piece',
+                  lambda: _get_pbi_and_restore(pbi_torrent, all_pieces_peer), None))
+    cases.append(('get_pbi_100k_pieces_last_piece',
+                  lambda: _get_pbi_and_restore(pbi_torrent, last_piece_peer), None))
+    return cases
+
+
+def measure(func, setup=None, repeat=5, min_time=0.2):
+    """
+    测量单次调用的耗时
+    :param func: 被测函数
+    :param setup: 每次调用前执行且不计时的函数
+    :param repeat: 重复测量次数
+    :param min_time: 无setup时每轮至少运行的时间(秒), 用于确定每轮调用次数
+    :return: (每次调用耗时列表, 每轮调用次数)的元组
+    """
+    if setup is not None:
+        timings = []
+        for _ in range(repeat):
+            setup()
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        return timings, 1
+    # 与timeit.autorange类似, 逐步增大调用次数直至单轮耗时超过min_time
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return timings, number
+
+
+def compare(results, baseline, threshold):
+    """
+    :param results: 本次结果
+    :param baseline: 基线结果
+    :param threshold: best耗时超过基线的该倍数时视为回退
+    :return: 回退的用例名列表
+    """
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f'{name:<36} (no baseline)')
+            continue
+        ratio = res['best'] / base['best']
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:<36} {ratio:6.2f}x of baseline{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for codec and hot helpers.')
+    parser.add_argument('--filter', help='only run cases whose name contains this string')
+    parser.add_argument('--repeat', type=int, default=5, help='measurements per case')
+    parser.add_argument('--save', metavar='FILE', help='write the results as JSON')
+    parser.add_argument('--baseline', metavar='FILE', help='compare against a saved result file')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='flag cases slower than this multiple of the baseline')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, func, setup in get_cases(work_dir):
+            if args.filter and args.filter not in name:
+                continue
+            timings, number = measure(func, setup, repeat=args.repeat)
+            results[name] = {'best': min(timings), 'median': statistics.median(timings),
+                             'calls': number}
+            print(f'{name:<36} best {min(timings) * 1e6:12.2f} us  '
+                  f'median {statistics.median(timings) * 1e6:12.2f} us')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'results': results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print()
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
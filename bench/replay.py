@@ -0,0 +1,103 @@
+"""
+重放peer-wire trace:
+将main.py --record-peers录制的连接数据通过ReplaySocket送入Peer/Torrent,
+按原始速度(--realtime)或尽快处理, 输出消息处理速率, 便于离线对比与二分定位性能回退
+
+python3 bench/replay.py --torrent test/sintel.torrent traces/*.bpt --repeat 3
+"""
+import argparse
+import os
+import statistics
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Config import SETTINGS
+from PeerTrace import PeerTrace, ReplaySocket
+from TorrentMetainfo import TorrentMetainfo
+
+
+def count_messages(data):
+    """
+    :param data: 一个连接收到的全部数据(包含握手信息)
+    :return: 其中完整的peer-wire消息数量(不含握手)
+    """
+    offset = 49 + data[0] if data else 0
+    count = 0
+    while offset + 4 <= len(data):
+        msg_len = struct.unpack_from('!L', data, offset)[0]
+        if offset + 4 + msg_len > len(data):
+            break
+        offset += 4 + msg_len
+        count += 1
+    return count
+
+
+def replay_once(metainfo, traces, realtime):
+    """
+    依次重放所有trace
+    :param metainfo: torrent的metainfo
+    :param traces: PeerTrace列表
+    :param realtime: 是否按原始时间间隔送入数据
+    :return: (耗时, 收到的字节数, 完成的piece数量)的元组
+    """
+    from Peer import Peer
+    from Torrent import Torrent
+
+    torrent = Torrent(metainfo)
+    # 重放时不向tracker或DHT补充新的peer
+    torrent.is_stopped = True
+    recv_bytes = 0
+    start_time = time.perf_counter()
+    for trace in traces:
+        sock = ReplaySocket(trace, realtime=realtime)
+        peer = Peer(trace.ip, trace.port, torrent, sock=sock)
+        torrent.peers[peer.key] = peer
+        if peer.is_available:
+            peer.run_download()
+        recv_bytes += sock.recv_bytes
+    elapsed = time.perf_counter() - start_time
+    completed = sum(1 for blocks in torrent.p_blocks if blocks is None)
+    return elapsed, recv_bytes, completed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded peer-wire sessions.')
+    parser.add_argument('traces', nargs='+', help='.bpt files recorded with main.py --record-peers')
+    parser.add_argument('--torrent', required=True, help='the .torrent file the traces belong to')
+    parser.add_argument('--realtime', action='store_true',
+                        help='feed data with the recorded timing instead of as fast as possible')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs')
+    args = parser.parse_args()
+
+    SETTINGS['dht_enabled'] = False
+    metainfo = TorrentMetainfo(args.torrent)
+    traces = [PeerTrace(path) for path in args.traces]
+    for path, trace in zip(args.traces, traces):
+        if trace.info_hash != metainfo.info_hash:
+            print(f'Warning: "{path}" was recorded for another torrent.')
+    messages = sum(count_messages(trace.inbound) for trace in traces)
+
+    timings = []
+    # 下载目录放在临时目录中, 不影响当前目录
+    with tempfile.TemporaryDirectory() as work_dir:
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            for run_idx in range(args.repeat):
+                elapsed, recv_bytes, completed = replay_once(metainfo, traces, args.realtime)
+                timings.append(elapsed)
+                print('run {}: {:.3f}s, {:.0f} msg/s, {:.2f} MB/s, {} pieces verified'.format(
+                    run_idx, elapsed, messages / elapsed, recv_bytes / elapsed / 2 ** 20,
+                    completed))
+        finally:
+            os.chdir(cwd)
+    print('median: {:.3f}s, {:.0f} msg/s'.format(statistics.median(timings),
+                                                 messages / statistics.median(timings)))
+
+
+if __name__ == '__main__':
+    main()
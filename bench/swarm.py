@@ -0,0 +1,357 @@
+"""
+本机回环网络上的模拟swarm:
+生成合成torrent, 启动若干做种进程(可配置延迟、带宽与choke行为)、本地HTTP/UDP tracker
+以及支持Range请求的web seed
+"""
+import hashlib
+import os
+import random
+import re
+import socket
+import struct
+import sys
+import time
+from functools import partial
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process
+from threading import Lock, Thread, Timer
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Bencode
+from Config import SETTINGS
+
+
+def make_synthetic_torrent(directory, size, piece_length, announce, name='synthetic.bin', seed=0,
+                           url_list=None):
+    """
+    生成随机内容的单文件torrent
+    :param directory: 输出目录
+    :param size: 文件大小(字节)
+    :param piece_length: piece长度
+    :param announce: tracker的announce链接
+    :param name: 文件名
+    :param seed: 随机数种子, 相同参数生成相同内容
+    :param url_list: BEP 19 web seed的URL列表
+    :return: (torrent文件路径, 数据文件路径)的元组
+    """
+    data_path = os.path.join(directory, name)
+    rng = random.Random(seed)
+    pieces = []
+    with open(data_path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            piece = rng.randbytes(min(piece_length, remaining))
+            f.write(piece)
+            pieces.append(hashlib.sha1(piece).digest())
+            remaining -= len(piece)
+    metainfo = {
+        b'announce': announce.encode(),
+        b'info': {
+            b'length': size,
+            b'name': name.encode(),
+            b'piece length': piece_length,
+            b'pieces': b''.join(pieces)
+        }
+    }
+    if url_list:
+        metainfo[b'url-list'] = [url.encode() for url in url_list]
+    torrent_path = os.path.join(directory, name + '.torrent')
+    with open(torrent_path, 'wb') as f:
+        f.write(Bencode.encode(metainfo))
+    return torrent_path, data_path
+
+
+class Seeder:
+    """
+    只做种的peer-wire服务端, 运行在单独的进程中
+    """
+
+    def __init__(self, info_hash, data_path, piece_length, latency=0.0, bandwidth=None,
+                 choke_every=0, choke_duration=0.0, fast=False, allowed_fast_count=10):
+        """
+        :param info_hash: torrent的info_hash
+        :param data_path: 完整的数据文件
+        :param piece_length: piece长度
+        :param latency: 每个请求的额外延迟(秒)
+        :param bandwidth: 每个连接的上传带宽(字节/秒), None表示不限速
+        :param choke_every: 每服务多少个请求choke一次对端, 0表示从不choke
+        :param choke_duration: 每次choke持续的时间(秒)
+        :param fast: 是否支持BEP 6 Fast Extension: 以have_all代替bitfield,
+                     choke期间拒绝allowed_fast以外的请求而不是延迟处理
+        :param allowed_fast_count: 告知对端的allowed_fast piece数量
+        """
+        self.info_hash = info_hash
+        self.piece_length = piece_length
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.choke_every = choke_every
+        self.choke_duration = choke_duration
+        self.fast = fast
+        self.allowed_fast_count = allowed_fast_count
+        with open(data_path, 'rb') as f:
+            self.data = f.read()
+        self.pieces_count = (len(self.data) + piece_length - 1) // piece_length
+
+    def serve(self, sock):
+        """
+        accept循环, 每个连接一个线程
+        :param sock: 已listen的套接字
+        :return: None
+        """
+        while True:
+            conn, _ = sock.accept()
+            Thread(target=self._handle_conn, args=(conn,), daemon=True).start()
+
+    def _handle_conn(self, conn):
+        try:
+            self._serve_peer(conn)
+        except (OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+    def _serve_peer(self, conn):
+        reader = conn.makefile('rb')
+        # 对端在握手完成前关闭连接时read返回的数据不完整
+        first = reader.read(1)
+        if not first:
+            return
+        pstrlen = first[0]
+        handshake = reader.read(pstrlen + 48)
+        if len(handshake) < pstrlen + 48 or handshake[pstrlen + 8: pstrlen + 28] != self.info_hash:
+            return
+        # BEP 6: reserved字段最后一个字节的0x04位, 双方都支持时才使用Fast Extension
+        fast = self.fast and bool(handshake[pstrlen + 7] & 0x04)
+        reserved = bytes(7) + (b'\x04' if self.fast else b'\x00')
+        conn.sendall(b'\x13' + SETTINGS['protocol_name'] + reserved + self.info_hash +
+                     b'-SD0001-' + os.urandom(12))
+        if fast:
+            conn.sendall(struct.pack('!LB', 1, 14))
+            allowed_fast = set(range(min(self.allowed_fast_count, self.pieces_count)))
+            for piece_idx in allowed_fast:
+                conn.sendall(struct.pack('!LBL', 5, 17, piece_idx))
+        else:
+            bitfield = bytearray((self.pieces_count + 7) // 8)
+            for i in range(self.pieces_count):
+                bitfield[i // 8] |= 0x80 >> (i % 8)
+            conn.sendall(struct.pack('!LB', 1 + len(bitfield), 5) + bytes(bitfield))
+        conn.sendall(struct.pack('!LB', 1, 1))
+        send_lock = Lock()
+        choked_until = 0
+        served = 0
+        while True:
+            prefix = reader.read(4)
+            if len(prefix) < 4:
+                return
+            msg_len = struct.unpack('!L', prefix)[0]
+            msg = reader.read(msg_len)
+            if len(msg) < msg_len or msg_len == 0 or msg[0] != 6:
+                continue
+            piece_idx, offset, block_len = struct.unpack('!LLL', msg[1:13])
+            # choke期间拒绝allowed_fast以外的请求
+            if fast and time.monotonic() < choked_until and piece_idx not in allowed_fast:
+                with send_lock:
+                    conn.sendall(struct.pack('!LB', 13, 16) + msg[1:13])
+                continue
+            begin = piece_idx * self.piece_length + offset
+            block = self.data[begin: begin + block_len]
+            if self.latency:
+                time.sleep(self.latency)
+            if self.bandwidth:
+                time.sleep(len(block) / self.bandwidth)
+            with send_lock:
+                conn.sendall(struct.pack('!LBLL', 9 + len(block), 7, piece_idx, offset) + block)
+            served += 1
+            if self.choke_every and served % self.choke_every == 0:
+                with send_lock:
+                    conn.sendall(struct.pack('!LB', 1, 0))
+                if fast:
+                    # 继续读取请求并拒绝, 到期后由定时器发送unchoke
+                    choked_until = time.monotonic() + self.choke_duration
+                    Timer(self.choke_duration, self._send_locked,
+                          (conn, send_lock, struct.pack('!LB', 1, 1))).start()
+                else:
+                    time.sleep(self.choke_duration)
+                    conn.sendall(struct.pack('!LB', 1, 1))
+
+    @staticmethod
+    def _send_locked(conn, send_lock, msg):
+        try:
+            with send_lock:
+                conn.sendall(msg)
+        except OSError:
+            pass
+
+
+def _run_seeder(sock, seeder_args):
+    Seeder(*seeder_args).serve(sock)
+
+
+def start_seeders(count, seeder_args):
+    """
+    启动做种进程, 监听套接字在父进程中创建以便立即得到端口
+    :param count: 做种进程数量
+    :param seeder_args: 传给Seeder的参数元组
+    :return: (进程列表, 端口列表)的元组
+    """
+    processes = []
+    ports = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(64)
+        ports.append(sock.getsockname()[1])
+        process = Process(target=_run_seeder, args=(sock, seeder_args), daemon=True)
+        process.start()
+        sock.close()
+        processes.append(process)
+    return processes, ports
+
+
+def compact_peers(ports):
+    return b''.join(socket.inet_aton('127.0.0.1') + struct.pack('!H', port) for port in ports)
+
+
+class HTTPTracker:
+    """
+    本地HTTP tracker, 对任何info_hash都返回set_peers()设置的做种者
+    """
+
+    def __init__(self, interval=1800):
+        self.peers = b''
+        self.interval = interval
+        tracker = self
+
+        class TrackerHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if urlsplit(self.path).path != '/announce':
+                    self.send_error(404)
+                    return
+                body = Bencode.encode({b'interval': tracker.interval, b'peers': tracker.peers})
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), TrackerHandler)
+        self.server.daemon_threads = True
+        self.announce = f'http://127.0.0.1:{self.server.server_address[1]}/announce'
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def set_peers(self, ports):
+        self.peers = compact_peers(ports)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class UDPTracker:
+    """
+    本地UDP tracker(BEP 15), 对任何info_hash都返回set_peers()设置的做种者
+    """
+
+    def __init__(self, interval=1800):
+        self.peers = b''
+        self.interval = interval
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.announce = f'udp://127.0.0.1:{self.sock.getsockname()[1]}/announce'
+        self.is_running = True
+        Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while self.is_running:
+            try:
+                data, addr = self.sock.recvfrom(2048)
+            except OSError:
+                return
+            if len(data) < 16:
+                continue
+            action, transaction_id = struct.unpack('!LL', data[8:16])
+            if action == 0:
+                self.sock.sendto(struct.pack('!LLQ', 0, transaction_id, random.getrandbits(63)),
+                                 addr)
+            elif action == 1:
+                self.sock.sendto(struct.pack('!LLLLL', 1, transaction_id, self.interval,
+                                             len(self.peers) // 6, 0) + self.peers, addr)
+            elif action == 2:
+                self.sock.sendto(struct.pack('!LL', 2, transaction_id) +
+                                 struct.pack('!LLL', len(self.peers) // 6, 0, 0), addr)
+
+    def set_peers(self, ports):
+        self.peers = compact_peers(ports)
+
+    def stop(self):
+        self.is_running = False
+        self.sock.close()
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    支持单个Range请求与keep-alive的静态文件服务, 作为web seed的本地替身
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def send_head(self):
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        path = self.translate_path(self.path)
+        if match is None or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        if start > end:
+            self.send_error(416)
+            return None
+        f = open(path, 'rb')
+        f.seek(start)
+        self.range_len = end - start + 1
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(self.range_len))
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        range_len = getattr(self, 'range_len', None)
+        if range_len is None:
+            return super().copyfile(source, outputfile)
+        self.range_len = None
+        outputfile.write(source.read(range_len))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebSeedServer:
+    """
+    本地HTTP web seed, url属性为指向directory的目录URL
+    """
+
+    def __init__(self, directory):
+        handler = partial(RangeRequestHandler, directory=directory)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_tracker(kind):
+    """
+    :param kind: 'http'或'udp'
+    :return: tracker对象, announce属性为其链接, 做种者启动后通过set_peers()设置返回的peer
+    """
+    if kind == 'udp':
+        return UDPTracker()
+    return HTTPTracker()
+
@@ -0,0 +1,58 @@
+from RPCServer import RPCError, call
+import argparse
+import json
+import os
+import sys
+
+
+def print_torrents(torrents):
+    """
+    以表格形式输出torrent列表
+    :param torrents: get_stats()返回的dict列表
+    :return: None
+    """
+    print('Info hash                                | Name                         | '
+          'Status      | Progress | Peers')
+    for stats in torrents:
+        print(' | '.join(['{:<40}'.format(stats['info_hash']),
+                          '{:<28}'.format(stats['name'][:28]),
+                          '{:<11}'.format(stats['status']),
+                          '{:<8}'.format('{:.2%}'.format(stats['progress'])),
+                          '{:<5}'.format(stats['peers'])]))
+
+
+def main():
+    # 守护进程的命令行客户端, 每条命令对应一个JSON-RPC方法
+    my_parser = argparse.ArgumentParser(description='Control a torrent client running with --daemon.')
+    subparsers = my_parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help='add a .torrent file')
+    add_parser.add_argument('path', help='the path to the .torrent file')
+    for command in ('pause', 'resume', 'remove', 'stats'):
+        cur_parser = subparsers.add_parser(command, help=f'{command} a torrent')
+        cur_parser.add_argument('info_hash', help='the hex info hash of the torrent')
+    subparsers.add_parser('list', help='list all torrents')
+    subparsers.add_parser('metrics', help='dump a JSON snapshot of all metrics')
+    subparsers.add_parser('shutdown', help='stop the daemon')
+    args = my_parser.parse_args()
+
+    if args.command == 'add':
+        # 守护进程的工作目录可能不同, 发送绝对路径
+        params = [os.path.abspath(args.path)]
+    elif args.command in ('list', 'metrics', 'shutdown'):
+        params = []
+    else:
+        params = [args.info_hash]
+    try:
+        result = call(args.command, params)
+    except (OSError, RPCError) as e:
+        print(f'Exception: {e}')
+        sys.exit(1)
+
+    if args.command == 'list':
+        print_torrents(result)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
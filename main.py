@@ -1,7 +1,15 @@
 from Client import Client
+from Config import SETTINGS
+from Metrics import serve_metrics
+from RPCServer import RPCServer
+import Tracing
+from Session import Session
+from Shard import ShardedDownload
+from TorrentWriter import ALLOCATION_STRATEGIES
 import argparse
 import os
 import sys
+import time
 
 
 def is_valid_torrent_file(filename):
@@ -20,21 +28,100 @@ def is_valid_torrent_file(filename):
     return True
 
 
+def run_daemon(input_paths):
+    """
+    以无界面的守护进程方式运行, 通过本地JSON-RPC接口接受控制, 直至收到shutdown请求
+    :param input_paths: 启动时加入的torrent文件路径
+    :return: None
+    """
+    session = Session()
+    session.start()
+    for input_path, error in session.add_many(input_paths).items():
+        print(f'Exception: Failed to load "{input_path}": {error}')
+    server = RPCServer(session)
+    server.start()
+    # 提供Prometheus文本与JSON格式的指标
+    serve_metrics()
+    print(f'Daemon is listening on {server.address}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        session.stop()
+
+
+def run_sharded(input_path, shards_count):
+    """
+    将单个torrent的peer连接分散到多个工作进程下载
+    :param input_path: torrent文件路径
+    :param shards_count: 工作进程数量, 0表示CPU核数
+    :return: None
+    """
+    download = ShardedDownload(input_path, shards_count or None)
+    download.start()
+    try:
+        while download.progress < 1:
+            time.sleep(.5)
+            print('\r{:.2%} | {} peers | {} shards | {:.2f} MB/s'.format(
+                download.progress, download.peers_count, download.shards_count,
+                download.download_rate / 1024 ** 2), end='', flush=True)
+        print('\nDownload finished!')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        download.stop()
+
+
 def main():
     # 创建parser解析torrent文件
     my_parser = argparse.ArgumentParser(description='Torrent Client to download files using .torrent files.')
     # 添加parser输入变量
-    my_parser.add_argument(action='store', dest='path', help='the path to the .torrent file')
+    my_parser.add_argument(action='store', dest='paths', nargs='*',
+                           help='the paths to the .torrent files')
+    my_parser.add_argument('--daemon', action='store_true',
+                           help='run without a TTY and accept commands over the local JSON-RPC API')
+    my_parser.add_argument('--trace', action='store', metavar='FILE',
+                           help='record per-phase timing spans and dump them as Chrome trace JSON')
+    my_parser.add_argument('--record-peers', action='store', metavar='DIR',
+                           help='record every peer-wire connection into DIR for offline replay')
+    my_parser.add_argument('--shards', action='store', type=int, metavar='N',
+                           help='download a single torrent with N worker processes, 0 for one per CPU')
+    my_parser.add_argument('--allocation', action='store', choices=ALLOCATION_STRATEGIES,
+                           help='how to allocate the downloaded files: sparse (default), '
+                                'full preallocation, or lazy creation on first write')
     # 执行parse_args()方法获取torrent文件路径
     args = my_parser.parse_args()
-    input_path = args.path
+    input_paths = args.paths
+    if not input_paths and not args.daemon:
+        my_parser.error('the following arguments are required: paths')
     # 进行文件异常校验
-    if not is_valid_torrent_file(input_path):
-        print('The file specified does not exist or is not a .torrent file.')
-        sys.exit()
+    for input_path in input_paths:
+        if not is_valid_torrent_file(input_path):
+            print(f'The file "{input_path}" does not exist or is not a .torrent file.')
+            sys.exit()
+    if args.shards is not None and (args.daemon or len(input_paths) != 1):
+        my_parser.error('--shards requires exactly one torrent file and no --daemon')
 
+    # 开启trace时记录各阶段耗时, 退出时写出
+    if args.trace:
+        Tracing.enable()
+    if args.allocation:
+        SETTINGS['file_allocation'] = args.allocation
+    if args.record_peers:
+        SETTINGS['peer_trace_dir'] = args.record_peers
     # 执行下载
-    Client(path=input_path).run()
+    try:
+        if args.daemon:
+            run_daemon(input_paths)
+        elif args.shards is not None:
+            run_sharded(input_paths[0], args.shards)
+        else:
+            Client(paths=input_paths).run()
+    finally:
+        if args.trace:
+            Tracing.dump(args.trace)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,57 @@
+from TorrentMaker import make_torrent, write_torrent
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+import Bencode
+
+
+def main():
+    # 为文件或目录生成.torrent文件, piece哈希由进程池并行计算
+    my_parser = argparse.ArgumentParser(description='Create a .torrent file from a file or directory.')
+    my_parser.add_argument('path', help='the file or directory to publish')
+    my_parser.add_argument('-o', '--output', help='the output .torrent file, defaults to <name>.torrent')
+    my_parser.add_argument('-t', '--tracker', action='append', default=[], metavar='URL[,URL...]',
+                           help='announce URLs of one tier, repeat the option for more tiers')
+    my_parser.add_argument('-w', '--web-seed', action='append', default=[], metavar='URL',
+                           help='HTTP web seed URL (BEP 19), repeat the option for more')
+    my_parser.add_argument('--piece-length', type=int, metavar='KIB',
+                           help='piece length in KiB, chosen from the total size by default')
+    my_parser.add_argument('--comment', help='a free-form comment')
+    my_parser.add_argument('--private', action='store_true', help='set the private flag (BEP 27)')
+    my_parser.add_argument('--workers', type=int, help='hashing processes, defaults to the CPU count')
+    args = my_parser.parse_args()
+
+    if not os.path.exists(args.path):
+        print(f'Exception: Path "{args.path}" does not exist.')
+        sys.exit(1)
+    piece_length = None
+    if args.piece_length is not None:
+        piece_length = args.piece_length * 1024
+        # piece长度须为16KiB的2的幂倍
+        if piece_length < 2 ** 14 or piece_length & (piece_length - 1):
+            print('Exception: Piece length must be a power of two and at least 16 KiB.')
+            sys.exit(1)
+    announce_tiers = [[url for url in tier.split(',') if url] for tier in args.tracker]
+    start_time = time.perf_counter()
+    try:
+        meta_info = make_torrent(args.path, announce_tiers, piece_length, args.comment,
+                                 args.private, args.workers, args.web_seed)
+    except (OSError, ValueError) as e:
+        print(f'Exception: {e}')
+        sys.exit(1)
+    elapsed = time.perf_counter() - start_time
+    info = meta_info[b'info']
+    output = args.output or info[b'name'].decode() + '.torrent'
+    write_torrent(meta_info, output)
+    length = info.get(b'length') or sum(file[b'length'] for file in info[b'files'])
+    print('{}: {} pieces of {} KiB, hashed {:.1f} MiB in {:.2f}s ({:.1f} MiB/s)'.format(
+        output, len(info[b'pieces']) // 20, info[b'piece length'] // 1024, length / 2 ** 20,
+        elapsed, length / 2 ** 20 / max(elapsed, 1e-9)))
+    print('info_hash: ' + hashlib.sha1(Bencode.encode(info)).hexdigest())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+from Config import SETTINGS
+from MetainfoCache import MetainfoCache
+import argparse
+import os
+import sys
+import time
+
+
+def main():
+    # 为目录下的所有.torrent文件建立metainfo缓存, 未缓存或已变化的文件由进程池并行解析
+    my_parser = argparse.ArgumentParser(description='Index a directory of .torrent files into the metainfo cache.')
+    my_parser.add_argument('directory', help='the directory to scan recursively')
+    my_parser.add_argument('--db', help='the cache database, defaults to ' + SETTINGS['metainfo_cache'])
+    my_parser.add_argument('--workers', type=int, help='parsing processes, defaults to the CPU count')
+    args = my_parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        print(f'Exception: Directory "{args.directory}" does not exist.')
+        sys.exit(1)
+    start_time = time.perf_counter()
+    cache = MetainfoCache(args.db)
+    try:
+        res = cache.scan(args.directory, args.workers)
+    finally:
+        cache.close()
+    elapsed = time.perf_counter() - start_time
+    for path, error in res['failed'].items():
+        print(f'Exception: Failed to parse "{path}": {error}')
+    print('{} torrent files in {:.2f}s: {} cached, {} parsed, {} failed, {} removed'.format(
+        res['files'], elapsed, res['files'] - res['parsed'], res['parsed'] - len(res['failed']),
+        len(res['failed']), res['removed']))
+
+
+if __name__ == '__main__':
+    main()